@@ -19,6 +19,7 @@ import sys
 basedir = path.dirname(path.abspath(__file__))
 sys.path.append(path.join(basedir, "..", "src"))
 
+import packed
 import plotting
 
 
@@ -232,7 +233,7 @@ def main():
     args = check_argv()
 
     print("Reading:", args.npz_fn)
-    npz = np.load(args.npz_fn)
+    npz = packed.load(args.npz_fn)
 
     if args.normalize:
         print("Normalizing embeddings")
@@ -8,12 +8,17 @@ Contact: kamperh@gmail.com
 Date: 2015, 2018, 2019
 """
 
+from os import path
 import argparse
 import numpy as np
 import scipy.interpolate as interpolate
 import scipy.signal as signal
 import sys
 
+sys.path.append(path.join("..", "src"))
+
+import packed
+
 flatten_order = "C"
 
 
@@ -26,7 +31,10 @@ def check_argv():
     parser = argparse.ArgumentParser(
         description=__doc__.strip().split("\n")[0], add_help=False
         )
-    parser.add_argument("input_npz_fn", type=str, help="input speech file")
+    parser.add_argument(
+        "input_npz_fn", type=str,
+        help="input speech file, a NumPy archive or packed archive"
+        )
     parser.add_argument(
         "output_npz_fn", type=str, help="output embeddings file"
         )
@@ -53,7 +61,7 @@ def main():
     args = check_argv()
     
     print("Reading:", args.input_npz_fn)
-    input_npz = np.load(args.input_npz_fn)
+    input_npz = packed.load(args.input_npz_fn)
     d_frame = input_npz[sorted(input_npz.keys())[0]].shape[1]
 
     print("Frame dimensionality:", d_frame)
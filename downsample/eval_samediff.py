@@ -17,6 +17,7 @@ import sys
 
 sys.path.append(path.join("..", "src"))
 
+import packed
 import samediff
 
 
@@ -29,7 +30,9 @@ def check_argv():
     parser = argparse.ArgumentParser(
         description=__doc__.strip().split("\n")[0], add_help=False
         )
-    parser.add_argument("npz_fn", type=str, help="NumPy archive")
+    parser.add_argument(
+        "npz_fn", type=str, help="NumPy archive or packed archive"
+        )
     parser.add_argument(
         "--metric", choices=["cosine", "euclidean", "hamming", "chebyshev"],
         default="cosine",
@@ -60,7 +63,7 @@ def main():
     print(datetime.now())
 
     print("Reading:", args.npz_fn)
-    npz = np.load(args.npz_fn)
+    npz = packed.load(args.npz_fn)
 
     print(datetime.now())
 
@@ -68,14 +71,20 @@ def main():
     #     print("Normalizing embeddings")
     # else:
     print("Ordering embeddings")
-    n_embeds = 0
-    X = []
-    ids = []
-    for label in sorted(npz):
-        ids.append(label)
-        X.append(npz[label])
-        n_embeds += 1
-    X = np.array(X)
+    if isinstance(npz, packed.PackedArchive) and npz.item_ndim == 1:
+        # Packed embeddings are already sorted and stored as a matrix
+        ids = npz.keys()
+        X = np.array(npz.frames)
+        n_embeds = len(ids)
+    else:
+        n_embeds = 0
+        X = []
+        ids = []
+        for label in sorted(npz):
+            ids.append(label)
+            X.append(npz[label])
+            n_embeds += 1
+        X = np.array(X)
     print("No. embeddings:", n_embeds)
     print("Embedding dimensionality:", X.shape[1])
 
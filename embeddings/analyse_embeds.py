@@ -18,6 +18,7 @@ import sys
 
 sys.path.append(path.join("..", "src"))
 
+import packed
 import plotting
 
 
@@ -237,7 +238,7 @@ def main():
     args = check_argv()
 
     print("Reading:", args.npz_fn)
-    npz = np.load(args.npz_fn)
+    npz = packed.load(args.npz_fn)
 
     if args.normalise:
         print("Normalising embeddings")
@@ -84,9 +84,8 @@ def apply_model(model_fn, subset, language, batch_size=None):
 
         # Pad and flatten data
         x_data, _ = data_io.pad_sequences(
-            x_data, options_dict["max_length"], True
+            x_data, options_dict["max_length"], True, transpose=True
             )
-        x_data = np.transpose(x_data, (0, 2, 1))
         x_data = x_data.reshape((-1, options_dict["d_in"]))
 
         # Build model
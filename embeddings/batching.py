@@ -7,27 +7,228 @@ Date: 2018, 2019
 """
 
 from os import path
+import copy
 import numpy as np
+import queue
 import sys
+import threading
 
 sys.path.append(path.join("..", "src"))
 
 from tflego import NP_DTYPE, TF_DTYPE, NP_ITYPE, TF_ITYPE
 
+COMPRESSED_DTYPES = [np.float16, np.int8]
+
+
+#-----------------------------------------------------------------------------#
+#                          PACKED SEQUENCE CONTAINERS                         #
+#-----------------------------------------------------------------------------#
+
+class PackedSequences(object):
+    """
+    Sequences stored as spans of a single contiguous frame matrix.
+
+    Sequence `i` is `frames[starts[i]:starts[i] + lengths[i]]`. Indexing gives
+    this view, so the container can be used in place of a list of sequences.
+    Batches are padded by `pad` directly from `frames`.
+    Several containers can share the same `frames`, e.g. with one giving
+    subsequences of another.
+
+    The frames can be stored in a compressed form (see `compress_sequences`),
+    e.g. as float16. If `scale` and `offset` are given, `frames` holds
+    quantised values and the actual frames are `frames*scale + offset`. The
+    frames are only decoded to `NP_DTYPE` when indexed or padded.
+    """
+
+    def __init__(self, frames, starts, lengths, scale=None, offset=None):
+        self.frames = frames
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.scale = scale
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        seq = self.frames[self.starts[i]:self.starts[i] + self.lengths[i]]
+        if self.scale is not None:
+            seq = (seq*self.scale + self.offset).astype(NP_DTYPE)
+        return seq
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def subsequences(self, offsets, lengths):
+        """
+        Return a container with, for each sequence, the span of `lengths[i]`
+        frames starting at frame `offsets[i]` within that sequence.
+        """
+        return PackedSequences(
+            self.frames, self.starts + np.asarray(offsets), lengths,
+            self.scale, self.offset
+            )
+
+    def pad(self, indices, n_pad=None, out=None):
+        """
+        Return the sequences `indices` zero-padded to a common length.
+
+        The sequences are copied into a [len(indices), n_pad, d_frame] array,
+        with `n_pad` by default the maximum length of the sequences. If given,
+        `out` is filled and returned instead of allocating a new array; it
+        does not have to be zeroed beforehand. Compressed frames are decoded
+        to `NP_DTYPE`.
+        """
+        lengths = self.lengths[indices]
+        if n_pad is None:
+            n_pad = np.max(lengths)
+        if out is None:
+            out = np.empty(
+                (len(indices), n_pad, self.frames.shape[-1]),
+                dtype=NP_DTYPE if self.frames.dtype in COMPRESSED_DTYPES
+                else self.frames.dtype
+                )
+        # Each sequence is a single contiguous copy, which is faster than
+        # gathering individual frames with an index array
+        for i, start, length in zip(
+                range(len(lengths)), self.starts[indices].tolist(),
+                lengths.tolist()):
+            out[i, :length] = self.frames[start:start + length]
+            out[i, length:] = 0
+        if self.scale is not None:
+            # Decode the whole batch at once, then clear the padding again
+            out *= self.scale
+            out += self.offset
+            for i, length in enumerate(lengths.tolist()):
+                out[i, length:] = 0
+        return out
+
+
+class BatchBuffers(object):
+    """
+    A ring of `n_buffers` reusable arrays for padded batches.
+
+    Each call to `get` returns the next buffer in the ring viewed with the
+    requested shape, so a batch stays valid until `n_buffers` more arrays have
+    been requested. The contents of the returned array are arbitrary. If
+    `n_buffers` is 0, a new array is allocated every time.
+    """
+
+    def __init__(self, n_buffers, dtype=NP_DTYPE):
+        self.n_buffers = n_buffers
+        self.dtype = dtype
+        self.buffers = [np.empty(0, dtype=dtype) for i in range(n_buffers)]
+        self.i_buffer = 0
+
+    def get(self, shape):
+        if self.n_buffers == 0:
+            return np.empty(shape, dtype=self.dtype)
+        size = int(np.prod(shape))
+        if self.buffers[self.i_buffer].size < size:
+            self.buffers[self.i_buffer] = np.empty(size, dtype=self.dtype)
+        buffer = self.buffers[self.i_buffer][:size].reshape(shape)
+        self.i_buffer = (self.i_buffer + 1) % self.n_buffers
+        return buffer
+
+
+class PaddedBuckets(object):
+    """
+    Sequences padded once for each bucket of fixed membership.
+
+    Element `i` of a batch (e.g. a sequence or a pair) is in bucket
+    `element_buckets[i]`, or in no bucket if this is -1, and uses the
+    sequences `element_sequences[i]` of `x_packed` (by default, sequence
+    `i`). The sequences used in a bucket are stored together as a zero-padded
+    [n_sequences, max_length, d_frame] tensor, padded to the longest sequence
+    in the bucket. A batch with all its elements in the same bucket is then
+    gathered from this tensor, which is much faster than padding it from the
+    frames; other batches fall back to `PackedSequences.pad`.
+    """
+
+    def __init__(self, x_packed, element_buckets, element_sequences=None):
+        self.x_packed = x_packed
+        self.element_buckets = np.asarray(element_buckets)
+        self.sequences = []  # sorted sequence indices used in each bucket
+        self.tensors = []
+        for i_bucket in range(np.max(self.element_buckets) + 1):
+            elements = np.flatnonzero(self.element_buckets == i_bucket)
+            if element_sequences is None:
+                sequences = elements
+            else:
+                sequences = np.unique(element_sequences[elements])
+            self.sequences.append(sequences)
+            self.tensors.append(x_packed.pad(sequences, n_pad=(
+                np.max(x_packed.lengths[sequences]) if len(sequences) > 0
+                else 0
+                )))
+        self.nbytes = sum([tensor.nbytes for tensor in self.tensors])
+
+    def pad(self, elements, indices, n_pad=None, out=None):
+        """
+        Return the sequences `indices` for the batch `elements` zero-padded to
+        a common length, as for `PackedSequences.pad`.
+        """
+        if n_pad is None:
+            n_pad = np.max(self.x_packed.lengths[indices])
+        buckets = self.element_buckets[elements]
+        i_bucket = buckets[0]
+        if i_bucket < 0 or np.any(buckets != i_bucket):
+            return self.x_packed.pad(indices, n_pad=n_pad, out=out)
+        tensor = self.tensors[i_bucket]
+        if out is None:
+            out = np.empty(
+                (len(indices), n_pad, tensor.shape[-1]), dtype=tensor.dtype
+                )
+        rows = np.searchsorted(self.sequences[i_bucket], indices)
+        return np.take(tensor[:, :n_pad], rows, axis=0, out=out, mode="clip")
+
 
 #-----------------------------------------------------------------------------#
 #                          BATCHING ITERATOR CLASSES                          #
 #-----------------------------------------------------------------------------#
 
-class SimpleIterator(object):
+class CheckpointableIterator(object):
+    """
+    Base class for iterators with a state that can be saved and restored.
+
+    The state consists of the attributes named in `state_attributes`, i.e.
+    those that can change from one epoch to the next, together with the state
+    of the NumPy random generator that the iterators draw from. Restoring the
+    state saved at the start of an epoch therefore gives exactly the same
+    batches for that epoch and all later epochs.
+    """
+
+    state_attributes = ()
+
+    def get_state(self):
+        state = {"rng_state": np.random.get_state()}
+        for name in self.state_attributes:
+            if hasattr(self, name):
+                state[name] = copy.deepcopy(getattr(self, name))
+        return state
+
+    def set_state(self, state):
+        np.random.set_state(state["rng_state"])
+        for name in self.state_attributes:
+            if name in state:
+                setattr(self, name, copy.deepcopy(state[name]))
+
+
+class SimpleIterator(CheckpointableIterator):
     """Iterator without bucketing."""
+
+    state_attributes = ("indices",)
     
-    def __init__(self, x_list, batch_size, shuffle_every_epoch=False):
+    def __init__(self, x_list, batch_size, shuffle_every_epoch=False,
+            n_buffers=0):
         self.x_list = x_list
         self.batch_size = batch_size
         self.shuffle_every_epoch = shuffle_every_epoch
         self.n_input = self.x_list[0].shape[-1]
-        self.x_lengths = np.array([i.shape[0] for i in x_list])
+        self.x_packed = pack_sequences(x_list)
+        self.x_lengths = self.x_packed.lengths
+        self.buffers = BatchBuffers(n_buffers)
         self.n_batches = int(np.ceil(float(len(self.x_lengths))/batch_size))
         self.indices = np.arange(len(self.x_lengths))
         np.random.shuffle(self.indices)
@@ -46,121 +247,216 @@ class SimpleIterator(object):
             batch_x_lengths = self.x_lengths[batch_indices]
 
             # Pad to maximum length in batch
-            batch_x_padded = np.zeros(
-                (len(batch_indices), np.max(batch_x_lengths), self.n_input),
-                 dtype=NP_DTYPE
+            batch_x_padded = self.x_packed.pad(
+                batch_indices, out=self.buffers.get((len(batch_indices),
+                np.max(batch_x_lengths), self.n_input))
                 )
-            for i, length in enumerate(batch_x_lengths):
-                seq = self.x_list[batch_indices[i]]
-                batch_x_padded[i, :length, :] = seq
 
             yield (batch_x_padded, batch_x_lengths)
 
 
-class SimpleBucketIterator(object):
+class SimpleBucketIterator(CheckpointableIterator):
     """An iterator with bucketing."""
 
+    state_attributes = ("buckets", "indices", "batches", "n_batches")
+
     def __init__(self, x_list, batch_size, n_buckets,
-            shuffle_every_epoch=False):
+            shuffle_every_epoch=False, n_buffers=0, max_frames=None,
+            prepad=False):
         self.x_list = x_list
         self.batch_size = batch_size
         self.shuffle_every_epoch = shuffle_every_epoch
+        self.max_frames = max_frames
         self.n_input = self.x_list[0].shape[-1]
-        self.x_lengths = np.array([i.shape[0] for i in x_list])
+        self.x_packed = pack_sequences(x_list)
+        self.x_lengths = self.x_packed.lengths
+        self.buffers = BatchBuffers(n_buffers)
         self.n_batches = int(len(self.x_lengths)/batch_size)
         
         # Set up bucketing
         self.n_buckets = n_buckets
-        sorted_indices = np.argsort([len(i) for i in x_list])
-        bucket_size = int(len(self.x_lengths)/self.n_buckets)
-        self.buckets = []
-        for i_bucket in range(n_buckets):
-            self.buckets.append(
-                sorted_indices[i_bucket*bucket_size:(i_bucket + 1)*bucket_size]
+        if max_frames is not None:
+            self.bucket_boundaries = get_bucket_boundaries(
+                self.x_lengths, n_buckets
                 )
+        else:
+            sorted_indices = np.argsort([len(i) for i in x_list])
+            bucket_size = int(len(self.x_lengths)/self.n_buckets)
+            self.buckets = []
+            for i_bucket in range(n_buckets):
+                self.buckets.append(sorted_indices[
+                    i_bucket*bucket_size:(i_bucket + 1)*bucket_size
+                    ])
+
+        # Bucket membership is fixed, so buckets can be padded once
+        self.padded_buckets = None
+        if prepad:
+            if max_frames is not None:
+                item_buckets = np.searchsorted(
+                    self.bucket_boundaries, self.x_lengths
+                    )
+            else:
+                item_buckets = get_bucket_ids(
+                    len(self.x_lengths), self.buckets
+                    )
+            self.padded_buckets = PaddedBuckets(self.x_packed, item_buckets)
+
         self.shuffle()
             
     def shuffle(self):
+        if self.max_frames is not None:
+            self.batches = get_budget_batches(
+                self.x_lengths, self.bucket_boundaries, self.max_frames
+                )
+            self.n_batches = len(self.batches)
+            return
         for i_bucket in range(self.n_buckets):
             np.random.shuffle(self.buckets[i_bucket])
         self.indices = np.concatenate(self.buckets)
+
+    def get_batches(self):
+        """Return the item indices of each batch in the current epoch."""
+        if self.max_frames is not None:
+            return self.batches
+        return [
+            self.indices[i_batch*self.batch_size:(i_batch + 1)*self.batch_size]
+            for i_batch in range(self.n_batches)
+            ]
+
+    def padding_efficiency(self):
+        """Return the fraction of real frames in this epoch's batches."""
+        return get_padding_efficiency(
+            [self.x_lengths[i] for i in self.get_batches()]
+            )
     
     def __iter__(self):
 
         if self.shuffle_every_epoch:
             self.shuffle()
         
-        for i_batch in range(self.n_batches):
-
-            batch_indices = self.indices[
-                i_batch*self.batch_size:(i_batch + 1)*self.batch_size
-                ]
+        for batch_indices in self.get_batches():
             
             batch_x_lengths = self.x_lengths[batch_indices]
 
             # Pad to maximum length in batch
-            batch_x_padded = np.zeros(
-                (len(batch_indices), np.max(batch_x_lengths), self.n_input),
-                 dtype=NP_DTYPE
+            out = self.buffers.get(
+                (len(batch_indices), np.max(batch_x_lengths), self.n_input)
                 )
-            for i, length in enumerate(batch_x_lengths):
-                seq = self.x_list[batch_indices[i]]
-                batch_x_padded[i, :length, :] = seq
+            if self.padded_buckets is not None:
+                batch_x_padded = self.padded_buckets.pad(
+                    batch_indices, batch_indices, out=out
+                    )
+            else:
+                batch_x_padded = self.x_packed.pad(batch_indices, out=out)
 
             yield (batch_x_padded, batch_x_lengths)
 
 
-class PairedBucketIterator(object):
+class PairedBucketIterator(CheckpointableIterator):
     """Iterator over bucketed pairs of sequences."""
+
+    state_attributes = (
+        "bucket_boundaries", "buckets", "indices", "batches", "n_batches"
+        )
     
     def __init__(self, x_list, pair_list, batch_size, n_buckets,
-            shuffle_every_epoch=False, speaker_ids=None):
+            shuffle_every_epoch=False, speaker_ids=None, n_buffers=0,
+            max_frames=None, prepad=False):
 
         # Attributes
         self.x_list = x_list
-        self.pair_list = pair_list
         self.batch_size = batch_size
         self.shuffle_every_epoch = shuffle_every_epoch
+        self.max_frames = max_frames
+        self.prepad = prepad
         self.speaker_ids = speaker_ids
 
         self.n_input = self.x_list[0].shape[-1]
-        self.x_lengths = np.array([i.shape[0] for i in x_list])
+        self.x_packed = pack_sequences(x_list)
+        self.x_lengths = self.x_packed.lengths
+        self.buffers = BatchBuffers(2*n_buffers)  # two arrays per batch
+        self.n_buckets = n_buckets
+        self.set_pair_list(pair_list)
+        self.shuffle()
+
+    def set_pair_list(self, pair_list):
+        """Set the pairs that are iterated over and bucket them on length."""
+        self.pair_list = np.asarray(pair_list, dtype=NP_ITYPE).reshape(-1, 2)
         # self.n_batches = int(len(self.x_lengths)/batch_size)
         self.n_batches = int(len(self.pair_list)/self.batch_size)
         
         # Set up bucketing
-        self.n_buckets = n_buckets
-        sorted_indices = np.argsort(
-            [max(len(x_list[i]), len(x_list[j])) for i, j in pair_list]
+        self.pair_lengths = np.maximum(
+            self.x_lengths[self.pair_list[:, 0]],
+            self.x_lengths[self.pair_list[:, 1]]
             )
-        # bucket_size = int(len(self.x_lengths)/self.n_buckets)
-        bucket_size = int(len(self.pair_list)/self.n_buckets)
-        self.buckets = []
-        for i_bucket in range(n_buckets):
-            self.buckets.append(
-                sorted_indices[i_bucket*bucket_size:(i_bucket + 1)*bucket_size]
+        if self.max_frames is not None:
+            self.bucket_boundaries = get_bucket_boundaries(
+                self.pair_lengths, self.n_buckets
+                )
+        else:
+            sorted_indices = np.argsort(self.pair_lengths)
+            # bucket_size = int(len(self.x_lengths)/self.n_buckets)
+            bucket_size = int(len(self.pair_list)/self.n_buckets)
+            self.buckets = []
+            for i_bucket in range(self.n_buckets):
+                self.buckets.append(sorted_indices[
+                    i_bucket*bucket_size:(i_bucket + 1)*bucket_size
+                    ])
+
+        # Bucket membership is fixed, so buckets can be padded once
+        self.padded_buckets = None
+        if self.prepad:
+            if self.max_frames is not None:
+                pair_buckets = np.searchsorted(
+                    self.bucket_boundaries, self.pair_lengths
+                    )
+            else:
+                pair_buckets = get_bucket_ids(
+                    len(self.pair_list), self.buckets
+                    )
+            self.padded_buckets = PaddedBuckets(
+                self.x_packed, pair_buckets, self.pair_list
                 )
-        self.shuffle()
 
     def shuffle(self):
+        if self.max_frames is not None:
+            self.batches = get_budget_batches(
+                self.pair_lengths, self.bucket_boundaries, self.max_frames,
+                frames_per_item=2
+                )
+            self.n_batches = len(self.batches)
+            return
         for i_bucket in range(self.n_buckets):
             np.random.shuffle(self.buckets[i_bucket])
         self.indices = np.concatenate(self.buckets)
+
+    def get_batches(self):
+        """Return the pair indices of each batch in the current epoch."""
+        if self.max_frames is not None:
+            return self.batches
+        return [
+            self.indices[i_batch*self.batch_size:(i_batch + 1)*self.batch_size]
+            for i_batch in range(self.n_batches)
+            ]
+
+    def padding_efficiency(self):
+        """Return the fraction of real frames in this epoch's batches."""
+        return get_padding_efficiency([
+            self.x_lengths[self.pair_list[i]] for i in self.get_batches()
+            ])
     
     def __iter__(self):
 
         if self.shuffle_every_epoch:
             self.shuffle()
         
-        for i_batch in range(self.n_batches):
+        for batch_pair_indices in self.get_batches():
             
-            batch_pair_list = [
-                self.pair_list[i] for i in self.indices[
-                i_batch*self.batch_size:(i_batch + 1)*self.batch_size]
-                ]
+            batch_pair_list = self.pair_list[batch_pair_indices]
 
-            batch_indices_a = [i for i, j in batch_pair_list]
-            batch_indices_b = [j for i, j in batch_pair_list]
+            batch_indices_a = batch_pair_list[:, 0]
+            batch_indices_b = batch_pair_list[:, 1]
             
             batch_lengths_a = self.x_lengths[batch_indices_a]
             batch_lengths_b = self.x_lengths[batch_indices_b]
@@ -171,19 +467,27 @@ class PairedBucketIterator(object):
             
             n_pad = max(np.max(batch_lengths_a), np.max(batch_lengths_b))
             
-            # Pad to maximum length in batch            
-            batch_padded_a = np.zeros(
-                (len(batch_indices_a), n_pad, self.n_input), dtype=NP_DTYPE
+            # Pad to maximum length in batch
+            out_a = self.buffers.get(
+                (len(batch_indices_a), n_pad, self.n_input)
                 )
-            batch_padded_b = np.zeros(
-                (len(batch_indices_b), n_pad, self.n_input), dtype=NP_DTYPE
+            out_b = self.buffers.get(
+                (len(batch_indices_b), n_pad, self.n_input)
                 )
-            for i, length in enumerate(batch_lengths_a):
-                seq = self.x_list[batch_indices_a[i]]
-                batch_padded_a[i, :length, :] = seq
-            for i, length in enumerate(batch_lengths_b):
-                seq = self.x_list[batch_indices_b[i]]
-                batch_padded_b[i, :length, :] = seq
+            if self.padded_buckets is not None:
+                batch_padded_a = self.padded_buckets.pad(
+                    batch_pair_indices, batch_indices_a, n_pad, out_a
+                    )
+                batch_padded_b = self.padded_buckets.pad(
+                    batch_pair_indices, batch_indices_b, n_pad, out_b
+                    )
+            else:
+                batch_padded_a = self.x_packed.pad(
+                    batch_indices_a, n_pad, out_a
+                    )
+                batch_padded_b = self.x_packed.pad(
+                    batch_indices_b, n_pad, out_b
+                    )
             
             if self.speaker_ids is None:
                 yield (
@@ -197,41 +501,131 @@ class PairedBucketIterator(object):
                     )
 
 
-class RandomSegmentsIterator(object):
+class SampledPairIterator(PairedBucketIterator):
+    """
+    Iterator over bucketed pairs sampled from tokens of the same type.
+
+    Rather than taking the list of all same-type pairs, which grows
+    quadratically in the number of tokens of a type, `n_pairs` ordered pairs
+    are drawn from the groups of tokens with the same label in `labels` (by
+    default, as many pairs as there are tokens). A type with k tokens is drawn
+    with probability proportional to its k(k - 1) pairs, or to
+    `max_pairs_per_type` if this is smaller, and then two different tokens of
+    the type are drawn uniformly. Without a cap this is the same as drawing
+    from the full pair list. If `shuffle_every_epoch` is True, new pairs are
+    drawn for every epoch. Batches are the same as for `PairedBucketIterator`.
+    """
+
+    state_attributes = (
+        PairedBucketIterator.state_attributes + ("pair_list", "pair_lengths")
+        )
+
+    def __init__(self, x_list, labels, batch_size, n_buckets, n_pairs=None,
+            max_pairs_per_type=None, shuffle_every_epoch=False,
+            speaker_ids=None, n_buffers=0, max_frames=None):
+
+        # Groups of tokens of each type with at least two tokens
+        _, codes = np.unique(np.asarray(labels), return_inverse=True)
+        self.sorted_indices = np.argsort(codes, kind="mergesort")
+        group_sizes = np.bincount(codes)
+        group_starts = np.cumsum(group_sizes) - group_sizes
+        self.group_sizes = group_sizes[group_sizes >= 2]
+        self.group_starts = group_starts[group_sizes >= 2]
+        assert len(self.group_sizes) > 0, "no type with more than one token"
+
+        type_weights = self.group_sizes*(self.group_sizes - 1.0)
+        if max_pairs_per_type is not None:
+            type_weights = np.minimum(type_weights, max_pairs_per_type)
+        self.type_probs = type_weights/np.sum(type_weights)
+        self.n_pairs = len(codes) if n_pairs is None else n_pairs
+
+        super(SampledPairIterator, self).__init__(
+            x_list, self.sample_pairs(), batch_size, n_buckets,
+            shuffle_every_epoch=shuffle_every_epoch, speaker_ids=speaker_ids,
+            n_buffers=n_buffers, max_frames=max_frames
+            )
+
+    def sample_pairs(self):
+        """Return `n_pairs` pairs of different tokens of the same type."""
+        types = np.random.choice(
+            len(self.type_probs), self.n_pairs, p=self.type_probs
+            )
+        sizes = self.group_sizes[types]
+        offsets_a = (np.random.random(self.n_pairs)*sizes).astype(np.int64)
+        offsets_b = (
+            np.random.random(self.n_pairs)*(sizes - 1)
+            ).astype(np.int64)
+        offsets_b += offsets_b >= offsets_a  # skip over the first token
+        starts = self.group_starts[types]
+        return np.stack([
+            self.sorted_indices[starts + offsets_a],
+            self.sorted_indices[starts + offsets_b]
+            ], axis=1)
+
+    def __iter__(self):
+        if self.shuffle_every_epoch:
+            self.set_pair_list(self.sample_pairs())
+        return super(SampledPairIterator, self).__iter__()
+
+
+class RandomSegmentsIterator(CheckpointableIterator):
     """An iterator that samples random subsequences for each batch."""
+
+    state_attributes = (
+        "bucket_boundaries", "buckets", "indices", "batches", "n_batches"
+        )
     
     def __init__(self, x_full_list, batch_size, n_buckets, min_dur=50,
-            max_dur=100, shuffle_every_epoch=False, paired=False):
+            max_dur=100, shuffle_every_epoch=False, paired=False, n_buffers=0,
+            max_frames=None):
         self.x_full_list = x_full_list
         self.batch_size = batch_size
         self.n_buckets = n_buckets
+        self.max_frames = max_frames
         self.min_dur = min_dur
         self.max_dur = max_dur
         self.shuffle_every_epoch = shuffle_every_epoch
         self.paired = paired
         self.n_input = self.x_full_list[0].shape[-1]
         self.n_batches = int(len(self.x_full_list)/batch_size)
+        self.x_full_packed = pack_sequences(x_full_list)
+        self.buffers = BatchBuffers(n_buffers)
 
         self.sample_segments()
 
     def sample_segments(self):
-        self.x_list = []
-        for cur_x in self.x_full_list:
-            cur_len = cur_x.shape[0]
-            dur = np.random.randint(self.min_dur, min(self.max_dur, cur_len))
-            start = np.random.randint(0, cur_len - dur)
-            self.x_list.append(cur_x[start:start + dur, :])
-        self.x_lengths = np.array([i.shape[0] for i in self.x_list])
-        sorted_indices = np.argsort([len(i) for i in self.x_list])
-        bucket_size = int(len(self.x_lengths)/self.n_buckets)
-        self.buckets = []
-        for i_bucket in range(self.n_buckets):
-            self.buckets.append(
-                sorted_indices[i_bucket*bucket_size:(i_bucket + 1)*bucket_size]
+        # Segments are drawn for all the sequences at once and are only
+        # (start, length) spans into `x_full_packed`, so no frames are copied
+        full_lengths = self.x_full_packed.lengths
+        durs = np.random.randint(
+            self.min_dur, np.minimum(self.max_dur, full_lengths)
+            )
+        starts = np.random.randint(0, full_lengths - durs)
+        self.x_packed = self.x_full_packed.subsequences(starts, durs)
+        self.x_list = self.x_packed
+        self.x_lengths = self.x_packed.lengths
+        if self.max_frames is not None:
+            self.bucket_boundaries = get_bucket_boundaries(
+                self.x_lengths, self.n_buckets
                 )
+        else:
+            sorted_indices = np.argsort(self.x_lengths)
+            bucket_size = int(len(self.x_lengths)/self.n_buckets)
+            self.buckets = []
+            for i_bucket in range(self.n_buckets):
+                self.buckets.append(sorted_indices[
+                    i_bucket*bucket_size:(i_bucket + 1)*bucket_size
+                    ])
         self.shuffle()
 
     def shuffle(self):
+        if self.max_frames is not None:
+            self.batches = get_budget_batches(
+                self.x_lengths, self.bucket_boundaries, self.max_frames,
+                frames_per_item=2 if self.paired else 1
+                )
+            self.n_batches = len(self.batches)
+            return
         for i_bucket in range(self.n_buckets):
             np.random.shuffle(self.buckets[i_bucket])
         self.indices = np.concatenate(self.buckets)
@@ -241,28 +635,52 @@ class RandomSegmentsIterator(object):
         #     ]
         # np.random.shuffle(blocks)
         # self.indices[:] = [b for bs in blocks for b in bs]
+
+    def get_state(self):
+        state = super(RandomSegmentsIterator, self).get_state()
+        state["segment_starts"] = self.x_packed.starts.copy()
+        state["segment_lengths"] = self.x_packed.lengths.copy()
+        return state
+
+    def set_state(self, state):
+        super(RandomSegmentsIterator, self).set_state(state)
+        self.x_packed = PackedSequences(
+            self.x_full_packed.frames, state["segment_starts"],
+            state["segment_lengths"], self.x_full_packed.scale,
+            self.x_full_packed.offset
+            )
+        self.x_list = self.x_packed
+        self.x_lengths = self.x_packed.lengths
+
+    def get_batches(self):
+        """Return the segment indices of each batch in the current epoch."""
+        if self.max_frames is not None:
+            return self.batches
+        return [
+            self.indices[i_batch*self.batch_size:(i_batch + 1)*self.batch_size]
+            for i_batch in range(self.n_batches)
+            ]
+
+    def padding_efficiency(self):
+        """Return the fraction of real frames in this epoch's batches."""
+        return get_padding_efficiency(
+            [self.x_lengths[i] for i in self.get_batches()]
+            )
         
     def __iter__(self):
 
         if self.shuffle_every_epoch:
             self.sample_segments()
         
-        for i_batch in range(self.n_batches):
-
-            batch_indices = self.indices[
-                i_batch*self.batch_size:(i_batch + 1)*self.batch_size
-                ]
+        for batch_indices in self.get_batches():
             
             batch_x_lengths = self.x_lengths[batch_indices]
 
             # Pad to maximum length in batch
-            batch_x_padded = np.zeros(
-                (len(batch_indices), np.max(batch_x_lengths), self.n_input),
-                 dtype=NP_DTYPE
+            batch_x_padded = self.x_packed.pad(
+                batch_indices, out=self.buffers.get((len(batch_indices),
+                np.max(batch_x_lengths), self.n_input))
                 )
-            for i, length in enumerate(batch_x_lengths):
-                seq = self.x_list[batch_indices[i]]
-                batch_x_padded[i, :length, :] = seq
 
             if self.paired:
                 yield (
@@ -273,13 +691,16 @@ class RandomSegmentsIterator(object):
                 yield (batch_x_padded, batch_x_lengths)
 
 
-class LabelledBucketIterator(object):
+class LabelledBucketIterator(CheckpointableIterator):
     """Iterator with labels and bucketing."""
+
+    state_attributes = ("buckets", "indices", "batches", "n_batches")
     
     def __init__(self, x_list, y, batch_size, n_buckets,
-            shuffle_every_epoch=False):
+            shuffle_every_epoch=False, n_buffers=0, max_frames=None):
         self.x_list = x_list
         self.y = y
+        self.max_frames = max_frames
         self.batch_size = int(np.floor(batch_size*0.5))  # batching is done
                                                          # over pairs, but
                                                          # target batch size
@@ -287,66 +708,97 @@ class LabelledBucketIterator(object):
                                                          # within pairs
         self.shuffle_every_epoch = shuffle_every_epoch
         self.n_input = self.x_list[0].shape[-1]
-        self.x_lengths = np.array([i.shape[0] for i in x_list])
+        self.x_packed = pack_sequences(x_list)
+        self.x_lengths = self.x_packed.lengths
+        self.buffers = BatchBuffers(n_buffers)
         self.pair_list = get_pair_list(y, both_directions=False)
         self.n_batches = int(len(self.pair_list)/self.batch_size)
         
         # Set up bucketing
         self.n_buckets = n_buckets
-        sorted_indices = np.argsort(
-            [max(len(x_list[i]), len(x_list[j])) for i, j in self.pair_list]
+        self.pair_lengths = np.maximum(
+            self.x_lengths[self.pair_list[:, 0]],
+            self.x_lengths[self.pair_list[:, 1]]
             )
-        bucket_size = int(len(self.pair_list)/self.n_buckets)
-        self.buckets = []
-        for i_bucket in range(self.n_buckets):
-            self.buckets.append(
-                sorted_indices[i_bucket*bucket_size:(i_bucket + 1)*bucket_size]
+        if max_frames is not None:
+            self.bucket_boundaries = get_bucket_boundaries(
+                self.pair_lengths, n_buckets
                 )
+        else:
+            sorted_indices = np.argsort(self.pair_lengths)
+            bucket_size = int(len(self.pair_list)/self.n_buckets)
+            self.buckets = []
+            for i_bucket in range(self.n_buckets):
+                self.buckets.append(sorted_indices[
+                    i_bucket*bucket_size:(i_bucket + 1)*bucket_size
+                    ])
         self.shuffle()
 
     def shuffle(self):
+        if self.max_frames is not None:
+            # Each pair contributes at most two items to a batch
+            self.batches = get_budget_batches(
+                self.pair_lengths, self.bucket_boundaries, self.max_frames,
+                frames_per_item=2
+                )
+            self.n_batches = len(self.batches)
+            return
         for i_bucket in range(self.n_buckets):
             np.random.shuffle(self.buckets[i_bucket])
         self.indices = np.concatenate(self.buckets)
+
+    def get_batches(self):
+        """Return the pair indices of each batch in the current epoch."""
+        if self.max_frames is not None:
+            return self.batches
+        return [
+            self.indices[i_batch*self.batch_size:(i_batch + 1)*self.batch_size]
+            for i_batch in range(self.n_batches)
+            ]
+
+    def get_batch_indices(self, batch_pair_indices):
+        """Return the indices of the items in the given pairs."""
+        batch_pair_list = self.pair_list[batch_pair_indices]
+        return list(set(
+            batch_pair_list[:, 0].tolist() + batch_pair_list[:, 1].tolist()
+            ))
+
+    def padding_efficiency(self):
+        """Return the fraction of real frames in this epoch's batches."""
+        return get_padding_efficiency([
+            self.x_lengths[self.get_batch_indices(i)]
+            for i in self.get_batches()
+            ])
     
     def __iter__(self):
 
         if self.shuffle_every_epoch:
             self.shuffle()
         
-        for i_batch in range(self.n_batches):
-            
-            batch_pair_list = [
-                self.pair_list[i] for i in self.indices[
-                i_batch*self.batch_size:(i_batch + 1)*self.batch_size]
-                ]
+        for batch_pair_indices in self.get_batches():
 
-            batch_indices = list(
-                set([i for i, j in batch_pair_list] + [j for i, j in
-                batch_pair_list])
-                )
+            batch_indices = self.get_batch_indices(batch_pair_indices)
             
             batch_x_lengths = self.x_lengths[batch_indices]
             batch_y = self.y[batch_indices]
             
             # Pad to maximum length in batch
-            batch_x_padded = np.zeros(
-                (len(batch_indices), np.max(batch_x_lengths), self.n_input),
-                 dtype=NP_DTYPE
+            batch_x_padded = self.x_packed.pad(
+                batch_indices, out=self.buffers.get((len(batch_indices),
+                np.max(batch_x_lengths), self.n_input))
                 )
-            for i, length in enumerate(batch_x_lengths):
-                seq = self.x_list[batch_indices[i]]
-                batch_x_padded[i, :length, :] = seq
 
             yield (batch_x_padded, batch_x_lengths, batch_y)
 
 
-class LabelledIterator(object):
+class LabelledIterator(CheckpointableIterator):
     """
     Iterator without bucketing or padding but with labels.
     
     If `y_vec` is set to None, no labels are yielded.
     """
+
+    state_attributes = ("indices",)
     
     def __init__(self, x_mat, y_vec, batch_size, shuffle_every_epoch=False):
         self.x_mat = x_mat
@@ -373,20 +825,494 @@ class LabelledIterator(object):
                 yield (self.x_mat[batch_indices], self.y_vec[batch_indices])
 
 
+class ClassBalancedSampler(object):
+    """
+    Sampler of batches with `n_classes` classes and `n_samples` items each.
+
+    The items are split into `n_buckets` equal-sized buckets on `lengths`.
+    For every batch, a bucket is drawn, then `n_classes` different classes
+    from those with at least `n_samples` items in that bucket, and then
+    `n_samples` different items from each of these classes. Buckets and
+    classes are drawn with probability proportional to their number of
+    items. Every batch therefore has `n_classes*n_samples` items of similar
+    length, and each item has `n_samples - 1` positives in the batch. Items
+    of classes that cannot be sampled within their length bucket are grouped
+    on class across buckets in an additional bucket, so that such classes
+    are still covered (with batches of mixed lengths). The number of classes
+    and items that can be sampled is printed.
+    """
+
+    def __init__(self, labels, n_classes, n_samples, lengths=None,
+            n_buckets=1):
+        assert n_classes >= 2 and n_samples >= 2, (
+            "batches need at least two classes with two items each"
+            )
+        self.n_classes = n_classes
+        self.n_samples = n_samples
+        _, codes = np.unique(np.asarray(labels), return_inverse=True)
+        if lengths is None:
+            bucket_ids = np.zeros(len(codes), dtype=np.int64)
+        else:
+            bucket_size = int(np.ceil(len(codes)/float(n_buckets)))
+            bucket_ids = np.empty(len(codes), dtype=np.int64)
+            bucket_ids[np.argsort(lengths, kind="mergesort")] = (
+                np.arange(len(codes)) // bucket_size
+                )
+
+        # Group the items in each bucket on class
+        sorted_indices = np.lexsort((codes, bucket_ids))
+        group_boundaries = np.flatnonzero(
+            np.diff(codes[sorted_indices]) |
+            np.diff(bucket_ids[sorted_indices])
+            ) + 1
+        group_starts = np.concatenate([[0], group_boundaries])
+        group_sizes = np.diff(np.append(group_starts, len(codes)))
+        group_buckets = bucket_ids[sorted_indices[group_starts]]
+        self.buckets = []  # (group starts, group sizes) of classes in bucket
+        bucket_n_items = []
+        used_groups = np.zeros(len(group_starts), dtype=bool)
+        for i_bucket in np.unique(group_buckets):
+            use_groups = (
+                (group_buckets == i_bucket) & (group_sizes >= n_samples)
+                )
+            if np.sum(use_groups) < n_classes:
+                continue
+            used_groups |= use_groups
+            self.buckets.append(
+                (group_starts[use_groups], group_sizes[use_groups])
+                )
+            bucket_n_items.append(np.sum(group_sizes[use_groups]))
+
+        # Group the remaining items on class across buckets
+        other_indices = sorted_indices[~np.repeat(used_groups, group_sizes)]
+        other_indices = other_indices[
+            np.argsort(codes[other_indices], kind="mergesort")
+            ]
+        if len(other_indices) > 0:
+            other_starts = np.concatenate([
+                [0], np.flatnonzero(np.diff(codes[other_indices])) + 1
+                ])
+            other_sizes = np.diff(np.append(other_starts, len(other_indices)))
+            use_groups = other_sizes >= n_samples
+            if np.sum(use_groups) >= n_classes:
+                self.buckets.append((
+                    len(sorted_indices) + other_starts[use_groups],
+                    other_sizes[use_groups]
+                    ))
+                bucket_n_items.append(np.sum(other_sizes[use_groups]))
+                sorted_indices = np.concatenate(
+                    [sorted_indices, other_indices]
+                    )
+        self.sorted_indices = sorted_indices
+        assert len(self.buckets) > 0, (
+            "fewer than {} classes have {} items".format(n_classes, n_samples)
+            )
+        self.n_items = int(np.sum(bucket_n_items))
+        self.bucket_probs = np.array(bucket_n_items)/float(self.n_items)
+        n_covered_classes = len(np.unique(np.concatenate([
+            codes[sorted_indices[group_starts]] for group_starts, _ in
+            self.buckets
+            ])))
+        print(
+            "Class-balanced batches cover {} of {} classes and {} of {} "
+            "items".format(
+            n_covered_classes, np.max(codes) + 1, self.n_items, len(codes)
+            ))
+
+    def sample_batches(self, n_batches):
+        """Return a list of `n_batches` arrays of item indices."""
+        batches = []
+        for i_bucket in np.random.choice(
+                len(self.buckets), n_batches, p=self.bucket_probs):
+            group_starts, group_sizes = self.buckets[i_bucket]
+            groups = np.random.choice(
+                len(group_sizes), self.n_classes, replace=False,
+                p=group_sizes/float(np.sum(group_sizes))
+                )
+            batches.append(np.concatenate([
+                self.sorted_indices[group_starts[i] + np.random.choice(
+                group_sizes[i], self.n_samples, replace=False)]
+                for i in groups
+                ]))
+        return batches
+
+
+class ClassBalancedBucketIterator(CheckpointableIterator):
+    """
+    Iterator with labels and class-balanced batches.
+
+    Every batch has `n_classes` classes with `n_samples` items each, drawn by
+    a `ClassBalancedSampler` with length buckets. By default an epoch has as
+    many batches as are needed to cover the number of items that can be
+    sampled.
+    """
+
+    state_attributes = ("batches",)
+
+    def __init__(self, x_list, y, n_classes, n_samples, n_buckets,
+            n_batches=None, shuffle_every_epoch=False, n_buffers=0):
+        self.x_list = x_list
+        self.y = y
+        self.shuffle_every_epoch = shuffle_every_epoch
+        self.n_input = self.x_list[0].shape[-1]
+        self.x_packed = pack_sequences(x_list)
+        self.x_lengths = self.x_packed.lengths
+        self.buffers = BatchBuffers(n_buffers)
+        self.sampler = ClassBalancedSampler(
+            y, n_classes, n_samples, self.x_lengths, n_buckets
+            )
+        if n_batches is None:
+            n_batches = self.sampler.n_items // (n_classes*n_samples)
+        self.n_batches = n_batches
+        self.shuffle()
+
+    def shuffle(self):
+        self.batches = self.sampler.sample_batches(self.n_batches)
+
+    def padding_efficiency(self):
+        """Return the fraction of real frames in this epoch's batches."""
+        return get_padding_efficiency(
+            [self.x_lengths[i] for i in self.batches]
+            )
+
+    def __iter__(self):
+
+        if self.shuffle_every_epoch:
+            self.shuffle()
+
+        for batch_indices in self.batches:
+
+            batch_x_lengths = self.x_lengths[batch_indices]
+            batch_y = self.y[batch_indices]
+
+            # Pad to maximum length in batch
+            batch_x_padded = self.x_packed.pad(
+                batch_indices, out=self.buffers.get((len(batch_indices),
+                np.max(batch_x_lengths), self.n_input))
+                )
+
+            yield (batch_x_padded, batch_x_lengths, batch_y)
+
+
+class ClassBalancedIterator(CheckpointableIterator):
+    """
+    Iterator without bucketing or padding but with class-balanced batches.
+
+    Every batch has `n_classes` classes with `n_samples` items each, drawn by
+    a `ClassBalancedSampler`.
+    """
+
+    state_attributes = ("batches",)
+
+    def __init__(self, x_mat, y_vec, n_classes, n_samples, n_batches=None,
+            shuffle_every_epoch=False):
+        self.x_mat = x_mat
+        self.y_vec = y_vec
+        self.shuffle_every_epoch = shuffle_every_epoch
+        self.sampler = ClassBalancedSampler(y_vec, n_classes, n_samples)
+        if n_batches is None:
+            n_batches = self.sampler.n_items // (n_classes*n_samples)
+        self.n_batches = n_batches
+        self.shuffle()
+
+    def shuffle(self):
+        self.batches = self.sampler.sample_batches(self.n_batches)
+
+    def __iter__(self):
+        if self.shuffle_every_epoch:
+            self.shuffle()
+        for batch_indices in self.batches:
+            yield (self.x_mat[batch_indices], self.y_vec[batch_indices])
+
+
+class PrefetchIterator(object):
+    """
+    Iterator that builds upcoming batches in a background thread.
+
+    Any of the iterators above can be wrapped. Every pass over this iterator
+    starts a thread that iterates over `iterator` and keeps up to
+    `n_prefetch` batches ready, so batches are padded while the main thread
+    is busy with e.g. a training step. The batches are yielded in the same
+    order as `iterator` would give them. Since the random shuffling of
+    `iterator` is then done in the background thread, results are only
+    reproducible for a fixed seed if the main thread does not draw from the
+    NumPy random generator during a pass. Exceptions raised in the thread are
+    raised again in the main thread.
+    """
+
+    def __init__(self, iterator, n_prefetch=2):
+        self.iterator = iterator
+        self.n_prefetch = n_prefetch
+
+    def __getattr__(self, name):
+        # Attributes such as `n_batches` are those of the wrapped iterator
+        if name == "iterator":
+            raise AttributeError(name)
+        return getattr(self.iterator, name)
+
+    def __iter__(self):
+
+        if self.n_prefetch < 1:
+            for batch in self.iterator:
+                yield batch
+            return
+
+        batch_queue = queue.Queue(maxsize=self.n_prefetch)
+        stop_event = threading.Event()
+        end_of_epoch = object()
+
+        def put(item):
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.iterator:
+                    if not put((batch, None)):
+                        return
+            except Exception as exception:
+                put((None, exception))
+                return
+            put((end_of_epoch, None))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch, exception = batch_queue.get()
+                if exception is not None:
+                    raise exception
+                if batch is end_of_epoch:
+                    break
+                yield batch
+        finally:
+            stop_event.set()
+            thread.join()
+
 
 #-----------------------------------------------------------------------------#
 #                              UTILITY FUNCTIONS                              #
 #-----------------------------------------------------------------------------#
 
+def pack_sequences(x_list):
+    """
+    Return `x_list` as a `PackedSequences` container.
+
+    A list of sequences is copied into a single frame matrix, unless the
+    sequences are already all contiguous views into the same frame matrix
+    (e.g. after `data_io.trunc_and_limit_dim`), in which case that matrix is
+    used. A container is returned as is.
+    """
+    if isinstance(x_list, PackedSequences):
+        return x_list
+    lengths = np.array([i.shape[0] for i in x_list], dtype=np.int64)
+    frames = x_list[0].base if len(x_list) > 0 else None
+    if (frames is not None and frames.ndim == 2 and frames.dtype == NP_DTYPE
+            and frames.flags.c_contiguous and all([
+            seq.base is frames and seq.flags.c_contiguous and seq.ndim == 2
+            and seq.shape[1] == frames.shape[1] for seq in x_list
+            ])):
+        starts = (
+            np.array([seq.ctypes.data for seq in x_list], dtype=np.int64) -
+            frames.ctypes.data
+            ) // frames.strides[0]
+        return PackedSequences(frames, starts, lengths)
+    starts = np.cumsum(lengths) - lengths
+    frames = np.zeros((np.sum(lengths), x_list[0].shape[-1]), dtype=NP_DTYPE)
+    for i, seq in enumerate(x_list):
+        frames[starts[i]:starts[i] + lengths[i]] = seq
+    return PackedSequences(frames, starts, lengths)
+
+
+def compress_sequences(x_list, dtype, chunk_size=100000):
+    """
+    Return the sequences in `x_list` with frames stored as `dtype`.
+
+    The returned `PackedSequences` container stores its frames either as
+    float16 or, for int8, quantised with a separate scale and offset for
+    each dimension to cover that dimension's range. Frames are decoded to
+    `NP_DTYPE` only when batches are padded, so compressed sequences can be
+    passed to any of the iterators. Only the frames of the sequences are
+    read and packed into a new contiguous matrix, about `chunk_size` frames
+    at a time, so frames that were truncated or filtered away from an
+    underlying (e.g. memory-mapped) matrix are never loaded.
+    """
+    if isinstance(x_list, PackedSequences):
+        assert x_list.scale is None, "sequences are already compressed"
+        x_list = [
+            x_list.frames[start:start + length] for start, length in
+            zip(x_list.starts, x_list.lengths)
+            ]
+    dtype = np.dtype(dtype)
+    assert dtype in COMPRESSED_DTYPES, "unsupported dtype: " + str(dtype)
+    lengths = np.array([seq.shape[0] for seq in x_list], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    d_frame = x_list[0].shape[-1] if len(x_list) > 0 else 0
+
+    # Groups of consecutive sequences with about `chunk_size` frames
+    groups = np.split(
+        np.arange(len(x_list)),
+        np.flatnonzero(np.diff(starts // chunk_size)) + 1
+        )
+
+    def get_chunks():
+        for group in groups:
+            if len(group) > 0:
+                yield starts[group[0]], np.concatenate(
+                    [x_list[i] for i in group]
+                    ).astype(NP_DTYPE, copy=False)
+
+    scale = None
+    offset = None
+    compressed = np.empty((np.sum(lengths), d_frame), dtype=dtype)
+    if dtype == np.int8:
+        mins = np.full(d_frame, np.inf, dtype=NP_DTYPE)
+        maxs = np.full(d_frame, -np.inf, dtype=NP_DTYPE)
+        for _, chunk in get_chunks():
+            if len(chunk) > 0:
+                mins = np.minimum(mins, chunk.min(axis=0))
+                maxs = np.maximum(maxs, chunk.max(axis=0))
+        scale = ((maxs - mins)/255.).astype(NP_DTYPE)
+        scale[~(scale > 0)] = 1.
+        offset = (mins + 128*scale).astype(NP_DTYPE)
+        offset[~np.isfinite(offset)] = 0.
+    for start, chunk in get_chunks():
+        if dtype == np.int8:
+            chunk = np.clip(np.round((chunk - offset)/scale), -128, 127)
+        compressed[start:start + len(chunk)] = chunk
+    return PackedSequences(compressed, starts, lengths, scale, offset)
+
+
 def get_pair_list(labels, both_directions=True):
-    """Return a list of tuples giving indices of matching types."""
-    N = len(labels)
-    match_list = []
-    for n in range(N - 1):
-        cur_label = labels[n]
-        for cur_match_i in (n + 1 + np.where(np.asarray(labels[n + 1:]) ==
-                cur_label)[0]):
-            match_list.append((n, cur_match_i))
-            if both_directions:
-                match_list.append((cur_match_i, n))
-    return match_list
+    """
+    Return an array of index pairs of matching types.
+
+    The [n_pairs, 2] int32 array is ordered on the first and then the second
+    index of each pair (i, j) with i < j; if `both_directions` is True, each
+    such pair is directly followed by (j, i). Pairs are generated within each
+    group of tokens with the same label, so the cost depends on the group
+    sizes rather than on the total number of tokens.
+    """
+    _, codes = np.unique(np.asarray(labels), return_inverse=True)
+    sorted_indices = np.argsort(codes, kind="mergesort")  # stable
+    group_boundaries = np.flatnonzero(np.diff(codes[sorted_indices])) + 1
+    pairs_a = []
+    pairs_b = []
+    for group in np.split(sorted_indices, group_boundaries):
+        if len(group) < 2:
+            continue
+        i_a, i_b = np.triu_indices(len(group), 1)
+        pairs_a.append(group[i_a])
+        pairs_b.append(group[i_b])
+    if len(pairs_a) == 0:
+        return np.zeros((0, 2), dtype=NP_ITYPE)
+    # Order on the first and then the second index using a single sort key
+    n_tokens = len(codes)
+    pair_keys = (
+        np.concatenate(pairs_a).astype(np.int64)*n_tokens +
+        np.concatenate(pairs_b)
+        )
+    pair_keys.sort()
+    pairs = np.stack([pair_keys // n_tokens, pair_keys % n_tokens], axis=1)
+    if both_directions:
+        pairs = np.stack([pairs, pairs[:, ::-1]], axis=1).reshape(-1, 2)
+    return pairs.astype(NP_ITYPE)
+
+
+def get_bucket_ids(n_items, buckets):
+    """
+    Return the index of the bucket of each of `n_items` items.
+
+    Bucket `i` is given by the item indices `buckets[i]`; items not in any
+    bucket get -1.
+    """
+    bucket_ids = -np.ones(n_items, dtype=np.int64)
+    for i_bucket, bucket in enumerate(buckets):
+        bucket_ids[bucket] = i_bucket
+    return bucket_ids
+
+
+def get_bucket_boundaries(lengths, n_buckets):
+    """
+    Return the maximum length in each of `n_buckets` length buckets.
+
+    The boundaries are chosen from the histogram of `lengths` by dynamic
+    programming to minimise the total padding when every item is padded to the
+    maximum length in its bucket. Fewer buckets are used if there are fewer
+    distinct lengths.
+    """
+    unique_lengths, counts = np.unique(lengths, return_counts=True)
+    n_unique = len(unique_lengths)
+    n_buckets = min(n_buckets, n_unique)
+    cum_counts = np.concatenate([[0], np.cumsum(counts)])
+    cum_frames = np.concatenate([[0], np.cumsum(counts*unique_lengths)])
+
+    # Padding of a bucket containing distinct lengths i to j - 1
+    i, j = np.meshgrid(
+        np.arange(n_unique + 1), np.arange(n_unique + 1), indexing="ij"
+        )
+    cost = (
+        (cum_counts[j] - cum_counts[i])*unique_lengths[np.maximum(j - 1, 0)]
+        - (cum_frames[j] - cum_frames[i])
+        ).astype(np.float64)
+    cost[i >= j] = np.inf
+
+    # Minimum padding of the first j distinct lengths in k + 1 buckets
+    min_cost = cost[0]
+    best_starts = []
+    for k in range(1, n_buckets):
+        total_cost = min_cost[:, None] + cost
+        best_start = np.argmin(total_cost, axis=0)
+        min_cost = total_cost[best_start, np.arange(n_unique + 1)]
+        best_starts.append(best_start)
+
+    # Trace back the bucket ends
+    ends = [n_unique]
+    for best_start in best_starts[::-1]:
+        ends.append(best_start[ends[-1]])
+    return unique_lengths[np.array(ends[::-1]) - 1]
+
+
+def get_budget_batches(lengths, boundaries, max_frames, frames_per_item=1):
+    """
+    Return a shuffled list of batches with at most `max_frames` padded frames.
+
+    Item `i` is placed in the first bucket with a boundary of at least
+    `lengths[i]`. Each bucket is shuffled and split into batches of as many
+    items as fit into `max_frames` when padded to the bucket boundary, with
+    every item taking `frames_per_item` padded sequences (e.g. two for pairs).
+    The order of the batches is shuffled over all the buckets.
+    """
+    bucket_ids = np.searchsorted(boundaries, lengths)
+    batches = []
+    for i_bucket, boundary in enumerate(boundaries):
+        bucket = np.flatnonzero(bucket_ids == i_bucket)
+        if len(bucket) == 0:
+            continue
+        np.random.shuffle(bucket)
+        batch_size = max(1, int(max_frames // (frames_per_item*boundary)))
+        batches.extend(
+            np.split(bucket, np.arange(batch_size, len(bucket), batch_size))
+            )
+    return [batches[i] for i in np.random.permutation(len(batches))]
+
+
+def get_padding_efficiency(batch_lengths):
+    """
+    Return the fraction of real frames over all the padded batches.
+
+    Each item in `batch_lengths` gives the sequence lengths of a batch, which
+    are all padded to the maximum length in that batch.
+    """
+    n_real = 0
+    n_padded = 0
+    for cur_lengths in batch_lengths:
+        n_real += np.sum(cur_lengths)
+        n_padded += np.size(cur_lengths)*np.max(cur_lengths)
+    return float(n_real)/n_padded
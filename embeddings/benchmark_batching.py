@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Time epochs of the bucketing iterators with and without pre-padded buckets.
+
+If `--frame_dtype` is given, the frames are first compressed (see
+`batching.compress_sequences`), and the memory saved, the error in the
+decoded frames and the change in same-different average precision (AP) of a
+downsampled representation (as in ../downsample/) are also reported.
+
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from os import path
+from scipy.spatial.distance import pdist
+import argparse
+import numpy as np
+import scipy.signal as signal
+import sys
+import timeit
+
+sys.path.append(path.join("..", "src"))
+
+import batching
+import data_io
+import samediff
+
+
+#-----------------------------------------------------------------------------#
+#                              UTILITY FUNCTIONS                              #
+#-----------------------------------------------------------------------------#
+
+def check_argv():
+    """Check the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0], add_help=False
+        )
+    parser.add_argument(
+        "npz_fn", type=str, help="NumPy archive or packed archive of segments"
+        )
+    parser.add_argument(
+        "--batch_size", type=int, help="size of mini-batch (default: "
+        "%(default)s)", default=300
+        )
+    parser.add_argument(
+        "--n_buckets", type=int, help="number of buckets (default: "
+        "%(default)s)", default=3
+        )
+    parser.add_argument(
+        "--n_epochs", type=int, help="number of timed epochs (default: "
+        "%(default)s)", default=5
+        )
+    parser.add_argument(
+        "--frame_dtype", type=str, choices=["float16", "int8"],
+        help="compress the frames held in memory (default: %(default)s)"
+        )
+    parser.add_argument(
+        "--n_ap_items", type=int, help="number of items used to compare "
+        "the AP of downsampled compressed and uncompressed frames (default: "
+        "%(default)s)", default=2000
+        )
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    return parser.parse_args()
+
+
+def time_epochs(batch_iterator, n_epochs):
+    """Return the average time in seconds of an epoch over the iterator."""
+    start_time = timeit.default_timer()
+    for i_epoch in range(n_epochs):
+        for batch in batch_iterator:
+            pass
+    return (timeit.default_timer() - start_time)/n_epochs
+
+
+def downsample_ap(x_list, labels, n=10):
+    """Return the AP of the sequences in `x_list` resampled to `n` frames."""
+    X = np.array([signal.resample(seq, n, axis=0).flatten() for seq in x_list])
+    distances = pdist(X, metric="cosine")
+    matches = samediff.generate_matches_array(labels)
+    ap, _ = samediff.average_precision(
+        distances[matches == True], distances[matches == False]
+        )
+    return ap
+
+
+#-----------------------------------------------------------------------------#
+#                                MAIN FUNCTION                                #
+#-----------------------------------------------------------------------------#
+
+def main():
+    args = check_argv()
+
+    x, labels, lengths, keys, speakers = data_io.load_data_from_npz(
+        args.npz_fn
+        )
+    data_io.trunc_and_limit_dim(x, lengths, 13, 100)
+    if args.frame_dtype is not None:
+        frames = np.concatenate(x)
+        x_original = x
+        x = batching.compress_sequences(x, args.frame_dtype)
+        decoded = x.frames.astype(frames.dtype)
+        if x.scale is not None:
+            decoded = decoded*x.scale + x.offset
+        print(
+            "Compressed frame memory: {:.1f} MB (from {:.1f} MB)".format(
+            x.frames.nbytes/1024.**2, frames.nbytes/1024.**2
+            ))
+        print("Relative RMS error in decoded frames: {:.2e}".format(
+            np.sqrt(np.mean((decoded - frames)**2)/np.mean(frames**2))
+            ))
+        n_ap_items = min(args.n_ap_items, len(x))
+        ap = downsample_ap(x_original[:n_ap_items], labels[:n_ap_items])
+        compressed_ap = downsample_ap(
+            [decoded[start:start + length] for start, length in
+            zip(x.starts[:n_ap_items], x.lengths[:n_ap_items])],
+            labels[:n_ap_items]
+            )
+        print(
+            "Downsampled AP on {} items: {:.4f} (from {:.4f})".format(
+            n_ap_items, compressed_ap, ap
+            ))
+    pair_list = batching.get_pair_list(labels)
+    print("No. pairs:", int(len(pair_list)/2.0))
+
+    iterators = [
+        ("SimpleBucketIterator", lambda prepad: batching.SimpleBucketIterator(
+            x, args.batch_size, args.n_buckets, shuffle_every_epoch=True,
+            prepad=prepad
+            )),
+        ("PairedBucketIterator (AE)", lambda prepad:
+            batching.PairedBucketIterator(
+            x, [(i, i) for i in range(len(x))], args.batch_size,
+            args.n_buckets, shuffle_every_epoch=True, prepad=prepad
+            )),
+        ("PairedBucketIterator (CAE)", lambda prepad:
+            batching.PairedBucketIterator(
+            x, pair_list, args.batch_size, args.n_buckets,
+            shuffle_every_epoch=True, prepad=prepad
+            )),
+        ]
+    for name, get_iterator in iterators:
+        print(name + ":")
+        batch_iterator = get_iterator(False)
+        epoch_time = time_epochs(batch_iterator, args.n_epochs)
+        print("Epoch time: {:.4f} sec".format(epoch_time))
+        batch_iterator = get_iterator(True)
+        prepad_epoch_time = time_epochs(batch_iterator, args.n_epochs)
+        print(
+            "Epoch time with pre-padded buckets: {:.4f} sec ({:.2f}x "
+            "faster)".format(prepad_epoch_time, epoch_time/prepad_epoch_time)
+            )
+        print(
+            "Pre-padded bucket memory: {:.1f} MB ({:.2f}x the frames)".format(
+            batch_iterator.padded_buckets.nbytes/1024.**2,
+            float(batch_iterator.padded_buckets.nbytes) /
+            batch_iterator.x_packed.frames.nbytes
+            ))
+
+
+if __name__ == "__main__":
+    main()
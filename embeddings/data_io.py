@@ -7,74 +7,273 @@ Date: 2018, 2019
 """
 
 from os import path
+import hashlib
 import numpy as np
+import os
+import shutil
 import sys
 
 sys.path.append(path.join("..", "src"))
 
 from tflego import NP_DTYPE
+import batching
+import packed
 
+DERIVED_FN = "derived.npz"
+PAIR_LIST_FN = "pair_list.npy"
 
 
-def load_data_from_npz(npz_fn, min_length=None):
+def load_index(npz_fn, use_cache=True):
+    """
+    Return the index of a NumPy archive or a packed archive of segments.
+
+    The index is a dictionary with the sorted "keys" and the "labels",
+    "speakers", "lengths" and "dims" of the segments, which is obtained
+    without reading any frames and is cached as a sidecar for NumPy archives
+    (see `packed.read_index`). It can be used to plan work, e.g. filtering on
+    length, bucketing or pairing, before loading the data.
+    """
+    index = packed.read_index(npz_fn, use_cache=use_cache)
+    index["labels"] = np.array(
+        [utt_key.split("_")[0] for utt_key in index["keys"]]
+        )
+    index["speakers"] = np.array(
+        [utt_key.split("_")[1][:3] for utt_key in index["keys"]]
+        )
+    return index
+
+
+def load_data_from_npz(npz_fn, min_length=None, as_packed=False,
+        n_threads=None):
+    """
+    Load the data from a NumPy archive or a packed archive.
+
+    Items are filtered on `min_length` using the index (see `load_index`), so
+    frames are only read for the items that are kept. For a NumPy archive,
+    each of these is decompressed once, using `n_threads` threads (see
+    `packed.read_npz_arrays`).
+
+    For a packed archive (see `packed.py`), the returned sequences are views
+    into the memory-mapped frames, so no data is read until it is used. If
+    `as_packed` is True, the sequences of a packed archive are returned as a
+    `batching.PackedSequences` over the memory-mapped frames instead of as a
+    list, so that the batching iterators use the frames without copying them
+    into memory.
+    """
     print("Reading:", npz_fn)
-    npz = np.load(npz_fn)
-    x = []
-    labels = []
-    speakers = []
-    lengths = []
-    keys = []
-    n_items = 0
-    for utt_key in sorted(npz):
-        if min_length is not None and len(npz[utt_key]) <= min_length:
-            continue
-        keys.append(utt_key)
-        x.append(npz[utt_key])
-        word = utt_key.split("_")[0]
-        speaker = utt_key.split("_")[1][:3]
-        labels.append(word)
-        speakers.append(speaker)
-        lengths.append(npz[utt_key].shape[0])
-        n_items += 1
+    index = load_index(npz_fn)
+    use_items = np.arange(len(index["keys"]))
+    if min_length is not None:
+        use_items = np.flatnonzero(index["lengths"] > min_length)
+    keys = index["keys"][use_items].tolist()
+    labels = index["labels"][use_items].tolist()
+    speakers = index["speakers"][use_items].tolist()
+    lengths = index["lengths"][use_items].tolist()
+    if packed.is_packed(npz_fn):
+        npz = packed.PackedArchive(npz_fn)
+        if as_packed:
+            x = batching.PackedSequences(
+                npz.frames, npz.offsets[use_items], npz.lengths[use_items]
+                )
+        else:
+            x = [npz.get_index(i) for i in use_items]
+    else:
+        _, x = packed.read_npz_arrays(npz_fn, keys, n_threads=n_threads)
+    n_items = len(keys)
     print("No. items:", n_items)
-    print("E.g. item shape:", x[0].shape)
+    if n_items > 0:
+        print("E.g. item shape:", x[0].shape)
     return (x, labels, lengths, keys, speakers)
 
 
-def trunc_and_limit_dim(x, lengths, d_frame, max_length):
+def trunc_and_limit_dim(x, lengths, d_frame, max_length, compact=True):
+    """
+    Truncate the sequences in `x` to `max_length` frames and `d_frame` dims.
+
+    For a list, if `compact` is True, the kept frames are copied into a
+    single contiguous matrix and each item is replaced by a view into it, so
+    that the original sequences can be freed; the batching iterators then
+    use this matrix without copying it (see `batching.pack_sequences`).
+    Otherwise the items are replaced by views into the original sequences.
+    A `batching.PackedSequences` container is always truncated through its
+    views, so memory-mapped frames are not read.
+    """
+    if isinstance(x, batching.PackedSequences):
+        # Only the views are changed, the frames are not copied
+        x.frames = x.frames[:, :d_frame]
+        if x.scale is not None:
+            x.scale = x.scale[:d_frame]
+            x.offset = x.offset[:d_frame]
+        if max_length is not None:
+            x.lengths = np.minimum(x.lengths, max_length)
+        lengths[:] = x.lengths.tolist()
+        return
+    if compact and len(x) > 0:
+        kept_lengths = [seq[:max_length].shape[0] for seq in x]
+        frames = np.empty(
+            (sum(kept_lengths), x[0][:, :d_frame].shape[1]), dtype=NP_DTYPE
+            )
+        start = 0
+        for i, length in enumerate(kept_lengths):
+            frames[start:start + length] = x[i][:length, :d_frame]
+            x[i] = frames[start:start + length]
+            lengths[i] = min(lengths[i], length)
+            start += length
+        return
     for i, seq in enumerate(x):
         x[i] = x[i][:max_length, :d_frame]
         lengths[i] = min(lengths[i], max_length)
 
 
-def pad_sequences(x, n_padded, center_padded=True, return_mask=False):
-    """Return the padded sequences and their original lengths."""
-    padded_x = np.zeros((len(x), n_padded, x[0].shape[1]), dtype=NP_DTYPE)
-    if return_mask:
-        mask_x = np.zeros((len(x), n_padded), dtype=NP_DTYPE)
-    lengths = []
-    for i_data, cur_x in enumerate(x):
-        length = cur_x.shape[0]
-        if center_padded:
-            padding = int(np.round((n_padded - length) / 2.))
-            if length <= n_padded:
-                padded_x[i_data, padding:padding + length, :] = cur_x
-                if return_mask:
-                    mask_x[i_data, padding:padding + length] = 1
+def get_source_hash(npz_fn):
+    """
+    Return a hash identifying the current version of an archive.
+
+    The hash is computed from the resolved path, size and modification time
+    of the archive files (as for the caches in `packed.read_index`), so
+    large archives are not read to compute it.
+    """
+    if packed.is_packed(npz_fn):
+        fns = [
+            path.join(npz_fn, packed.INDEX_FN),
+            path.join(npz_fn, packed.FRAMES_FN)
+            ]
+    else:
+        fns = [npz_fn]
+    identity = []
+    for fn in fns:
+        fn_stat = os.stat(fn)
+        identity.append(
+            (path.realpath(fn), fn_stat.st_size, fn_stat.st_mtime)
+            )
+    return hashlib.md5(repr(identity).encode("utf-8")).hexdigest()
+
+
+def load_derived_data(npz_fn, d_frame, max_length, min_length=None,
+        as_packed=False, cache_dir=None, return_pairs=False):
+    """
+    Load the data in `npz_fn`, truncated and limited in dimensionality.
+
+    This gives the same output as `load_data_from_npz` followed by
+    `trunc_and_limit_dim`, with the pair list from `batching.get_pair_list`
+    also returned if `return_pairs` is True. If `cache_dir` is given, the
+    derived dataset is cached in a subdirectory keyed on the source archive
+    (see `get_source_hash`), `d_frame`, `max_length` and `min_length`: the
+    truncated frames are stored as a packed archive, together with the label
+    and speaker codes and the pair list. Later calls with the same settings
+    then memory-map the cached frames and never read the source archive.
+    """
+
+    if cache_dir is not None:
+        hasher = hashlib.md5(repr((
+            get_source_hash(npz_fn), d_frame, max_length, min_length
+            )).encode("utf-8"))
+        derived_dir = path.join(cache_dir, "{}.{}".format(
+            path.splitext(path.basename(path.normpath(npz_fn)))[0],
+            hasher.hexdigest()[:10]
+            ))
+
+    if cache_dir is None or not path.isdir(derived_dir):
+        x, labels, lengths, keys, speakers = load_data_from_npz(
+            npz_fn, min_length, as_packed=as_packed
+            )
+        trunc_and_limit_dim(x, lengths, d_frame, max_length)
+        if cache_dir is not None:
+            print("Writing:", derived_dir)
+            tmp_dir = derived_dir + ".tmp{}".format(os.getpid())
+            packed.write_packed(
+                tmp_dir, dict(zip(keys, x)), dtype=NP_DTYPE
+                )
+            label_set, label_ids = np.unique(labels, return_inverse=True)
+            speaker_set, speaker_ids = np.unique(
+                speakers, return_inverse=True
+                )
+            np.savez(
+                path.join(tmp_dir, DERIVED_FN), labels=label_set,
+                label_ids=label_ids, speakers=speaker_set,
+                speaker_ids=speaker_ids
+                )
+            if path.isdir(derived_dir):
+                # Written by another process in the meantime
+                shutil.rmtree(tmp_dir)
             else:
-                # Cut out snippet from sequence exceeding n_padded
-                padded_x[i_data, :, :] = cur_x[-padding:-padding + n_padded]
-                if return_mask:
-                    mask_x[i_data, :] = 1
-            lengths.append(min(length, n_padded))
+                os.rename(tmp_dir, derived_dir)
+    else:
+        print("Reading:", derived_dir)
+        archive = packed.PackedArchive(derived_dir)
+        keys = archive.keys()
+        if as_packed:
+            x = batching.PackedSequences(
+                archive.frames, archive.offsets[:-1], archive.lengths
+                )
         else:
-            length = min(length, n_padded)
-            padded_x[i_data, :length, :] = cur_x[:length, :]
-            if return_mask:
-                mask_x[i_data, :length] = 1
-            lengths.append(length)
-    if return_mask:
-        return padded_x, lengths, mask_x
+            x = [archive.get_index(i) for i in range(len(archive))]
+        lengths = archive.lengths.tolist()
+        derived = np.load(path.join(derived_dir, DERIVED_FN))
+        labels = derived["labels"][derived["label_ids"]].tolist()
+        speakers = derived["speakers"][derived["speaker_ids"]].tolist()
+        print("No. items:", len(keys))
+        print("E.g. item shape:", x[0].shape)
+
+    if not return_pairs:
+        return (x, labels, lengths, keys, speakers)
+    pair_list_fn = (
+        None if cache_dir is None else path.join(derived_dir, PAIR_LIST_FN)
+        )
+    if pair_list_fn is not None and path.isfile(pair_list_fn):
+        pair_list = np.load(pair_list_fn, mmap_mode="r")
+    else:
+        pair_list = batching.get_pair_list(labels)
+        if pair_list_fn is not None:
+            tmp_fn = pair_list_fn + ".tmp{}".format(os.getpid())
+            with open(tmp_fn, "wb") as f:
+                np.save(f, pair_list)
+            os.rename(tmp_fn, pair_list_fn)
+    return (x, labels, lengths, keys, speakers, pair_list)
+
+
+def pad_sequences(x, n_padded, center_padded=True, return_mask=False,
+        transpose=False):
+    """
+    Return the padded sequences and their original lengths.
+
+    Sequences are zero-padded or cut to `n_padded` frames, centred if
+    `center_padded` is True. The padded sequences are returned as a
+    [n_data, n_padded, d_frame] array or, if `transpose` is True, written
+    directly as a [n_data, d_frame, n_padded] array, which can be flattened
+    for the CNN inputs without copying it. The returned lengths are those
+    after cutting, and the mask, if requested, marks the frames taken from
+    the sequences.
+    """
+    lengths = np.array([seq.shape[0] for seq in x], dtype=np.int64)
+    kept_lengths = np.minimum(lengths, n_padded)
+    if center_padded:
+        padding = np.round((n_padded - lengths) / 2.).astype(np.int64)
     else:
-        return padded_x, lengths
+        padding = np.zeros(len(x), dtype=np.int64)
+    dest_starts = np.maximum(padding, 0)
+    src_starts = np.maximum(-padding, 0)
 
+    d_frame = x[0].shape[1]
+    if transpose:
+        padded_x = np.zeros((len(x), d_frame, n_padded), dtype=NP_DTYPE)
+    else:
+        padded_x = np.zeros((len(x), n_padded, d_frame), dtype=NP_DTYPE)
+    for i_data, (dest_start, src_start, length) in enumerate(zip(
+            dest_starts.tolist(), src_starts.tolist(),
+            kept_lengths.tolist())):
+        cur_x = x[i_data][src_start:src_start + length]
+        if transpose:
+            padded_x[i_data, :, dest_start:dest_start + length] = cur_x.T
+        else:
+            padded_x[i_data, dest_start:dest_start + length, :] = cur_x
+
+    if return_mask:
+        frame_indices = np.arange(n_padded)
+        mask_x = (
+            (frame_indices >= dest_starts[:, None]) &
+            (frame_indices < (dest_starts + kept_lengths)[:, None])
+            ).astype(NP_DTYPE)
+        return padded_x, kept_lengths.tolist(), mask_x
+    else:
+        return padded_x, kept_lengths.tolist()
@@ -0,0 +1,297 @@
+"""
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from os import path
+import numpy as np
+import numpy.testing as npt
+import shutil
+import tempfile
+
+import batching
+import packed
+
+
+#-----------------------------------------------------------------------------#
+#                                TEST FUNCTIONS                               #
+#-----------------------------------------------------------------------------#
+
+def test_packed_sequences_pad():
+
+    np.random.seed(1)
+    x_list = [np.random.randn(np.random.randint(1, 20), 5) for i in range(10)]
+    x_packed = batching.pack_sequences(x_list)
+    indices = [3, 0, 7, 7]
+    lengths = [x_list[i].shape[0] for i in indices]
+
+    buffers = batching.BatchBuffers(1)
+    out = buffers.get((4, max(lengths), 5))
+    out[:] = np.nan
+    batch_padded = x_packed.pad(indices, out=out)
+
+    assert batch_padded.shape == (4, max(lengths), 5)
+    for i, i_seq in enumerate(indices):
+        npt.assert_allclose(
+            batch_padded[i, :lengths[i]], x_list[i_seq], rtol=1e-6
+            )
+        assert np.all(batch_padded[i, lengths[i]:] == 0)
+    x_sub = x_packed.subsequences(
+        np.zeros(10, dtype=int), np.ones(10, dtype=int)
+        )
+    npt.assert_allclose(
+        x_sub.pad([2, 5])[:, 0], [x_list[2][0], x_list[5][0]], rtol=1e-6
+        )
+
+
+def test_prefetch_iterator():
+
+    np.random.seed(2)
+    x_list = [np.random.randn(np.random.randint(1, 20), 5) for i in range(50)]
+
+    np.random.seed(3)
+    iterator = batching.SimpleBucketIterator(
+        x_list, 8, 3, shuffle_every_epoch=True
+        )
+    batches = [batch for i_epoch in range(2) for batch in iterator]
+
+    np.random.seed(3)
+    iterator = batching.PrefetchIterator(
+        batching.SimpleBucketIterator(
+        x_list, 8, 3, shuffle_every_epoch=True, n_buffers=4
+        ), n_prefetch=2
+        )
+    for i_epoch in range(2):
+        for i_batch, (batch_x_padded, batch_x_lengths) in enumerate(iterator):
+            npt.assert_array_equal(
+                batch_x_padded, batches[i_epoch*iterator.n_batches +
+                i_batch][0]
+                )
+
+
+def test_get_pair_list():
+
+    labels = ["cat", "dog", "cat", "cow", "cat", "dog"]
+
+    pairs = batching.get_pair_list(labels, both_directions=False)
+    npt.assert_array_equal(pairs, [[0, 2], [0, 4], [1, 5], [2, 4]])
+    assert pairs.dtype == np.int32
+
+    pairs = batching.get_pair_list(labels)
+    npt.assert_array_equal(pairs[:4], [[0, 2], [2, 0], [0, 4], [4, 0]])
+    assert len(pairs) == 8
+
+
+def test_budget_batches():
+
+    np.random.seed(4)
+    lengths = np.array([3, 3, 4, 10, 10, 11, 30, 30])
+    boundaries = batching.get_bucket_boundaries(lengths, 3)
+    npt.assert_array_equal(boundaries, [4, 11, 30])
+
+    x_list = [np.random.randn(i, 2) for i in lengths]
+    batch_iterator = batching.SimpleBucketIterator(
+        x_list, 2, 3, shuffle_every_epoch=True, max_frames=40
+        )
+    batch_lengths = []
+    for batch_x_padded, batch_x_lengths in batch_iterator:
+        assert batch_x_padded.shape[0]*batch_x_padded.shape[1] <= 40
+        batch_lengths.extend(batch_x_lengths)
+    npt.assert_array_equal(sorted(batch_lengths), lengths)
+    assert batch_iterator.n_batches == 4
+    assert batch_iterator.padding_efficiency() > 0.9
+
+
+def test_sampled_pairs():
+
+    np.random.seed(5)
+    labels = ["a"]*6 + ["b"]*2 + ["c"]
+    np.random.shuffle(labels)
+    x_list = [np.random.randn(np.random.randint(1, 10), 2) for i in labels]
+    batch_iterator = batching.SampledPairIterator(
+        x_list, labels, 10, 2, n_pairs=1000, max_pairs_per_type=2,
+        shuffle_every_epoch=True
+        )
+    pair_list = batch_iterator.pair_list
+    assert pair_list.shape == (1000, 2)
+    all_pairs = set(map(tuple, batching.get_pair_list(labels).tolist()))
+    assert set(map(tuple, pair_list.tolist())) <= all_pairs
+    n_b = np.sum(np.array(labels)[pair_list[:, 0]] == "b")
+    assert 400 < n_b < 600  # capped to the same weight as "a"
+    assert len(list(batch_iterator)) == 100
+
+
+def test_class_balanced_batches():
+
+    np.random.seed(6)
+    y = np.array([0]*10 + [1]*6 + [2]*4 + [3]*1)
+    x_list = [np.random.randn(np.random.randint(1, 10), 2) for i in y]
+    batch_iterator = batching.ClassBalancedBucketIterator(
+        x_list, y, 2, 3, 1, shuffle_every_epoch=True
+        )
+    assert batch_iterator.n_batches == 3  # class 3 cannot be sampled
+    for batch_x_padded, batch_x_lengths, batch_y in batch_iterator:
+        assert batch_x_padded.shape[0] == 6
+        classes, counts = np.unique(batch_y, return_counts=True)
+        assert len(classes) == 2
+        npt.assert_array_equal(counts, [3, 3])
+
+
+def test_class_balanced_sampler_across_buckets():
+
+    np.random.seed(13)
+    y = np.array([0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6])
+    lengths = np.array([1, 9, 2, 8, 3, 7, 1, 2, 8, 9, 2, 3, 9, 8])
+    sampler = batching.ClassBalancedSampler(y, 2, 2, lengths, n_buckets=2)
+    assert len(sampler.buckets) == 3  # classes 0 to 2 span both buckets
+    assert sampler.n_items == 14
+    for batch in sampler.sample_batches(50):
+        classes, counts = np.unique(y[batch], return_counts=True)
+        npt.assert_array_equal(counts, [2, 2])
+    covered = np.unique(np.concatenate(sampler.sample_batches(200)))
+    npt.assert_array_equal(covered, np.arange(14))
+
+
+def test_iterator_state():
+
+    np.random.seed(7)
+    x_list = [np.random.randn(np.random.randint(1, 20), 2) for i in range(50)]
+    batch_iterator = batching.SimpleBucketIterator(
+        x_list, 8, 3, shuffle_every_epoch=True
+        )
+    state = batch_iterator.get_state()
+    epochs = [[b[1].copy() for b in batch_iterator] for i in range(2)]
+
+    batch_iterator.set_state(state)
+    for batches in epochs:
+        for batch_x_lengths, (_, restored_x_lengths) in zip(
+                batches, batch_iterator):
+            npt.assert_array_equal(batch_x_lengths, restored_x_lengths)
+
+
+def test_prepadded_buckets():
+
+    np.random.seed(8)
+    x_list = [np.random.randn(np.random.randint(1, 20), 2) for i in range(50)]
+    pair_list = [(i, (i + 1) % 50) for i in range(50)]
+    for prepad in [False, True]:
+        np.random.seed(9)
+        batch_iterator = batching.PairedBucketIterator(
+            x_list, pair_list, 8, 3, shuffle_every_epoch=True, prepad=prepad
+            )
+        batches = [[b.copy() for b in batch] for batch in batch_iterator]
+        if not prepad:
+            expected_batches = batches
+    for batch, expected_batch in zip(batches, expected_batches):
+        for b, expected_b in zip(batch, expected_batch):
+            npt.assert_array_equal(b, expected_b)
+
+
+def test_pack_sequences_views():
+
+    np.random.seed(10)
+    frames = np.random.randn(20, 3).astype(batching.NP_DTYPE)
+    x_list = [frames[5:9], frames[0:5], frames[9:20]]
+    x_packed = batching.pack_sequences(x_list)
+    assert x_packed.frames is frames
+    npt.assert_array_equal(x_packed.starts, [5, 0, 9])
+    for seq, packed_seq in zip(x_list, x_packed):
+        npt.assert_array_equal(seq, packed_seq)
+
+    x_list = [frames[5:9, :2], frames[0:5, :2]]
+    x_packed = batching.pack_sequences(x_list)
+    assert x_packed.frames is not frames
+    for seq, packed_seq in zip(x_list, x_packed):
+        npt.assert_array_equal(seq, packed_seq)
+
+
+def test_compress_sequences():
+
+    np.random.seed(11)
+    x_list = [
+        (np.random.randn(np.random.randint(1, 20), 3)*[1., 10., 100.]).astype(
+        batching.NP_DTYPE
+        ) for i in range(20)
+        ]
+    x_packed = batching.pack_sequences(x_list)
+    indices = np.arange(20)
+    for dtype, rtol in [("float16", 1e-3), ("int8", 1e-2)]:
+        x_compressed = batching.compress_sequences(x_list, dtype)
+        assert x_compressed.frames.dtype == dtype
+        padded = x_compressed.pad(indices)
+        assert padded.dtype == batching.NP_DTYPE
+        for i, length in enumerate(x_packed.lengths):
+            assert np.all(padded[i, length:] == 0)
+        expected = x_packed.pad(indices)
+        tolerance = rtol*np.max(np.abs(expected), axis=(0, 1))
+        assert np.all(np.abs(padded - expected) <= tolerance)
+
+
+def test_compress_sequences_kept_frames():
+
+    np.random.seed(12)
+    frames = np.random.randn(100, 3).astype(batching.NP_DTYPE)
+    x_packed = batching.PackedSequences(
+        frames, np.array([60, 5, 30]), np.array([10, 20, 0])
+        )
+    indices = np.arange(3)
+    for dtype in ["float16", "int8"]:
+        x_compressed = batching.compress_sequences(x_packed, dtype)
+        assert x_compressed.frames.shape == (30, 3)
+        npt.assert_array_equal(x_compressed.starts, [0, 10, 30])
+        npt.assert_allclose(
+            x_compressed.pad(indices), x_packed.pad(indices), atol=2e-2
+            )
+
+
+def test_random_segments():
+
+    np.random.seed(14)
+    x_list = [
+        np.random.randn(np.random.randint(6, 40), 3).astype(batching.NP_DTYPE)
+        for i in range(30)
+        ]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        packed_dir = path.join(tmp_dir, "test.packed")
+        packed.write_packed(
+            packed_dir, dict([("{:02d}".format(i), seq) for i, seq in
+            enumerate(x_list)])
+            )
+        archive = packed.PackedArchive(packed_dir)
+        x_memmap = batching.PackedSequences(
+            archive.frames, archive.offsets[:-1], archive.lengths
+            )
+        assert isinstance(x_memmap.frames, np.memmap)
+        for x in [x_list, x_memmap]:
+            batch_iterator = batching.RandomSegmentsIterator(
+                x, 4, 2, min_dur=5, max_dur=20, shuffle_every_epoch=True
+                )
+            for i_epoch in range(3):
+                batches = [
+                    (batch_x_padded.copy(), batch_x_lengths) for
+                    batch_x_padded, batch_x_lengths in batch_iterator
+                    ]
+                x_full_packed = batch_iterator.x_full_packed
+                x_packed = batch_iterator.x_packed
+                offsets = x_packed.starts - x_full_packed.starts
+                durs = x_packed.lengths
+                assert np.all((durs >= 5) & (durs < 20))
+                assert np.all(offsets >= 0)
+                assert np.all(offsets + durs <= x_full_packed.lengths)
+                for (batch_x_padded, batch_x_lengths), batch_indices in zip(
+                        batches, batch_iterator.get_batches()):
+                    npt.assert_array_equal(
+                        batch_x_lengths, durs[batch_indices]
+                        )
+                    for i, i_seq in enumerate(batch_indices):
+                        npt.assert_array_equal(
+                            batch_x_padded[i, :durs[i_seq]],
+                            x_list[i_seq][
+                            offsets[i_seq]:offsets[i_seq] + durs[i_seq]
+                            ]
+                            )
+                        assert np.all(batch_x_padded[i, durs[i_seq]:] == 0)
+    finally:
+        shutil.rmtree(tmp_dir)
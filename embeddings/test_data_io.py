@@ -0,0 +1,147 @@
+"""
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from os import path
+import numpy as np
+import numpy.testing as npt
+import os
+import shutil
+import tempfile
+
+import batching
+import data_io
+
+
+#-----------------------------------------------------------------------------#
+#                                TEST FUNCTIONS                               #
+#-----------------------------------------------------------------------------#
+
+def write_segments_npz(npz_fn, n_items=40, d_frame=20):
+    feat_dict = {}
+    for i in range(n_items):
+        label = ["because", "about", "people", "years"][i % 4]
+        speaker = "s{:02d}".format(1 + i % 3)
+        key = "{}_{}_01a_{:06d}-{:06d}".format(label, speaker, i, i + 1)
+        feat_dict[key] = np.random.randn(np.random.randint(2, 40), d_frame)
+    np.savez_compressed(npz_fn, **feat_dict)
+
+
+def assert_same_data(data, expected):
+    x, labels, lengths, keys, speakers, pair_list = data
+    assert len(x) == len(expected[0])
+    for seq, expected_seq in zip(x, expected[0]):
+        npt.assert_array_equal(seq, expected_seq)
+    assert list(labels) == expected[1]
+    assert list(lengths) == expected[2]
+    assert list(keys) == expected[3]
+    assert list(speakers) == expected[4]
+    npt.assert_array_equal(pair_list, expected[5])
+
+
+def pad_sequences_loop(x, n_padded, center_padded=True):
+    """Pad the sequences in `x` one at a time, as a reference."""
+    padded_x = np.zeros((len(x), n_padded, x[0].shape[1]))
+    mask_x = np.zeros((len(x), n_padded))
+    for i_data, cur_x in enumerate(x):
+        length = cur_x.shape[0]
+        if center_padded:
+            padding = int(np.round((n_padded - length) / 2.))
+            if length <= n_padded:
+                padded_x[i_data, padding:padding + length, :] = cur_x
+                mask_x[i_data, padding:padding + length] = 1
+            else:
+                padded_x[i_data, :, :] = cur_x[-padding:-padding + n_padded]
+                mask_x[i_data, :] = 1
+        else:
+            padded_x[i_data, :length, :] = cur_x[:n_padded, :]
+            mask_x[i_data, :length] = 1
+    return padded_x, mask_x
+
+
+def test_pad_sequences():
+
+    np.random.seed(2)
+    for i_case in range(300):
+        n_padded = np.random.randint(1, 30)
+        x = [
+            np.random.randn(np.random.randint(1, 50), 3).astype(
+            batching.NP_DTYPE
+            ) for i in range(np.random.randint(1, 10))
+            ]
+        for center_padded in [True, False]:
+            expected_x, expected_mask = pad_sequences_loop(
+                x, n_padded, center_padded
+                )
+            padded_x, lengths, mask_x = data_io.pad_sequences(
+                x, n_padded, center_padded, return_mask=True
+                )
+            assert padded_x.dtype == batching.NP_DTYPE
+            npt.assert_array_equal(padded_x, expected_x)
+            npt.assert_array_equal(mask_x, expected_mask)
+            assert lengths == [min(seq.shape[0], n_padded) for seq in x]
+            padded_x, _ = data_io.pad_sequences(
+                x, n_padded, center_padded, transpose=True
+                )
+            npt.assert_array_equal(padded_x, expected_x.transpose(0, 2, 1))
+
+
+def test_pad_sequences_odd_cuts():
+
+    # The padding is rounded half to even, e.g. -1.5 and -2.5 both give -2
+    x = [np.arange(length)[:, None]*1. for length in [5, 7, 11, 13, 15]]
+    padded_x, lengths = data_io.pad_sequences(x, 10)
+    assert lengths == [5, 7, 10, 10, 10]
+    npt.assert_array_equal(padded_x[0, 2:7, 0], np.arange(5))
+    npt.assert_array_equal(padded_x[1, 2:9, 0], np.arange(7))
+    npt.assert_array_equal(padded_x[2, :, 0], np.arange(10))
+    npt.assert_array_equal(padded_x[3, :, 0], np.arange(2, 12))
+    npt.assert_array_equal(padded_x[4, :, 0], np.arange(2, 12))
+
+
+def test_load_derived_data_cache():
+
+    np.random.seed(1)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        npz_fn = path.join(tmp_dir, "train.npz")
+        cache_dir = path.join(tmp_dir, "cache")
+        write_segments_npz(npz_fn)
+
+        def get_expected():
+            x, labels, lengths, keys, speakers = data_io.load_data_from_npz(
+                npz_fn, min_length=5
+                )
+            data_io.trunc_and_limit_dim(x, lengths, 13, 30)
+            pair_list = batching.get_pair_list(labels)
+            return (x, labels, lengths, keys, speakers, pair_list)
+
+        # Uncached, cold cache, warm cache and warm cache as packed sequences
+        expected = get_expected()
+        for cache, as_packed in [
+                (None, False), (cache_dir, False), (cache_dir, False),
+                (cache_dir, True)]:
+            data = data_io.load_derived_data(
+                npz_fn, 13, 30, min_length=5, as_packed=as_packed,
+                cache_dir=cache, return_pairs=True
+                )
+            if as_packed:
+                assert isinstance(data[0], batching.PackedSequences)
+            assert_same_data(data, expected)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # Changing the source archive invalidates the cache
+        npz_stat = os.stat(npz_fn)
+        write_segments_npz(npz_fn)
+        os.utime(npz_fn, (npz_stat.st_atime, npz_stat.st_mtime + 10))
+        expected = get_expected()
+        data = data_io.load_derived_data(
+            npz_fn, 13, 30, min_length=5, cache_dir=cache_dir,
+            return_pairs=True
+            )
+        assert_same_data(data, expected)
+        assert len(os.listdir(cache_dir)) == 2
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -35,6 +35,12 @@ import training
 
 default_options_dict = {
     "data_dir": path.join("data", "buckeye.mfcc"),
+    "data_cache_dir": path.join("data", "cache"),
+                                        # truncated datasets are cached here
+                                        # (None to disable caching)
+    "frame_dtype": None,                # if "float16" or "int8", frames are
+                                        # held in memory in this compressed
+                                        # form and decoded per batch
     "train_tag": "utd",                 # "gt", "gt2", "utd", "rnd",
                                         # "besgmm", "besgmm7"
     "pretrain_tag": None,               # if not provided, same tag as
@@ -52,11 +58,28 @@ default_options_dict = {
     "ae_n_epochs": 100,                 # AE pretraining options
     "ae_batch_size": 300,
     "ae_n_buckets": 3,
+    "ae_max_frames": None,              # if given, batches are formed up to
+                                        # this many padded frames with
+                                        # buckets chosen to minimise padding,
+                                        # instead of using ae_batch_size
     "pretrain_usefinal": False,         # if True, do not use best validation
                                         # AE model, but rather use final model
     "cae_n_epochs": 10,                 # CAE training options
     "cae_batch_size": 300,
     "cae_n_buckets": 3,
+    "cae_max_frames": None,             # as for ae_max_frames
+    "cae_sample_pairs": False,          # if True, draw same-type pairs for
+                                        # every epoch instead of using all
+                                        # pairs
+    "cae_n_pairs": None,                # pairs drawn per epoch (default: the
+                                        # no. of training tokens)
+    "cae_max_pairs_per_type": None,     # if given, caps the weight of a type
+                                        # when drawing pairs
+    "n_prefetch": 2,                    # batches built in background
+    "prepad": False,                    # if True, keep zero-padded copies of
+                                        # the training buckets so that
+                                        # batches are gathered rather than
+                                        # padded (uses more memory)
     "extrinsic_usefinal": False,        # if True, during final extrinsic
                                         # evaluation, the final saved model
                                         # will be used (instead of the
@@ -67,9 +90,21 @@ default_options_dict = {
     "d_speaker_embedding": None,        # if None, no speaker information is
                                         # used, otherwise this is the embedding
                                         # dimensionality
+    "resumable": False,                 # if True, training is checkpointed
+                                        # after every epoch, and a restarted
+                                        # run resumes where it stopped
+    "n_checkpoint_batches": None,       # if given with resumable, also
+                                        # checkpoint every this many batches
     "rnd_seed": 1,
     }
 
+# Options that only affect how training is run and not the trained model,
+# and are therefore left out of the model directory hash
+runtime_option_keys = [
+    "data_cache_dir", "n_prefetch", "prepad", "resumable",
+    "n_checkpoint_batches"
+    ]
+
 
 #-----------------------------------------------------------------------------#
 #                              TRAINING FUNCTIONS                             #
@@ -136,7 +171,10 @@ def train_cae(options_dict):
     print(datetime.now())
 
     # Output directory
-    hasher = hashlib.md5(repr(sorted(options_dict.items())).encode("ascii"))
+    hasher = hashlib.md5(repr(sorted([
+        (key, value) for key, value in options_dict.items() if key not in
+        runtime_option_keys
+        ])).encode("ascii"))
     # hash_str = (
     #     datetime.now().strftime("%y%m%d.%Hh%M") + "." +
     #     # datetime.now().strftime("%y%m%d.%Hh%Mm%Ss") + "." +
@@ -161,6 +199,13 @@ def train_cae(options_dict):
 
     # LOAD AND FORMAT DATA
 
+    # Truncation and dimensionality
+    max_length = options_dict["max_length"]
+    d_frame = 13  # None
+    options_dict["n_input"] = d_frame
+    print("Limiting dimensionality:", d_frame)
+    print("Limiting length:", max_length)
+
     # Training data
     train_tag = options_dict["train_tag"]
     min_length = None
@@ -170,8 +215,14 @@ def train_cae(options_dict):
     npz_fn = path.join(
         options_dict["data_dir"], "train." + train_tag + ".npz"
         )
+    train_data = data_io.load_derived_data(
+        npz_fn, d_frame, max_length, min_length,
+        as_packed=options_dict["train_tag"] == "rnd",
+        cache_dir=options_dict["data_cache_dir"],
+        return_pairs=not options_dict["cae_sample_pairs"]
+        )
     train_x, train_labels, train_lengths, train_keys, train_speakers = (
-        data_io.load_data_from_npz(npz_fn, min_length)
+        train_data[:5]
         )
 
     # Pretraining data (if specified)
@@ -185,7 +236,11 @@ def train_cae(options_dict):
             options_dict["data_dir"], "train." + pretrain_tag + ".npz"
             )
         (pretrain_x, pretrain_labels, pretrain_lengths, pretrain_keys,
-            pretrain_speakers) = data_io.load_data_from_npz(npz_fn, min_length)
+            pretrain_speakers) = data_io.load_derived_data(
+            npz_fn, d_frame, max_length, min_length,
+            as_packed=options_dict["pretrain_tag"] == "rnd",
+            cache_dir=options_dict["data_cache_dir"]
+            )
 
     # Validation data
     if options_dict["use_test_for_val"]:
@@ -193,8 +248,9 @@ def train_cae(options_dict):
     else:
         npz_fn = path.join(options_dict["data_dir"], "val.npz")
     val_x, val_labels, val_lengths, val_keys, val_speakers = (
-        data_io.load_data_from_npz(npz_fn)
-        )
+        data_io.load_derived_data(
+        npz_fn, d_frame, max_length, cache_dir=options_dict["data_cache_dir"]
+        ))
 
     # Convert training speakers, if speaker embeddings
     if options_dict["d_speaker_embedding"] is not None:
@@ -210,22 +266,25 @@ def train_cae(options_dict):
         train_speaker_ids = np.array(train_speaker_ids, dtype=NP_ITYPE)
         options_dict["n_speakers"] = max(speaker_to_id.values()) + 1
 
-    # Truncate and limit dimensionality
-    max_length = options_dict["max_length"]
-    d_frame = 13  # None
-    options_dict["n_input"] = d_frame
-    print("Limiting dimensionality:", d_frame)
-    print("Limiting length:", max_length)
-    data_io.trunc_and_limit_dim(train_x, train_lengths, d_frame, max_length)
-    if options_dict["pretrain_tag"] is not None:
-        data_io.trunc_and_limit_dim(
-            pretrain_x, pretrain_lengths, d_frame, max_length
+    # Compress frames held in memory
+    if options_dict["frame_dtype"] is not None:
+        print("Compressing frames:", options_dict["frame_dtype"])
+        train_x = batching.compress_sequences(
+            train_x, options_dict["frame_dtype"]
             )
-    data_io.trunc_and_limit_dim(val_x, val_lengths, d_frame, max_length)
+        if options_dict["pretrain_tag"] is not None:
+            pretrain_x = batching.compress_sequences(
+                pretrain_x, options_dict["frame_dtype"]
+                )
+        val_x = batching.compress_sequences(val_x, options_dict["frame_dtype"])
+        print("Training frames: {:.1f} MB".format(
+            train_x.frames.nbytes/1024.**2
+            ))
 
     # Get pairs
-    pair_list = batching.get_pair_list(train_labels)
-    print("No. pairs:", int(len(pair_list)/2.0))  # pairs in both directions
+    if not options_dict["cae_sample_pairs"]:
+        pair_list = train_data[5]
+        print("No. pairs:", int(len(pair_list)/2.0))  # both directions
 
 
     # DEFINE MODEL
@@ -319,7 +378,8 @@ def train_cae(options_dict):
             train_batch_iterator = batching.RandomSegmentsIterator(
                 pretrain_x, options_dict["ae_batch_size"],
                 options_dict["ae_n_buckets"], shuffle_every_epoch=True,
-                paired=True
+                paired=True, n_buffers=options_dict["n_prefetch"] + 2,
+                max_frames=options_dict["ae_max_frames"]
                 )
         else:
             train_batch_iterator = batching.PairedBucketIterator(
@@ -327,14 +387,17 @@ def train_cae(options_dict):
                 options_dict["ae_batch_size"], options_dict["ae_n_buckets"],
                 shuffle_every_epoch=True, speaker_ids=None if
                 options_dict["d_speaker_embedding"] is None else
-                train_speaker_ids
+                train_speaker_ids, n_buffers=options_dict["n_prefetch"] + 2,
+                max_frames=options_dict["ae_max_frames"],
+                prepad=options_dict["prepad"]
                 )
     else:
         if options_dict["train_tag"] == "rnd":
             train_batch_iterator = batching.RandomSegmentsIterator(
                 train_x, options_dict["ae_batch_size"],
                 options_dict["ae_n_buckets"], shuffle_every_epoch=True,
-                paired=True
+                paired=True, n_buffers=options_dict["n_prefetch"] + 2,
+                max_frames=options_dict["ae_max_frames"]
                 )
         else:
             train_batch_iterator = batching.PairedBucketIterator(
@@ -342,15 +405,30 @@ def train_cae(options_dict):
                 options_dict["ae_batch_size"], options_dict["ae_n_buckets"],
                 shuffle_every_epoch=True, speaker_ids=None if
                 options_dict["d_speaker_embedding"] is None else
-                train_speaker_ids
+                train_speaker_ids, n_buffers=options_dict["n_prefetch"] + 2,
+                max_frames=options_dict["ae_max_frames"],
+                prepad=options_dict["prepad"]
                 )
+    print(
+        "Padding efficiency:", train_batch_iterator.padding_efficiency()
+        )
+    if getattr(train_batch_iterator, "padded_buckets", None) is not None:
+        print("Pre-padded buckets: {:.1f} MB".format(
+            train_batch_iterator.padded_buckets.nbytes/1024.**2
+            ))
+    train_batch_iterator = batching.PrefetchIterator(
+        train_batch_iterator, options_dict["n_prefetch"]
+        )
     if options_dict["d_speaker_embedding"] is None:
         ae_record_dict = training.train_fixed_epochs_external_val(
             options_dict["ae_n_epochs"], optimizer, loss, train_batch_iterator,
             [a, a_lengths, b, b_lengths], samediff_val,
             save_model_fn=pretrain_intermediate_model_fn,
             save_best_val_model_fn=pretrain_model_fn,
-            n_val_interval=options_dict["ae_n_val_interval"]
+            n_val_interval=options_dict["ae_n_val_interval"],
+            checkpoint_fn=path.join(model_dir, "ae.checkpoint.ckpt") if
+            options_dict["resumable"] else None,
+            n_checkpoint_batches=options_dict["n_checkpoint_batches"]
             )
     else:
         ae_record_dict = training.train_fixed_epochs_external_val(
@@ -358,7 +436,10 @@ def train_cae(options_dict):
             [a, a_lengths, b, b_lengths, speaker_id], samediff_val,
             save_model_fn=pretrain_intermediate_model_fn,
             save_best_val_model_fn=pretrain_model_fn,
-            n_val_interval=options_dict["ae_n_val_interval"]
+            n_val_interval=options_dict["ae_n_val_interval"],
+            checkpoint_fn=path.join(model_dir, "ae.checkpoint.ckpt") if
+            options_dict["resumable"] else None,
+            n_checkpoint_batches=options_dict["n_checkpoint_batches"]
             )
 
 
@@ -375,11 +456,37 @@ def train_cae(options_dict):
 
         # Train CAE
         val_model_fn = intermediate_model_fn
-        train_batch_iterator = batching.PairedBucketIterator(
-            train_x, pair_list, batch_size=options_dict["cae_batch_size"],
-            n_buckets=options_dict["cae_n_buckets"], shuffle_every_epoch=True,
-            speaker_ids=None if options_dict["d_speaker_embedding"] is None
-            else train_speaker_ids
+        if options_dict["cae_sample_pairs"]:
+            train_batch_iterator = batching.SampledPairIterator(
+                train_x, train_labels, options_dict["cae_batch_size"],
+                options_dict["cae_n_buckets"],
+                n_pairs=options_dict["cae_n_pairs"],
+                max_pairs_per_type=options_dict["cae_max_pairs_per_type"],
+                shuffle_every_epoch=True, speaker_ids=None if
+                options_dict["d_speaker_embedding"] is None else
+                train_speaker_ids, n_buffers=options_dict["n_prefetch"] + 2,
+                max_frames=options_dict["cae_max_frames"]
+                )
+            print("No. pairs per epoch:", train_batch_iterator.n_pairs)
+        else:
+            train_batch_iterator = batching.PairedBucketIterator(
+                train_x, pair_list, batch_size=options_dict["cae_batch_size"],
+                n_buckets=options_dict["cae_n_buckets"],
+                shuffle_every_epoch=True, speaker_ids=None if
+                options_dict["d_speaker_embedding"] is None else
+                train_speaker_ids, n_buffers=options_dict["n_prefetch"] + 2,
+                max_frames=options_dict["cae_max_frames"],
+                prepad=options_dict["prepad"]
+                )
+        print(
+            "Padding efficiency:", train_batch_iterator.padding_efficiency()
+            )
+        if getattr(train_batch_iterator, "padded_buckets", None) is not None:
+            print("Pre-padded buckets: {:.1f} MB".format(
+                train_batch_iterator.padded_buckets.nbytes/1024.**2
+                ))
+        train_batch_iterator = batching.PrefetchIterator(
+            train_batch_iterator, options_dict["n_prefetch"]
             )
         if options_dict["d_speaker_embedding"] is None:
             cae_record_dict = training.train_fixed_epochs_external_val(
@@ -388,7 +495,10 @@ def train_cae(options_dict):
                 samediff_val, save_model_fn=intermediate_model_fn,
                 save_best_val_model_fn=model_fn,
                 n_val_interval=options_dict["cae_n_val_interval"],
-                load_model_fn=cae_pretrain_model_fn
+                load_model_fn=cae_pretrain_model_fn,
+                checkpoint_fn=path.join(model_dir, "cae.checkpoint.ckpt") if
+                options_dict["resumable"] else None,
+                n_checkpoint_batches=options_dict["n_checkpoint_batches"]
                 )
         else:
             cae_record_dict = training.train_fixed_epochs_external_val(
@@ -397,7 +507,10 @@ def train_cae(options_dict):
                 samediff_val, save_model_fn=intermediate_model_fn,
                 save_best_val_model_fn=model_fn,
                 n_val_interval=options_dict["cae_n_val_interval"],
-                load_model_fn=cae_pretrain_model_fn
+                load_model_fn=cae_pretrain_model_fn,
+                checkpoint_fn=path.join(model_dir, "cae.checkpoint.ckpt") if
+                options_dict["resumable"] else None,
+                n_checkpoint_batches=options_dict["n_checkpoint_batches"]
                 )
 
     # Save record
@@ -545,6 +658,17 @@ def check_argv():
         "(default: %(default)s)",
         default=default_options_dict["use_test_for_val"]
         )
+    parser.add_argument(
+        "--resumable", action="store_true",
+        help="if set, checkpoint training so that a restarted run resumes "
+        "where it stopped (default: %(default)s)",
+        default=default_options_dict["resumable"]
+        )
+    parser.add_argument(
+        "--frame_dtype", type=str, choices=["float16", "int8"],
+        help="if set, hold frames in memory in this compressed form "
+        "(default: %(default)s)", default=default_options_dict["frame_dtype"]
+        )
     parser.add_argument(
         "--rnd_seed", type=int, help="random seed (default: %(default)s)",
         default=default_options_dict["rnd_seed"]
@@ -577,6 +701,8 @@ def main():
     options_dict["use_test_for_val"] = args.use_test_for_val
     options_dict["train_tag"] = args.train_tag
     options_dict["pretrain_tag"] = args.pretrain_tag
+    options_dict["resumable"] = args.resumable
+    options_dict["frame_dtype"] = args.frame_dtype
     options_dict["rnd_seed"] = args.rnd_seed
     if args.n_hiddens is not None and args.enc_n_layers is not None:
         options_dict["enc_n_hiddens"] = [1]*args.enc_n_layers
@@ -35,6 +35,13 @@ import training
 
 default_options_dict = {
         "data_dir": path.join("data", "buckeye.mfcc"),
+        "data_cache_dir": path.join("data", "cache"),
+                                            # truncated datasets are cached
+                                            # here (None to disable caching)
+        "frame_dtype": None,                # if "float16" or "int8", frames
+                                            # are held in memory in this
+                                            # compressed form and decoded per
+                                            # batch
         "train_tag": "gt",                  # "gt", "gt2", "utd"
         "max_length": 100,
         "bidirectional": False,
@@ -48,15 +55,39 @@ default_options_dict = {
         "n_epochs": 10,
         "batch_size": 300,
         "n_buckets": 3,
+        "max_frames": None,                 # if given, batches are formed up
+                                            # to this many padded frames with
+                                            # buckets chosen to minimise
+                                            # padding, instead of using
+                                            # batch_size
+        "n_batch_classes": None,            # if given, each batch has this
+                                            # many classes (P) with
+                                            # n_batch_samples items (K) each,
+                                            # instead of using batch_size
+        "n_batch_samples": 4,
+        "n_prefetch": 2,                    # batches built in background
         "extrinsic_usefinal": False,        # if True, during final extrinsic
                                             # evaluation, the final saved model
                                             # will be used (instead of the
                                             # validation best)
         "use_test_for_val": False,
         "n_val_interval": 1,
+        "resumable": False,                 # if True, training is checkpointed
+                                            # after every epoch, and a
+                                            # restarted run resumes where it
+                                            # stopped
+        "n_checkpoint_batches": None,       # if given with resumable, also
+                                            # checkpoint every this many
+                                            # batches
         "rnd_seed": 1,
     }
 
+# Options that only affect how training is run and not the trained model,
+# and are therefore left out of the model directory hash
+runtime_option_keys = [
+    "data_cache_dir", "n_prefetch", "resumable", "n_checkpoint_batches"
+    ]
+
 
 #-----------------------------------------------------------------------------#
 #                              TRAINING FUNCTIONS                             #
@@ -112,7 +143,10 @@ def train_siamese(options_dict):
     print(datetime.now())
 
     # Output directory
-    hasher = hashlib.md5(repr(sorted(options_dict.items())).encode("ascii"))
+    hasher = hashlib.md5(repr(sorted([
+        (key, value) for key, value in options_dict.items() if key not in
+        runtime_option_keys
+        ])).encode("ascii"))
     hash_str = hasher.hexdigest()[:10]
     model_dir = path.join(
         "models", path.split(options_dict["data_dir"])[-1] + "." +
@@ -131,14 +165,22 @@ def train_siamese(options_dict):
 
     # LOAD AND FORMAT DATA
 
+    # Truncation and dimensionality
+    max_length = options_dict["max_length"]
+    d_frame = 13  # None
+    options_dict["n_input"] = d_frame
+    print("Limiting dimensionality:", d_frame)
+    print("Limiting length:", max_length)
+
     # Training data
     train_tag = options_dict["train_tag"]
     npz_fn = path.join(
         options_dict["data_dir"], "train." + train_tag + ".npz"
         )
     train_x, train_labels, train_lengths, train_keys, train_speakers = (
-        data_io.load_data_from_npz(npz_fn, None)
-        )
+        data_io.load_derived_data(
+        npz_fn, d_frame, max_length, cache_dir=options_dict["data_cache_dir"]
+        ))
 
     # Convert training labels to integers
     train_label_set = list(set(train_labels))
@@ -156,17 +198,20 @@ def train_siamese(options_dict):
     else:
         npz_fn = path.join(options_dict["data_dir"], "val.npz")
     val_x, val_labels, val_lengths, val_keys, val_speakers = (
-        data_io.load_data_from_npz(npz_fn)
-        )
-
-    # Truncate and limit dimensionality
-    max_length = options_dict["max_length"]
-    d_frame = 13  # None
-    options_dict["n_input"] = d_frame
-    print("Limiting dimensionality:", d_frame)
-    print("Limiting length:", max_length)
-    data_io.trunc_and_limit_dim(train_x, train_lengths, d_frame, max_length)
-    data_io.trunc_and_limit_dim(val_x, val_lengths, d_frame, max_length)
+        data_io.load_derived_data(
+        npz_fn, d_frame, max_length, cache_dir=options_dict["data_cache_dir"]
+        ))
+
+    # Compress frames held in memory
+    if options_dict["frame_dtype"] is not None:
+        print("Compressing frames:", options_dict["frame_dtype"])
+        train_x = batching.compress_sequences(
+            train_x, options_dict["frame_dtype"]
+            )
+        val_x = batching.compress_sequences(val_x, options_dict["frame_dtype"])
+        print("Training frames: {:.1f} MB".format(
+            train_x.frames.nbytes/1024.**2
+            ))
 
 
     # DEFINE MODEL
@@ -239,15 +284,33 @@ def train_siamese(options_dict):
 
     # Train Siamese model
     val_model_fn = intermediate_model_fn
-    train_batch_iterator = batching.LabelledBucketIterator(
-        train_x, train_y, options_dict["batch_size"],
-        n_buckets=options_dict["n_buckets"], shuffle_every_epoch=True
+    if options_dict["n_batch_classes"] is not None:
+        train_batch_iterator = batching.ClassBalancedBucketIterator(
+            train_x, train_y, options_dict["n_batch_classes"],
+            options_dict["n_batch_samples"], options_dict["n_buckets"],
+            shuffle_every_epoch=True, n_buffers=options_dict["n_prefetch"] + 2
+            )
+    else:
+        train_batch_iterator = batching.LabelledBucketIterator(
+            train_x, train_y, options_dict["batch_size"],
+            n_buckets=options_dict["n_buckets"], shuffle_every_epoch=True,
+            n_buffers=options_dict["n_prefetch"] + 2,
+            max_frames=options_dict["max_frames"]
+            )
+    print(
+        "Padding efficiency:", train_batch_iterator.padding_efficiency()
+        )
+    train_batch_iterator = batching.PrefetchIterator(
+        train_batch_iterator, options_dict["n_prefetch"]
         )
     record_dict = training.train_fixed_epochs_external_val(
         options_dict["n_epochs"], optimizer, loss, train_batch_iterator, [x,
         x_lengths, y], samediff_val, save_model_fn=intermediate_model_fn,
         save_best_val_model_fn=model_fn,
-        n_val_interval=options_dict["n_val_interval"]
+        n_val_interval=options_dict["n_val_interval"],
+        checkpoint_fn=path.join(model_dir, "siamese.checkpoint.ckpt") if
+        options_dict["resumable"] else None,
+        n_checkpoint_batches=options_dict["n_checkpoint_batches"]
         )
 
     # Save record
@@ -329,6 +392,17 @@ def check_argv():
         "(default: %(default)s)",
         default=default_options_dict["use_test_for_val"]
         )
+    parser.add_argument(
+        "--resumable", action="store_true",
+        help="if set, checkpoint training so that a restarted run resumes "
+        "where it stopped (default: %(default)s)",
+        default=default_options_dict["resumable"]
+        )
+    parser.add_argument(
+        "--frame_dtype", type=str, choices=["float16", "int8"],
+        help="if set, hold frames in memory in this compressed form "
+        "(default: %(default)s)", default=default_options_dict["frame_dtype"]
+        )
     parser.add_argument(
         "--rnd_seed", type=int, help="random seed (default: %(default)s)",
         default=default_options_dict["rnd_seed"]
@@ -352,6 +426,8 @@ def main():
     options_dict["extrinsic_usefinal"] = args.extrinsic_usefinal
     options_dict["use_test_for_val"] = args.use_test_for_val
     options_dict["train_tag"] = args.train_tag
+    options_dict["resumable"] = args.resumable
+    options_dict["frame_dtype"] = args.frame_dtype
     options_dict["rnd_seed"] = args.rnd_seed
 
     # Train model
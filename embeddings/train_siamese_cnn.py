@@ -52,15 +52,32 @@ default_options_dict = {
         "n_epochs": 250,
         "learning_rate": 0.001,
         "batch_size": 600,
+        "n_batch_classes": None,            # if given, each batch has this
+                                            # many classes (P) with
+                                            # n_batch_samples items (K) each,
+                                            # instead of using batch_size
+        "n_batch_samples": 4,
+        "n_prefetch": 2,                    # batches built in background
         "extrinsic_usefinal": False,        # if True, during final extrinsic
                                             # evaluation, the final saved model
                                             # will be used (instead of the
                                             # validation best)
         "use_test_for_val": False,
         "n_val_interval": 1,
+        "resumable": False,                 # if True, training is checkpointed
+                                            # after every epoch, and a
+                                            # restarted run resumes where it
+                                            # stopped
+        "n_checkpoint_batches": None,       # if given with resumable, also
+                                            # checkpoint every this many
+                                            # batches
         "rnd_seed": 1,
     }
 
+# Options that only affect how training is run and not the trained model,
+# and are therefore left out of the model directory hash
+runtime_option_keys = ["n_prefetch", "resumable", "n_checkpoint_batches"]
+
 
 #-----------------------------------------------------------------------------#
 #                              TRAINING FUNCTIONS                             #
@@ -105,7 +122,10 @@ def train_siamese_cnn(options_dict):
     print(datetime.now())
 
     # Output directory
-    hasher = hashlib.md5(repr(sorted(options_dict.items())).encode("ascii"))
+    hasher = hashlib.md5(repr(sorted([
+        (key, value) for key, value in options_dict.items() if key not in
+        runtime_option_keys
+        ])).encode("ascii"))
     hash_str = hasher.hexdigest()[:10]
     model_dir = path.join(
         "models", path.split(options_dict["data_dir"])[-1] + "." +
@@ -155,10 +175,10 @@ def train_siamese_cnn(options_dict):
     # Zero-pad sequences
     max_length = options_dict["max_length"]
     print("Limiting length:", max_length)
-    train_x, _ = data_io.pad_sequences(train_x, max_length, True)
-    val_x, _ = data_io.pad_sequences(val_x, max_length, True)
-    train_x = np.transpose(train_x, (0, 2, 1))
-    val_x = np.transpose(val_x, (0, 2, 1))
+    train_x, _ = data_io.pad_sequences(
+        train_x, max_length, True, transpose=True
+        )
+    val_x, _ = data_io.pad_sequences(val_x, max_length, True, transpose=True)
     
     # Dimensionalities
     d_in = train_x.shape[1]*train_x.shape[2]
@@ -249,14 +269,27 @@ def train_siamese_cnn(options_dict):
 
     # Train Siamese CNN model
     val_model_fn = intermediate_model_fn
-    train_batch_iterator = batching.LabelledIterator(
-        train_x, train_y, options_dict["batch_size"], shuffle_every_epoch=True
+    if options_dict["n_batch_classes"] is not None:
+        train_batch_iterator = batching.ClassBalancedIterator(
+            train_x, train_y, options_dict["n_batch_classes"],
+            options_dict["n_batch_samples"], shuffle_every_epoch=True
+            )
+    else:
+        train_batch_iterator = batching.LabelledIterator(
+            train_x, train_y, options_dict["batch_size"],
+            shuffle_every_epoch=True
+            )
+    train_batch_iterator = batching.PrefetchIterator(
+        train_batch_iterator, options_dict["n_prefetch"]
         )
     record_dict = training.train_fixed_epochs_external_val(
         options_dict["n_epochs"], optimizer, loss, train_batch_iterator, [x,
          y], samediff_val, save_model_fn=intermediate_model_fn,
          save_best_val_model_fn=model_fn,
-         n_val_interval=options_dict["n_val_interval"]
+         n_val_interval=options_dict["n_val_interval"],
+         checkpoint_fn=path.join(model_dir, "siamese_cnn.checkpoint.ckpt") if
+         options_dict["resumable"] else None,
+         n_checkpoint_batches=options_dict["n_checkpoint_batches"]
          )
 
     # Save record
@@ -344,6 +377,12 @@ def check_argv():
         "(default: %(default)s)",
         default=default_options_dict["use_test_for_val"]
         )
+    parser.add_argument(
+        "--resumable", action="store_true",
+        help="if set, checkpoint training so that a restarted run resumes "
+        "where it stopped (default: %(default)s)",
+        default=default_options_dict["resumable"]
+        )
     parser.add_argument(
         "--rnd_seed", type=int, help="random seed (default: %(default)s)",
         default=default_options_dict["rnd_seed"]
@@ -368,6 +407,7 @@ def main():
     options_dict["extrinsic_usefinal"] = args.extrinsic_usefinal
     options_dict["use_test_for_val"] = args.use_test_for_val
     options_dict["train_tag"] = args.train_tag
+    options_dict["resumable"] = args.resumable
     options_dict["rnd_seed"] = args.rnd_seed
 
     # Train model
@@ -12,6 +12,7 @@ from datetime import datetime
 from os import path
 from tqdm import tqdm
 import argparse
+import glob
 import numpy as np
 import os
 import sys
@@ -23,11 +24,17 @@ import features
 import utils
 
 
-def extract_features_for_subset(subset, feat_type, output_fn):
+def extract_features_for_subset(subset, output_fns, n_workers=1,
+        keep_shards=False):
     """
     Extract specified features for a subset.
 
-    The `feat_type` parameter can be "mfcc" or "fbank".
+    The `output_fns` dictionary gives the output filename for each of the
+    feature types to extract, which can be "mfcc" and "fbank". All the feature
+    types are extracted in a single pass over the audio. The audio files of all
+    the speakers in the subset are spread over `n_workers` processes. Features
+    are written in per-speaker shards, so an interrupted extraction resumes
+    from the last completed speaker.
     """
 
     # Speakers for subset
@@ -41,70 +48,81 @@ def extract_features_for_subset(subset, feat_type, output_fn):
             speakers.add(line.strip())
     print("Speakers:", ", ".join(sorted(speakers)))
 
-    # Raw features
-    feat_dict = {}
-    print("Extracting features per speaker:")
+    # Audio files for each speaker
+    speaker_wav_fns = {}
     for speaker in sorted(speakers):
-        if feat_type == "mfcc":
-            speaker_feat_dict = features.extract_mfcc_dir(
-                path.join(buckeye_datadir, speaker)
-                )
-        elif feat_type == "fbank":
-            speaker_feat_dict = features.extract_fbank_dir(
-                path.join(buckeye_datadir, speaker)
-                )
-        else:
-            assert False, "invalid feature type"
-        for wav_key in speaker_feat_dict:
-            feat_dict[speaker + "_" + wav_key[3:]] = speaker_feat_dict[wav_key]
+        speaker_wav_fns[speaker] = sorted(
+            glob.glob(path.join(buckeye_datadir, speaker, "*.wav"))
+            )
 
     # Read voice activity regions
     fa_fn = path.join("..", "data", "buckeye_english.wrd")
     print("Reading:", fa_fn)
     vad_dict = utils.read_vad_from_fa(fa_fn)
 
-    # Only keep voice active regions
-    print("Extracting VAD regions:")
-    feat_dict = features.extract_vad(feat_dict, vad_dict)
+    # Extract, normalise and write features per speaker
+    print("Extracting features:", ", ".join(sorted(output_fns)))
+    features.extract_features_sharded(
+        speaker_wav_fns, output_fns, vad_dict, utils.uttlabel_to_uttkey,
+        n_workers, extra=fa_fn, keep_shards=keep_shards
+        )
 
-    # Perform per speaker mean and variance normalisation
-    print("Per speaker mean and variance normalisation:")
-    feat_dict = features.speaker_mvn(feat_dict)
 
-    # Write output
-    print("Writing:", output_fn)
-    np.savez_compressed(output_fn, **feat_dict)
+#-----------------------------------------------------------------------------#
+#                              UTILITY FUNCTIONS                              #
+#-----------------------------------------------------------------------------#
 
+def check_argv():
+    """Check the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0]
+        )
+    parser.add_argument(
+        "--n_workers", type=int,
+        help="number of processes used for feature extraction "
+        "(default: %(default)s)", default=1
+        )
+    parser.add_argument(
+        "--keep_shards", action="store_true",
+        help="keep the per-speaker shards after the archives are written"
+        )
+    return parser.parse_args()
+
+
+#-----------------------------------------------------------------------------#
+#                                MAIN FUNCTION                                #
+#-----------------------------------------------------------------------------#
 
 def main():
+    args = check_argv()
 
     print(datetime.now())
 
     # RAW FEATURES
 
-    # Extract MFCCs for the different sets
+    # Extract MFCCs and filterbanks for the different sets
     mfcc_dir = path.join("mfcc", "buckeye")
+    fbank_dir = path.join("fbank", "buckeye")
+    for feat_dir in [mfcc_dir, fbank_dir]:
+        if not path.isdir(feat_dir):
+            os.makedirs(feat_dir)
     for subset in ["devpart1", "devpart2", "zs"]:
-        if not path.isdir(mfcc_dir):
-            os.makedirs(mfcc_dir)
+        output_fns = {}
         output_fn = path.join(mfcc_dir, subset + ".dd.npz")
         if not path.isfile(output_fn):
-            print("Extracting MFCCs:", subset)
-            extract_features_for_subset(subset, "mfcc", output_fn)
+            output_fns["mfcc"] = output_fn
         else:
             print("Using existing file:", output_fn)
-
-    # Extract filterbanks for the different sets
-    fbank_dir = path.join("fbank", "buckeye")
-    for subset in ["devpart1", "devpart2", "zs"]:
-        if not path.isdir(fbank_dir):
-            os.makedirs(fbank_dir)
         output_fn = path.join(fbank_dir, subset + ".npz")
         if not path.isfile(output_fn):
-            print("Extracting filterbanks:", subset)
-            extract_features_for_subset(subset, "fbank", output_fn)
+            output_fns["fbank"] = output_fn
         else:
             print("Using existing file:", output_fn)
+        if len(output_fns) > 0:
+            print("Extracting features:", subset)
+            extract_features_for_subset(
+                subset, output_fns, args.n_workers, args.keep_shards
+                )
 
 
     # GROUND TRUTH WORD SEGMENTS
@@ -12,6 +12,7 @@ from datetime import datetime
 from os import path
 from tqdm import tqdm
 import argparse
+import glob
 import numpy as np
 import os
 import sys
@@ -23,70 +24,91 @@ import features
 import utils
 
 
-def extract_features(feat_type, output_fn):
+def extract_features(output_fns, n_workers=1, keep_shards=False):
     """
     Extract specified features.
 
-    The `feat_type` parameter can be "mfcc" or "fbank".
+    The `output_fns` dictionary gives the output filename for each of the
+    feature types to extract, which can be "mfcc" and "fbank". All the feature
+    types are extracted in a single pass over the audio, with the audio files
+    spread over `n_workers` processes. Features are written in per-speaker
+    shards, so an interrupted extraction resumes from the last completed
+    speaker.
     """
 
-    # Raw features
-    feat_dict = {}
-    if feat_type == "mfcc":
-        feat_dict_wavkey = features.extract_mfcc_dir(xitsonga_datadir)
-    elif feat_type == "fbank":
-        feat_dict_wavkey = features.extract_fbank_dir(xitsonga_datadir)
-    else:
-        assert False, "invalid feature type"
-    for wav_key in feat_dict_wavkey:
-        feat_key = utils.uttlabel_to_uttkey(wav_key)
-        feat_dict[feat_key] = feat_dict_wavkey[wav_key]
+    # Audio files for each speaker
+    speaker_wav_fns = {}
+    for wav_fn in sorted(glob.glob(path.join(xitsonga_datadir, "*.wav"))):
+        wav_key = path.splitext(path.split(wav_fn)[-1])[0]
+        speaker = utils.uttlabel_to_uttkey(wav_key).split("_")[0]
+        if speaker not in speaker_wav_fns:
+            speaker_wav_fns[speaker] = []
+        speaker_wav_fns[speaker].append(wav_fn)
 
     # Read voice activity regions
     fa_fn = path.join("..", "data", "xitsonga.wrd")
     print("Reading:", fa_fn)
     vad_dict = utils.read_vad_from_fa(fa_fn)
 
-    # Only keep voice active regions
-    print("Extracting VAD regions:")
-    feat_dict = features.extract_vad(feat_dict, vad_dict)
+    # Extract, normalise and write features per speaker
+    features.extract_features_sharded(
+        speaker_wav_fns, output_fns, vad_dict, utils.uttlabel_to_uttkey,
+        n_workers, extra=fa_fn, keep_shards=keep_shards
+        )
+
 
-    # Perform per speaker mean and variance normalisation
-    print("Per speaker mean and variance normalisation:")
-    feat_dict = features.speaker_mvn(feat_dict)
+#-----------------------------------------------------------------------------#
+#                              UTILITY FUNCTIONS                              #
+#-----------------------------------------------------------------------------#
+
+def check_argv():
+    """Check the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0]
+        )
+    parser.add_argument(
+        "--n_workers", type=int,
+        help="number of processes used for feature extraction "
+        "(default: %(default)s)", default=1
+        )
+    parser.add_argument(
+        "--keep_shards", action="store_true",
+        help="keep the per-speaker shards after the archives are written"
+        )
+    return parser.parse_args()
 
-    # Write output
-    print("Writing:", output_fn)
-    np.savez_compressed(output_fn, **feat_dict)
 
+#-----------------------------------------------------------------------------#
+#                                MAIN FUNCTION                                #
+#-----------------------------------------------------------------------------#
 
 def main():
+    args = check_argv()
 
     print(datetime.now())
 
     # RAW FEATURES
 
-    # Extract MFCCs
+    # Extract MFCCs and filterbanks
     mfcc_dir = path.join("mfcc", "xitsonga")
-    if not path.isdir(mfcc_dir):
-        os.makedirs(mfcc_dir)
+    fbank_dir = path.join("fbank", "xitsonga")
+    for feat_dir in [mfcc_dir, fbank_dir]:
+        if not path.isdir(feat_dir):
+            os.makedirs(feat_dir)
+    output_fns = {}
     output_fn = path.join(mfcc_dir, "xitsonga.dd.npz")
     if not path.isfile(output_fn):
-        print("Extracting MFCCs")
-        extract_features("mfcc", output_fn)
+        output_fns["mfcc"] = output_fn
     else:
         print("Using existing file:", output_fn)
-
-    # Extract filterbanks
-    fbank_dir = path.join("fbank", "xitsonga")
-    if not path.isdir(fbank_dir):
-        os.makedirs(fbank_dir)
     output_fn = path.join(fbank_dir, "xitsonga.npz")
     if not path.isfile(output_fn):
-        print("Extracting filterbanks")
-        extract_features("fbank", output_fn)
+        output_fns["fbank"] = output_fn
     else:
         print("Using existing file:", output_fn)
+    if len(output_fns) > 0:
+        print("Extracting features:", ", ".join(sorted(output_fns)))
+        extract_features(output_fns, args.n_workers, args.keep_shards)
 
 
     # GROUND TRUTH WORD SEGMENTS
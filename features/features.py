@@ -6,83 +6,380 @@ Contact: kamperh@gmail.com
 Date: 2019
 """
 
+from collections import deque
+from functools import lru_cache
+from functools import partial
+from multiprocessing import Pool
 from os import path
 from tqdm import tqdm
 import glob
+import hashlib
 import librosa
 import numpy as np
+import os
 import scipy.io.wavfile as wav
+import scipy.signal
+import shutil
+import zipfile
 
 
-def extract_fbank_dir(dir):
+#-----------------------------------------------------------------------------#
+#                           DEFAULT FEATURE OPTIONS                           #
+#-----------------------------------------------------------------------------#
+
+default_options_dict = {
+    "engine": "numpy",                  # "numpy" or "librosa"
+    "preemph": 0.97,
+    "win_length": 0.025,                # window length in seconds
+    "hop_length": 0.01,                 # frame shift in seconds
+    "fmin": 64,
+    "fmax": 8000,
+    "mfcc_n_mels": 24,
+    "n_mfcc": 13,
+    "fbank_n_mels": 40,
+    }
+
+
+#-----------------------------------------------------------------------------#
+#                            NUMPY FEATURE ENGINE                             #
+#-----------------------------------------------------------------------------#
+
+# The functions below give the same features as the librosa calls, but with
+# the window, Mel filterbank, DCT and delta filter matrices computed only once
+# for a particular configuration.
+
+@lru_cache(maxsize=None)
+def get_window(n_fft):
+    """Return a periodic Hann window of length `n_fft`."""
+    return 0.5 - 0.5*np.cos(2*np.pi*np.arange(n_fft)/n_fft)
+
+
+@lru_cache(maxsize=None)
+def get_mel_basis(sample_rate, n_fft, n_mels, fmin, fmax):
+    """Return a [n_mels, 1 + n_fft/2] Mel filterbank matrix."""
+    return librosa.filters.mel(
+        sr=sample_rate, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax
+        )
+
+
+@lru_cache(maxsize=None)
+def get_dct_matrix(n_mfcc, n_mels):
+    """Return the [n_mfcc, n_mels] orthonormal type-II DCT matrix."""
+    dct_matrix = np.cos(
+        np.pi/n_mels*np.outer(np.arange(n_mfcc), np.arange(n_mels) + 0.5)
+        )*np.sqrt(2./n_mels)
+    dct_matrix[0, :] /= np.sqrt(2.)
+    return dct_matrix
+
+
+@lru_cache(maxsize=None)
+def get_delta_filters(width=9):
+    """
+    Return a [2, width] matrix with the delta and double delta filters.
+
+    These are the Savitzky-Golay filters used by `librosa.feature.delta`.
+    """
+    return np.array([
+        scipy.signal.savgol_coeffs(width, order, deriv=order, use="dot")
+        for order in [1, 2]
+        ])
+
+
+def frame_signal(signal, n_fft, hop_length, pad_mode="reflect"):
+    """
+    Return a [n_frames, n_fft] view of overlapping frames from `signal`.
+
+    As for `librosa.stft`, the signal is padded so that frames are centred.
+    """
+    signal = np.pad(signal, n_fft//2, mode=pad_mode)
+    n_frames = 1 + (len(signal) - n_fft)//hop_length
+    return np.lib.stride_tricks.as_strided(
+        signal, shape=(n_frames, n_fft),
+        strides=(signal.strides[0]*hop_length, signal.strides[0]),
+        writeable=False
+        )
+
+
+def power_to_db(power, amin=1e-10, top_db=80.0):
+    """Convert a power spectrogram to decibels as `librosa.power_to_db`."""
+    log_power = 10.0*np.log10(np.maximum(amin, power))
+    return np.maximum(log_power, log_power.max() - top_db)
+
+
+def valid_deltas(feats, width=9):
+    """
+    Return the deltas and double deltas of the frames with a full window.
+
+    A [2, n_frames - width + 1, d] array is returned for the [n_frames, d]
+    matrix `feats`, with the deltas and double deltas of frames `width//2` up
+    to `n_frames - width//2 - 1`. Both are obtained from one pass over a
+    [n_frames - width + 1, width, d] view of `feats`.
+    """
+    n_frames, d = feats.shape
+    windows = np.lib.stride_tricks.as_strided(
+        feats, shape=(n_frames - width + 1, width, d),
+        strides=(feats.strides[0], feats.strides[0], feats.strides[1]),
+        writeable=False
+        )
+    return np.einsum(
+        "ow,twd->otd", get_delta_filters(width).astype(feats.dtype), windows
+        )
+
+
+def deltas(feats, width=9):
+    """
+    Append deltas and double deltas to the [n_frames, d] matrix `feats`.
+
+    As in `librosa.feature.delta`, the edge frames take the values of the
+    polynomial fitted to the first and last `width` frames.
+    """
+    if feats.shape[0] < width:
+        raise ValueError(
+            "need at least {} frames to compute deltas".format(width)
+            )
+    delta_feats = np.pad(
+        valid_deltas(feats, width), ((0, 0), (width//2, width//2), (0, 0)),
+        mode="edge"
+        )
+    return np.hstack([feats, delta_feats[0], delta_feats[1]])
+
+
+#-----------------------------------------------------------------------------#
+#                         FEATURE EXTRACTION FUNCTIONS                        #
+#-----------------------------------------------------------------------------#
+
+def power_spectrum(signal, sample_rate, options_dict=None):
+    """
+    Return the power spectrum of `signal` as a [n_bins, n_frames] matrix.
+
+    By default a 25 ms window is used with a 10 ms frame shift. The same
+    spectrum is used for both the filterbank and MFCC features.
+    """
+    if options_dict is None:
+        options_dict = default_options_dict
+    n_fft = int(np.floor(options_dict["win_length"]*sample_rate))
+    hop_length = int(np.floor(options_dict["hop_length"]*sample_rate))
+    if options_dict["engine"] == "numpy":
+        frames = frame_signal(signal, n_fft, hop_length)
+        spectrum = np.fft.rfft(frames*get_window(n_fft), axis=1)
+        return (spectrum.real**2 + spectrum.imag**2).T
+    elif options_dict["engine"] == "librosa":
+        return np.abs(librosa.stft(
+            signal, n_fft=n_fft, hop_length=hop_length, pad_mode="reflect"
+            ))**2
+    else:
+        assert False, "invalid feature engine"
+
+
+def fbank_from_power(power, sample_rate, options_dict=None):
+    """Return Mel-scale log filterbanks from a `power_spectrum` output."""
+    if options_dict is None:
+        options_dict = default_options_dict
+    mel_basis = get_mel_basis(
+        sample_rate, int(np.floor(options_dict["win_length"]*sample_rate)),
+        options_dict["fbank_n_mels"], options_dict["fmin"],
+        options_dict["fmax"]
+        )
+    fbank = np.log(np.dot(mel_basis, power))
+    # from python_speech_features import logfbank
+    # samplerate, signal = wav.read(wav_fn)
+    # fbanks = logfbank(
+    #     signal, samplerate=samplerate, winlen=0.025, winstep=0.01,
+    #     nfilt=45, nfft=2048, lowfreq=0, highfreq=None, preemph=0,
+    #     winfunc=np.hamming
+    #     )
+    return fbank.T.astype(np.float32, copy=False)
+
+
+def mfcc_from_power(power, sample_rate, options_dict=None):
+    """
+    Return MFCCs from a `power_spectrum` output.
+
+    Deltas and double deltas are also calculated and appended to the static
+    coefficients.
+    """
+    if options_dict is None:
+        options_dict = default_options_dict
+    mel_basis = get_mel_basis(
+        sample_rate, int(np.floor(options_dict["win_length"]*sample_rate)),
+        options_dict["mfcc_n_mels"], options_dict["fmin"],
+        options_dict["fmax"]
+        )  #, htk=True
+    if options_dict["engine"] == "numpy":
+        dct_matrix = get_dct_matrix(
+            options_dict["n_mfcc"], options_dict["mfcc_n_mels"]
+            )
+        mfcc = np.dot(dct_matrix, power_to_db(np.dot(mel_basis, power)))
+        return deltas(np.ascontiguousarray(mfcc.T, dtype=np.float32))
+    elif options_dict["engine"] != "librosa":
+        assert False, "invalid feature engine"
+    mfcc = librosa.feature.mfcc(
+        S=librosa.power_to_db(np.dot(mel_basis, power)),
+        n_mfcc=options_dict["n_mfcc"]
+        )  #dct_type=3
+    mfcc_delta = librosa.feature.delta(mfcc)
+    mfcc_delta_delta = librosa.feature.delta(mfcc, order=2)
+    # from python_speech_features import delta
+    # from python_speech_features import mfcc
+    # samplerate, signal = wav.read(wav_fn)
+    # mfccs = mfcc(
+    #     signal, samplerate=samplerate, winlen=0.025, winstep=0.01,
+    #     numcep=13, nfilt=24, nfft=None, lowfreq=0, highfreq=None,
+    #     preemph=0.97, ceplifter=22, appendEnergy=True, winfunc=np.hamming
+    #     )
+    # d_mfccs = delta(mfccs, 2)
+    # dd_mfccs = delta(d_mfccs, 2)
+    return np.hstack([mfcc.T, mfcc_delta.T, mfcc_delta_delta.T])
+
+
+def extract_features_wav(wav_fn, feat_types=("mfcc", "fbank"),
+        options_dict=None):
+    """
+    Extract the features in `feat_types` for the audio file `wav_fn`.
+
+    The audio is read, preemphasised and transformed only once, irrespective
+    of the number of feature types. A dictionary is returned with the feature
+    type as key, each giving a [n_frames, d_frame] matrix.
+    """
+    if options_dict is None:
+        options_dict = default_options_dict
+    signal, sample_rate = librosa.core.load(wav_fn, sr=None)
+    signal = preemphasis(signal, coeff=options_dict["preemph"])
+    power = power_spectrum(signal, sample_rate, options_dict)
+    feats = {}
+    for feat_type in feat_types:
+        if feat_type == "mfcc":
+            feats[feat_type] = mfcc_from_power(
+                power, sample_rate, options_dict
+                )
+        elif feat_type == "fbank":
+            feats[feat_type] = fbank_from_power(
+                power, sample_rate, options_dict
+                )
+        else:
+            assert False, "invalid feature type"
+    return feats
+
+
+def map_wav_files(func, wav_fns, n_workers=1):
+    """
+    Apply `func` to each of the audio files in `wav_fns` and yield the results.
+
+    If `n_workers` is more than one, the files are spread over a pool of worker
+    processes. Results are always yielded in the order of `wav_fns`. At most
+    `2*n_workers` files are submitted ahead of the result last yielded, so the
+    workers cannot run ahead of a slow consumer and fill memory with results.
+    """
+    if n_workers is None or n_workers <= 1 or len(wav_fns) <= 1:
+        for wav_fn in tqdm(wav_fns):
+            yield func(wav_fn)
+    else:
+        n_workers = min(n_workers, len(wav_fns))
+        with Pool(n_workers) as pool:
+            pending = deque()
+            for wav_fn in tqdm(wav_fns):
+                pending.append(pool.apply_async(func, (wav_fn,)))
+                if len(pending) > 2*n_workers:
+                    yield pending.popleft().get()
+            while len(pending) > 0:
+                yield pending.popleft().get()
+
+
+def iter_features_files(wav_fns, feat_types=("mfcc", "fbank"), n_workers=1,
+        options_dict=None):
+    """
+    Extract features for the audio files in `wav_fns` one file at a time.
+
+    For each file, in the order of `wav_fns`, a tuple is yielded giving the
+    filename without the extension and the dictionary returned by
+    `extract_features_wav`. Only the results not yet consumed are kept in
+    memory.
+    """
+    extract_func = partial(
+        extract_features_wav, feat_types=feat_types, options_dict=options_dict
+        )
+    for wav_fn, feats in zip(
+            wav_fns, map_wav_files(extract_func, wav_fns, n_workers)):
+        yield (path.splitext(path.split(wav_fn)[-1])[0], feats)
+
+
+def extract_features_files(wav_fns, feat_types=("mfcc", "fbank"),
+        n_workers=1, options_dict=None):
+    """
+    Extract several feature types for the audio files in `wav_fns`.
+
+    A dictionary is returned with each of `feat_types` as key and as value a
+    feature dictionary. Each feature dictionary key will be the filename of the
+    associated audio file without the extension. All the feature types are
+    obtained in a single pass over the audio, using `n_workers` processes.
+    """
+    feat_dicts = dict([(feat_type, {}) for feat_type in feat_types])
+    for key, feats in iter_features_files(
+            wav_fns, feat_types, n_workers, options_dict):
+        for feat_type in feat_types:
+            feat_dicts[feat_type][key] = feats[feat_type]
+        # import matplotlib.pyplot as plt
+        # plt.imshow(feat_dicts["mfcc"][key][2000:2200,:])
+        # plt.show()
+        # assert False
+    return feat_dicts
+
+
+def extract_fbank_files(wav_fns, n_workers=1):
+    """
+    Extract filterbanks for the audio files in `wav_fns` and return a dict.
+
+    Each dictionary key will be the filename of the associated audio file
+    without the extension. Mel-scale log filterbanks are extracted, using
+    `n_workers` processes.
+    """
+    return extract_features_files(wav_fns, ["fbank"], n_workers)["fbank"]
+
+
+def extract_mfcc_files(wav_fns, n_workers=1):
+    """
+    Extract MFCCs for the audio files in `wav_fns` and return a dictionary.
+
+    Each dictionary key will be the filename of the associated audio file
+    without the extension. Deltas and double deltas are also extracted, using
+    `n_workers` processes.
+    """
+    return extract_features_files(wav_fns, ["mfcc"], n_workers)["mfcc"]
+
+
+def extract_features_dir(dir, feat_types=("mfcc", "fbank"), n_workers=1):
+    """
+    Extract several feature types for all audio files in `dir`.
+
+    See `extract_features_files` for details on the returned dictionary.
+    """
+    return extract_features_files(
+        sorted(glob.glob(path.join(dir, "*.wav"))), feat_types, n_workers
+        )
+
+
+def extract_fbank_dir(dir, n_workers=1):
     """
     Extract filterbanks for all audio files in `dir` and return a dictionary.
 
     Each dictionary key will be the filename of the associated audio file
     without the extension. Mel-scale log filterbanks are extracted.
     """
-    feat_dict = {}
-    for wav_fn in tqdm(sorted(glob.glob(path.join(dir, "*.wav")))):
-        signal, sample_rate = librosa.core.load(wav_fn, sr=None)
-        signal = preemphasis(signal, coeff=0.97)
-        fbank = np.log(librosa.feature.melspectrogram(
-            signal, sr=sample_rate, n_mels=40,
-            n_fft=int(np.floor(0.025*sample_rate)),
-            hop_length=int(np.floor(0.01*sample_rate)), fmin=64, fmax=8000,
-            ))
-        # from python_speech_features import logfbank
-        # samplerate, signal = wav.read(wav_fn)
-        # fbanks = logfbank(
-        #     signal, samplerate=samplerate, winlen=0.025, winstep=0.01,
-        #     nfilt=45, nfft=2048, lowfreq=0, highfreq=None, preemph=0,
-        #     winfunc=np.hamming
-        #     )
-        key = path.splitext(path.split(wav_fn)[-1])[0]
-        feat_dict[key] = fbank.T
-    return feat_dict
-
-
-def extract_mfcc_dir(dir):
+    return extract_fbank_files(
+        sorted(glob.glob(path.join(dir, "*.wav"))), n_workers
+        )
+
+
+def extract_mfcc_dir(dir, n_workers=1):
     """
     Extract MFCCs for all audio files in `dir` and return a dictionary.
 
     Each dictionary key will be the filename of the associated audio file
     without the extension. Deltas and double deltas are also extracted.
     """
-    feat_dict = {}
-    for wav_fn in tqdm(sorted(glob.glob(path.join(dir, "*.wav")))):
-        signal, sample_rate = librosa.core.load(wav_fn, sr=None)
-        signal = preemphasis(signal, coeff=0.97)
-        mfcc = librosa.feature.mfcc(
-            signal, sr=sample_rate, n_mfcc=13, n_mels=24,  #dct_type=3,
-            n_fft=int(np.floor(0.025*sample_rate)),
-            hop_length=int(np.floor(0.01*sample_rate)), fmin=64, fmax=8000,
-            #htk=True
-            )
-        # mfcc = librosa.feature.mfcc(
-        #     signal, sr=sample_rate, n_mfcc=13,
-        #     n_fft=int(np.floor(0.025*sample_rate)),
-        #     hop_length=int(np.floor(0.01*sample_rate))
-        #     )
-        mfcc_delta = librosa.feature.delta(mfcc)
-        mfcc_delta_delta = librosa.feature.delta(mfcc, order=2)
-        # from python_speech_features import delta
-        # from python_speech_features import mfcc
-        # samplerate, signal = wav.read(wav_fn)
-        # mfccs = mfcc(
-        #     signal, samplerate=samplerate, winlen=0.025, winstep=0.01,
-        #     numcep=13, nfilt=24, nfft=None, lowfreq=0, highfreq=None,
-        #     preemph=0.97, ceplifter=22, appendEnergy=True, winfunc=np.hamming
-        #     )
-        # d_mfccs = delta(mfccs, 2)
-        # dd_mfccs = delta(d_mfccs, 2)
-        key = path.splitext(path.split(wav_fn)[-1])[0]
-        feat_dict[key] = np.hstack([mfcc.T, mfcc_delta.T, mfcc_delta_delta.T])
-        # import matplotlib.pyplot as plt
-        # plt.imshow(feat_dict[key][2000:2200,:])
-        # plt.show()
-        # assert False
-    return feat_dict
+    return extract_mfcc_files(
+        sorted(glob.glob(path.join(dir, "*.wav"))), n_workers
+        )
 
 
 def extract_vad(feat_dict, vad_dict):
@@ -91,7 +388,8 @@ def extract_vad(feat_dict, vad_dict):
 
     The `vad_dict` should have the same keys as `feat_dict` with the active
     speech regions given as lists of tuples of (start, end) frame, with the end
-    excluded.
+    excluded. Each segment is copied, so overlapping regions do not share
+    frames and the utterance features can be freed afterwards.
     """
     output_dict = {}
     for utt_key in tqdm(sorted(feat_dict)):
@@ -100,48 +398,504 @@ def extract_vad(feat_dict, vad_dict):
             continue
         for (start, end) in vad_dict[utt_key]:
             segment_key = utt_key + "_{:06d}-{:06d}".format(start, end)
-            output_dict[segment_key] = feat_dict[utt_key][start:end, :]
+            output_dict[segment_key] = np.array(
+                feat_dict[utt_key][start:end, :]
+                )
     return output_dict
 
 
-def speaker_mvn(feat_dict):
+def speaker_mvn_stats(feat_dict):
     """
-    Perform per-speaker mean and variance normalisation.
+    Accumulate per-speaker mean and variance statistics.
 
     It is assumed that each of the keys in `feat_dict` starts with a speaker
-    identifier followed by an underscore.
+    identifier followed by an underscore. Statistics are accumulated one item
+    at a time: the mean and sum of squared deviations of each item are merged
+    into running totals for its speaker (the parallel form of Welford's
+    algorithm), so memory use does not grow with the amount of data. A
+    dictionary is returned with speakers as keys and (n_frames, mean, std)
+    tuples as values.
     """
-
-    speakers = set([key.split("_")[0] for key in feat_dict])
-
-    # Separate features per speaker
-    speaker_features = {}
+    speaker_counts = {}
+    speaker_means = {}
+    speaker_m2s = {}
     for utt_key in sorted(feat_dict):
         speaker = utt_key.split("_")[0]
-        if speaker not in speaker_features:
-            speaker_features[speaker] = []
-        speaker_features[speaker].append(feat_dict[utt_key])
-
-    # Determine means and variances per speaker
-    speaker_mean = {}
-    speaker_std = {}
-    for speaker in speakers:
-        features = np.vstack(speaker_features[speaker])
-        speaker_mean[speaker] = np.mean(features, axis=0)
-        speaker_std[speaker] = np.std(features, axis=0)
+        features = np.asarray(feat_dict[utt_key], dtype=np.float64)
+        n = features.shape[0]
+        if n == 0:
+            continue
+        mean = np.mean(features, axis=0)
+        m2 = np.sum((features - mean)**2, axis=0)
+        if speaker not in speaker_counts:
+            speaker_counts[speaker] = n
+            speaker_means[speaker] = mean
+            speaker_m2s[speaker] = m2
+        else:
+            n_total = speaker_counts[speaker] + n
+            delta = mean - speaker_means[speaker]
+            speaker_means[speaker] += delta*n/n_total
+            speaker_m2s[speaker] += (
+                m2 + delta**2*speaker_counts[speaker]*n/n_total
+                )
+            speaker_counts[speaker] = n_total
+
+    speaker_stats = {}
+    for speaker in speaker_counts:
+        speaker_stats[speaker] = (
+            speaker_counts[speaker], speaker_means[speaker],
+            np.sqrt(speaker_m2s[speaker]/speaker_counts[speaker])
+            )
+    return speaker_stats
+
+
+def write_speaker_stats(speaker_stats, output_fn):
+    """Write the output of `speaker_mvn_stats` to a NumPy archive."""
+    speakers = sorted(speaker_stats)
+    np.savez(
+        output_fn, speakers=np.array(speakers),
+        counts=np.array([speaker_stats[i][0] for i in speakers]),
+        means=np.array([speaker_stats[i][1] for i in speakers]),
+        stds=np.array([speaker_stats[i][2] for i in speakers])
+        )
+
+
+def read_speaker_stats(input_fn):
+    """Read statistics written by `write_speaker_stats`."""
+    npz = np.load(input_fn)
+    speaker_stats = {}
+    for i, speaker in enumerate(npz["speakers"]):
+        speaker_stats[str(speaker)] = (
+            int(npz["counts"][i]), npz["means"][i], npz["stds"][i]
+            )
+    return speaker_stats
+
+
+def get_shared_keys(feat_dict):
+    """
+    Return the set of keys in `feat_dict` whose arrays share memory.
+
+    Arrays are compared on the range of bytes they span, so interleaved views
+    are conservatively reported as sharing memory.
+    """
+    bounds = []
+    for key in feat_dict:
+        features = feat_dict[key]
+        if features.size == 0:
+            continue
+        low = high = features.__array_interface__["data"][0]
+        for dim, stride in zip(features.shape, features.strides):
+            if stride < 0:
+                low += stride*(dim - 1)
+            else:
+                high += stride*(dim - 1)
+        bounds.append((low, high + features.itemsize, key))
+    bounds.sort()
+    shared_keys = set()
+    max_high = None
+    max_key = None
+    for low, high, key in bounds:
+        if max_high is not None and low < max_high:
+            shared_keys.add(key)
+            shared_keys.add(max_key)
+        if max_high is None or high > max_high:
+            max_high = high
+            max_key = key
+    return shared_keys
+
+
+def speaker_mvn(feat_dict, speaker_stats=None, in_place=False):
+    """
+    Perform per-speaker mean and variance normalisation.
+
+    It is assumed that each of the keys in `feat_dict` starts with a speaker
+    identifier followed by an underscore. If `speaker_stats` is not given, it
+    is accumulated from `feat_dict` using `speaker_mvn_stats`. If `in_place`
+    is True, the arrays in `feat_dict` are overwritten and no second copy of
+    the features is made. Arrays that are not floating point or that share
+    memory with another array in `feat_dict` (e.g. overlapping views of one
+    utterance) are instead replaced by normalised copies, so that no frame is
+    normalised twice.
+    """
+
+    if speaker_stats is None:
+        speaker_stats = speaker_mvn_stats(feat_dict)
 
     # Normalise per speaker
-    output_dict = {}
+    output_dict = feat_dict if in_place else {}
+    shared_keys = get_shared_keys(feat_dict) if in_place else set()
     for utt_key in tqdm(sorted(feat_dict)):
         speaker = utt_key.split("_")[0]
-        output_dict[utt_key] = (
-            (feat_dict[utt_key] - speaker_mean[speaker]) / 
-            speaker_std[speaker]
-            )
+        features = feat_dict[utt_key]
+        _, mean, std = speaker_stats[speaker]
+        mean = mean.astype(features.dtype)
+        std = std.astype(features.dtype)
+        if (in_place and utt_key not in shared_keys and
+                np.issubdtype(features.dtype, np.floating)):
+            features -= mean
+            features /= std
+        else:
+            output_dict[utt_key] = (features - mean) / std
 
     return output_dict
 
 
+class SpeakerMVNDict(object):
+    """
+    A dictionary-like view normalising features from `feat_dict` on access.
+
+    This can wrap any mapping of keys to features, e.g. a loaded NumPy archive
+    or packed archive, together with statistics from `speaker_mvn_stats` or
+    `read_speaker_stats`. Features are normalised only when they are indexed,
+    so no normalised copy of the data is kept.
+    """
+
+    def __init__(self, feat_dict, speaker_stats):
+        self.feat_dict = feat_dict
+        self.speaker_stats = speaker_stats
+
+    def keys(self):
+        return self.feat_dict.keys()
+
+    def __getitem__(self, key):
+        features = self.feat_dict[key]
+        _, mean, std = self.speaker_stats[key.split("_")[0]]
+        return (features - mean.astype(features.dtype)) / std.astype(
+            features.dtype
+            )
+
+    def __contains__(self, key):
+        return key in self.feat_dict
+
+    def __iter__(self):
+        return iter(self.feat_dict)
+
+    def __len__(self):
+        return len(self.feat_dict)
+
+
 def preemphasis(signal, coeff=0.97):
     """Perform preemphasis on the input `signal`."""    
     return np.append(signal[0], signal[1:] - coeff*signal[:-1])
+
+
+#-----------------------------------------------------------------------------#
+#                         STREAMING FEATURE EXTRACTION                        #
+#-----------------------------------------------------------------------------#
+
+class StreamingMFCCExtractor(object):
+    """
+    Extract MFCCs with deltas and double deltas from a stream of audio.
+
+    Chunks of samples of any size are passed to `process`, which returns the
+    [n_frames, d_frame] features of the frames that are complete so far; a
+    frame is complete once half a window of samples and `delta_width//2`
+    further frames have been received. At the end of the stream, `flush`
+    returns the remaining frames and resets the extractor.
+
+    Preemphasis, framing and deltas are performed as in
+    `extract_features_wav` using the NumPy engine, and if `mvn_stats` is given
+    as a (n_frames, mean, std) tuple for a speaker (as in the output of
+    `speaker_mvn_stats`), the features are normalised as in `speaker_mvn`. The
+    concatenated outputs are identical to those of the batch functions on the
+    whole signal, with one exception: the 80 dB dynamic range limit of the log
+    Mel spectrum is taken relative to the maximum so far rather than over the
+    whole signal. Frames quieter than 80 dB below the final maximum that are
+    received before the loudest audio (e.g. a quiet lead-in) are therefore
+    clipped less than by the batch functions. If `ref_db` is given, the limit
+    is instead taken relative to this fixed log Mel power in dB; the outputs
+    then do not depend on the chunking and match those of the batch functions
+    when `ref_db` is the maximum over the whole signal.
+    """
+
+    def __init__(self, sample_rate, mvn_stats=None, options_dict=None,
+            delta_width=9, ref_db=None):
+        if options_dict is None:
+            options_dict = default_options_dict
+        self.sample_rate = sample_rate
+        self.ref_db = ref_db
+        self.options_dict = options_dict
+        self.delta_width = delta_width
+        self.n_fft = int(np.floor(options_dict["win_length"]*sample_rate))
+        self.hop_length = int(
+            np.floor(options_dict["hop_length"]*sample_rate)
+            )
+        self.mel_basis = get_mel_basis(
+            sample_rate, self.n_fft, options_dict["mfcc_n_mels"],
+            options_dict["fmin"], options_dict["fmax"]
+            )
+        self.dct_matrix = get_dct_matrix(
+            options_dict["n_mfcc"], options_dict["mfcc_n_mels"]
+            )
+        if mvn_stats is not None:
+            _, self.mean, self.std = mvn_stats
+            self.mean = self.mean.astype(np.float32)
+            self.std = self.std.astype(np.float32)
+        else:
+            self.mean = None
+            self.std = None
+        self.reset()
+
+    def reset(self):
+        """Discard all buffered audio and start a new stream."""
+        self._last_sample = None
+        self._signal = np.zeros(0, dtype=np.float32)
+        self._tail = np.zeros(0, dtype=np.float32)  # last samples received
+        self._started = False
+        self._log_power_max = self.ref_db
+        self._mfcc = np.zeros((0, self.options_dict["n_mfcc"]), np.float32)
+        self._first_deltas = None
+        self._last_deltas = None
+
+    def _preemphasis(self, samples):
+        coeff = self.options_dict["preemph"]
+        if self._last_sample is None:
+            signal = preemphasis(samples, coeff)
+        else:
+            signal = samples - coeff*np.append(self._last_sample, samples[:-1])
+        self._last_sample = samples[-1:]
+        return signal
+
+    def _static_mfcc(self, frames):
+        spectrum = np.fft.rfft(frames*get_window(self.n_fft), axis=1)
+        power = (spectrum.real**2 + spectrum.imag**2).T
+        log_power = 10.0*np.log10(np.maximum(1e-10, np.dot(
+            self.mel_basis, power
+            )))
+        if self._log_power_max is None:
+            self._log_power_max = log_power.max()
+        elif self.ref_db is None:
+            self._log_power_max = max(self._log_power_max, log_power.max())
+        log_power = np.maximum(log_power, self._log_power_max - 80.0)
+        mfcc = np.dot(self.dct_matrix, log_power)
+        return np.ascontiguousarray(mfcc.T, dtype=np.float32)
+
+    def _take_frames(self, final=False):
+        """Return static MFCCs for the buffered frames that are complete."""
+        pad = self.n_fft//2
+        if final:
+            if self._started:
+                # Reflect the end of the signal, as in `frame_signal`, which
+                # can reach back into samples already framed
+                self._signal = np.append(self._signal, np.pad(
+                    self._tail, (0, pad), mode="reflect"
+                    )[len(self._tail):])
+            else:
+                self._signal = np.pad(self._signal, pad, mode="reflect")
+        elif not self._started:
+            if len(self._signal) <= pad:
+                return np.zeros((0, self._mfcc.shape[1]), np.float32)
+            self._signal = np.pad(self._signal, (pad, 0), mode="reflect")
+            self._started = True
+        if len(self._signal) < self.n_fft:
+            return np.zeros((0, self._mfcc.shape[1]), np.float32)
+        n_frames = 1 + (len(self._signal) - self.n_fft)//self.hop_length
+        frames = np.lib.stride_tricks.as_strided(
+            self._signal, shape=(n_frames, self.n_fft),
+            strides=(
+                self._signal.strides[0]*self.hop_length,
+                self._signal.strides[0]
+                ),
+            writeable=False
+            )
+        mfcc = self._static_mfcc(frames)
+        self._signal = self._signal[n_frames*self.hop_length:]
+        return mfcc
+
+    def _output(self, mfcc, delta_feats):
+        feats = np.hstack([mfcc, delta_feats[0], delta_feats[1]])
+        if self.mean is not None:
+            feats -= self.mean
+            feats /= self.std
+        return feats
+
+    def _emit(self, final=False):
+        half_width = self.delta_width//2
+        n_frames, d = self._mfcc.shape
+        if self._first_deltas is None:
+            if n_frames < self.delta_width:
+                if final:
+                    raise ValueError(
+                        "need at least {} frames to compute deltas".format(
+                        self.delta_width)
+                        )
+                return np.zeros((0, 3*d), np.float32)
+            delta_feats = valid_deltas(self._mfcc, self.delta_width)
+            self._first_deltas = delta_feats[:, :1]
+            delta_feats = np.concatenate(
+                [np.repeat(self._first_deltas, half_width, axis=1),
+                delta_feats], axis=1
+                )
+            mfcc = self._mfcc[:n_frames - half_width]
+        elif n_frames >= self.delta_width:
+            delta_feats = valid_deltas(self._mfcc, self.delta_width)
+            mfcc = self._mfcc[half_width:n_frames - half_width]
+        else:
+            delta_feats = np.zeros((2, 0, d), np.float32)
+            mfcc = np.zeros((0, d), np.float32)
+        if delta_feats.shape[1] > 0:
+            self._last_deltas = delta_feats[:, -1:]
+        if final:
+            delta_feats = np.concatenate(
+                [delta_feats,
+                np.repeat(self._last_deltas, half_width, axis=1)], axis=1
+                )
+            mfcc = np.vstack([mfcc, self._mfcc[n_frames - half_width:]])
+        else:
+            # Keep the context needed for the frames not yet output
+            n_keep = min(n_frames, self.delta_width - 1)
+            self._mfcc = self._mfcc[n_frames - n_keep:]
+        return self._output(mfcc, delta_feats)
+
+    def process(self, samples):
+        """Add `samples` to the stream and return the completed frames."""
+        samples = np.asarray(samples, dtype=np.float32)
+        if len(samples) > 0:
+            signal = self._preemphasis(samples)
+            self._signal = np.append(self._signal, signal)
+            self._tail = np.append(self._tail, signal)[-(self.n_fft//2 + 1):]
+        self._mfcc = np.vstack([self._mfcc, self._take_frames()])
+        return self._emit()
+
+    def flush(self):
+        """Return the remaining frames at the end of the stream and reset."""
+        self._mfcc = np.vstack([self._mfcc, self._take_frames(final=True)])
+        feats = self._emit(final=True)
+        self.reset()
+        return feats
+
+
+#-----------------------------------------------------------------------------#
+#                        SHARDED EXTRACTION FUNCTIONS                         #
+#-----------------------------------------------------------------------------#
+
+def get_shard_dir(output_fn, feat_type, wav_fns, options_dict=None,
+        extra=None):
+    """
+    Return the directory in which shards for `output_fn` are stored.
+
+    The directory name includes a hash of the feature type, the extraction
+    options, the audio files and any `extra` items (e.g. the VAD source), so
+    that changing any of these results in a new set of shards.
+    """
+    if options_dict is None:
+        options_dict = default_options_dict
+    hasher = hashlib.md5(repr(
+        (feat_type, sorted(options_dict.items()), sorted(wav_fns), extra)
+        ).encode("utf-8"))
+    return path.splitext(output_fn)[0] + ".shards." + hasher.hexdigest()[:10]
+
+
+def write_npz_from_shards(shard_fns, output_fn):
+    """
+    Combine the NumPy archives `shard_fns` into the archive `output_fn`.
+
+    Arrays are copied one at a time, so only a single array is kept in memory.
+    The archive is written to a temporary file which is only renamed to
+    `output_fn` once complete.
+    """
+    tmp_fn = output_fn + ".tmp"
+    with zipfile.ZipFile(
+            tmp_fn, "w", compression=zipfile.ZIP_DEFLATED,
+            allowZip64=True) as output_zf:
+        for shard_fn in shard_fns:
+            with zipfile.ZipFile(shard_fn) as shard_zf:
+                for name in shard_zf.namelist():
+                    output_zf.writestr(name, shard_zf.read(name))
+    os.rename(tmp_fn, output_fn)
+
+
+def extract_features_sharded(speaker_wav_fns, output_fns, vad_dict,
+        wav_key_to_utt_key, n_workers=1, options_dict=None, extra=None,
+        keep_shards=False):
+    """
+    Extract features per speaker into shards and combine them into archives.
+
+    The `speaker_wav_fns` dictionary gives the audio files for each speaker,
+    and `output_fns` gives the output filename for each of the feature types
+    to extract. Each audio filename without the extension is mapped to an
+    utterance key using `wav_key_to_utt_key`. For every speaker, voice active
+    regions are extracted using `vad_dict`, the features are speaker
+    normalised, and the result is written to a shard in the directory given
+    by `get_shard_dir`. Speakers for which shards already exist are skipped,
+    so an interrupted extraction can be resumed. At most one speaker's
+    features, together with the features of the `2*n_workers` files being
+    extracted ahead (see `map_wav_files`), are kept in memory. The speaker
+    normalisation statistics are written alongside each output archive. Once
+    an output archive has been written, its shard directory is removed,
+    unless `keep_shards` is True.
+    """
+
+    feat_types = sorted(output_fns)
+    all_wav_fns = []
+    for speaker in sorted(speaker_wav_fns):
+        all_wav_fns.extend(speaker_wav_fns[speaker])
+    shard_dirs = {}
+    for feat_type in feat_types:
+        shard_dirs[feat_type] = get_shard_dir(
+            output_fns[feat_type], feat_type, all_wav_fns, options_dict, extra
+            )
+        if not path.isdir(shard_dirs[feat_type]):
+            os.makedirs(shard_dirs[feat_type])
+
+    # Speakers without complete shards
+    todo_speakers = []
+    todo_wav_fns = []
+    for speaker in sorted(speaker_wav_fns):
+        if all([path.isfile(path.join(shard_dirs[feat_type], speaker +
+                ".npz")) for feat_type in feat_types]):
+            continue
+        todo_speakers.append(speaker)
+        todo_wav_fns.extend(speaker_wav_fns[speaker])
+    print(
+        "Using existing shards for", len(speaker_wav_fns) -
+        len(todo_speakers), "out of", len(speaker_wav_fns), "speakers"
+        )
+
+    # Extract shards
+    feat_iter = iter_features_files(
+        todo_wav_fns, feat_types, n_workers, options_dict
+        )
+    for speaker in todo_speakers:
+        speaker_feat_dicts = dict([(feat_type, {}) for feat_type in
+            feat_types])
+        for wav_fn in speaker_wav_fns[speaker]:
+            wav_key, feats = next(feat_iter)
+            for feat_type in feat_types:
+                speaker_feat_dicts[feat_type][wav_key_to_utt_key(wav_key)] = (
+                    feats[feat_type]
+                    )
+        for feat_type in feat_types:
+            feat_dict = extract_vad(
+                speaker_feat_dicts.pop(feat_type), vad_dict
+                )
+            speaker_stats = speaker_mvn_stats(feat_dict)
+            speaker_mvn(feat_dict, speaker_stats, in_place=True)
+            shard_fn = path.join(shard_dirs[feat_type], speaker + ".npz")
+            write_speaker_stats(
+                speaker_stats, path.join(shard_dirs[feat_type], speaker +
+                ".speaker_mvn.npz")
+                )
+            tmp_fn = path.join(shard_dirs[feat_type], speaker + ".tmp.npz")
+            np.savez_compressed(tmp_fn, **feat_dict)
+            os.rename(tmp_fn, shard_fn)
+
+    # Combine shards
+    for feat_type in feat_types:
+        output_fn = output_fns[feat_type]
+        speaker_stats = {}
+        for speaker in sorted(speaker_wav_fns):
+            speaker_stats.update(read_speaker_stats(path.join(
+                shard_dirs[feat_type], speaker + ".speaker_mvn.npz"
+                )))
+        stats_fn = path.splitext(output_fn)[0] + ".speaker_mvn.npz"
+        print("Writing:", stats_fn)
+        write_speaker_stats(speaker_stats, stats_fn)
+        print("Writing:", output_fn)
+        write_npz_from_shards([
+            path.join(shard_dirs[feat_type], speaker + ".npz") for speaker in
+            sorted(speaker_wav_fns)
+            ], output_fn)
+        if not keep_shards:
+            print("Removing:", shard_dirs[feat_type])
+            shutil.rmtree(shard_dirs[feat_type])
@@ -0,0 +1,277 @@
+"""
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from os import path
+import glob
+import librosa
+import numpy as np
+import numpy.testing as npt
+import os
+import scipy.io.wavfile as wav
+import tempfile
+
+import features
+
+
+#-----------------------------------------------------------------------------#
+#                                TEST FUNCTIONS                               #
+#-----------------------------------------------------------------------------#
+
+def get_librosa_options():
+    options_dict = dict(features.default_options_dict)
+    options_dict["engine"] = "librosa"
+    return options_dict
+
+
+def test_power_spectrum_engines():
+
+    np.random.seed(1)
+    sample_rate = 16000
+    signal = features.preemphasis(
+        np.random.randn(sample_rate).astype(np.float32)
+        )
+    power_librosa = features.power_spectrum(
+        signal, sample_rate, get_librosa_options()
+        )
+    power_numpy = features.power_spectrum(signal, sample_rate)
+
+    assert power_numpy.shape == power_librosa.shape
+    npt.assert_allclose(power_numpy, power_librosa, rtol=1e-3, atol=1e-3)
+
+
+def test_features_engines():
+
+    np.random.seed(2)
+    sample_rate = 16000
+    signal = features.preemphasis(
+        np.random.randn(sample_rate).astype(np.float32)
+        )
+    power = features.power_spectrum(signal, sample_rate, get_librosa_options())
+
+    mfcc_librosa = features.mfcc_from_power(
+        power, sample_rate, get_librosa_options()
+        )
+    mfcc_numpy = features.mfcc_from_power(power, sample_rate)
+    assert mfcc_numpy.shape == mfcc_librosa.shape
+    assert mfcc_numpy.dtype == np.float32
+    npt.assert_allclose(mfcc_numpy, mfcc_librosa, rtol=1e-4, atol=1e-3)
+
+    fbank_librosa = features.fbank_from_power(
+        power, sample_rate, get_librosa_options()
+        )
+    fbank_numpy = features.fbank_from_power(power, sample_rate)
+    npt.assert_allclose(fbank_numpy, fbank_librosa, rtol=1e-5)
+
+
+def test_deltas():
+
+    np.random.seed(3)
+    feats = np.random.randn(20, 13)
+
+    feats_deltas = features.deltas(feats)
+
+    npt.assert_array_equal(feats_deltas[:, :13], feats)
+    npt.assert_allclose(
+        feats_deltas[:, 13:26], librosa.feature.delta(feats.T).T, atol=1e-10
+        )
+    npt.assert_allclose(
+        feats_deltas[:, 26:], librosa.feature.delta(feats.T, order=2).T,
+        atol=1e-10
+        )
+
+
+def test_streaming_mfcc():
+
+    np.random.seed(4)
+    sample_rate = 16000
+    signal = np.random.randn(sample_rate).astype(np.float32)
+    power = features.power_spectrum(
+        features.preemphasis(signal), sample_rate
+        )
+    mfcc = features.mfcc_from_power(power, sample_rate)
+    mvn_stats = features.speaker_mvn_stats({"s01_a": mfcc})["s01"]
+    mfcc_mvn = features.speaker_mvn({"s01_a": mfcc}, {"s01": mvn_stats})[
+        "s01_a"
+        ]
+
+    extractor = features.StreamingMFCCExtractor(sample_rate, mvn_stats)
+    for chunk_sizes in [[len(signal)], [1]*500 + [160]*100, [3000]*6]:
+        i_start = 0
+        outputs = []
+        for chunk_size in chunk_sizes:
+            outputs.append(
+                extractor.process(signal[i_start:i_start + chunk_size])
+                )
+            i_start += chunk_size
+        outputs.append(extractor.process(signal[i_start:]))
+        outputs.append(extractor.flush())
+        npt.assert_array_equal(np.vstack(outputs), mfcc_mvn)
+
+
+def test_vad_overlapping_mvn():
+
+    np.random.seed(5)
+    utt_features = np.random.randn(400, 13).astype(np.float32)
+    feat_dict = {"s01_a": utt_features.copy()}
+    vad_dict = {"s01_a": [(100, 202), (201, 301)]}
+    vad_dict = features.extract_vad(feat_dict, vad_dict)
+    speaker_stats = features.speaker_mvn_stats(vad_dict)
+    mvn_dict = features.speaker_mvn(vad_dict, speaker_stats)
+    features.speaker_mvn(vad_dict, speaker_stats, in_place=True)
+
+    for segment_key in mvn_dict:
+        npt.assert_array_equal(vad_dict[segment_key], mvn_dict[segment_key])
+    npt.assert_array_equal(feat_dict["s01_a"], utt_features)
+
+
+def test_speaker_mvn_in_place_shared():
+
+    np.random.seed(6)
+    utt_features = np.random.randn(400, 13).astype(np.float32)
+    feat_dict = {
+        "s01_a": utt_features[100:202], "s01_b": utt_features[201:301],
+        "s01_c": utt_features[350:], "s02_a": np.random.randn(50, 13)
+        }
+    assert features.get_shared_keys(feat_dict) == set(["s01_a", "s01_b"])
+    mvn_dict = features.speaker_mvn(feat_dict)
+    features.speaker_mvn(feat_dict, in_place=True)
+
+    for utt_key in mvn_dict:
+        npt.assert_array_equal(feat_dict[utt_key], mvn_dict[utt_key])
+
+
+def test_streaming_mfcc_hop_lengths():
+
+    # With hops of more than half a window, the end of the signal is
+    # reflected into samples that have already been framed
+    np.random.seed(9)
+    sample_rate = 16000
+    for hop_length in [0.015, 0.02, 0.025]:
+        options_dict = dict(features.default_options_dict)
+        options_dict["hop_length"] = hop_length
+        for n_samples in [16000, 16123, 16200]:
+            signal = np.random.randn(n_samples).astype(np.float32)
+            power = features.power_spectrum(
+                features.preemphasis(signal), sample_rate, options_dict
+                )
+            mfcc = features.mfcc_from_power(power, sample_rate, options_dict)
+            extractor = features.StreamingMFCCExtractor(
+                sample_rate, options_dict=options_dict
+                )
+            outputs = [
+                extractor.process(signal[i:i + 1000])
+                for i in range(0, n_samples, 1000)
+                ]
+            outputs.append(extractor.flush())
+            npt.assert_array_equal(np.vstack(outputs), mfcc)
+
+def test_streaming_mfcc_quiet_lead_in():
+
+    np.random.seed(7)
+    sample_rate = 16000
+    signal = np.random.randn(sample_rate).astype(np.float32)
+    signal[:sample_rate//2] *= 1e-5
+    power = features.power_spectrum(
+        features.preemphasis(signal), sample_rate
+        )
+    mfcc = features.mfcc_from_power(power, sample_rate)
+    mel_basis = features.get_mel_basis(
+        sample_rate, power.shape[0]*2 - 2,
+        features.default_options_dict["mfcc_n_mels"],
+        features.default_options_dict["fmin"],
+        features.default_options_dict["fmax"]
+        )
+    ref_db = features.power_to_db(np.dot(mel_basis, power)).max()
+
+    def stream(extractor):
+        outputs = [
+            extractor.process(signal[i:i + 1600])
+            for i in range(0, len(signal), 1600)
+            ]
+        outputs.append(extractor.flush())
+        return np.vstack(outputs)
+
+    # The running maximum clips the quiet lead-in less than the batch
+    # functions, but frames after the loud onset are identical
+    mfcc_stream = stream(features.StreamingMFCCExtractor(sample_rate))
+    assert mfcc_stream.shape == mfcc.shape
+    i_onset = (sample_rate//2)//160
+    assert not np.allclose(mfcc_stream[:i_onset - 5], mfcc[:i_onset - 5])
+    npt.assert_array_equal(mfcc_stream[i_onset + 5:], mfcc[i_onset + 5:])
+
+    # With a fixed reference level, all frames match (up to rounding in the
+    # deltas of the constant clipped frames)
+    mfcc_stream = stream(
+        features.StreamingMFCCExtractor(sample_rate, ref_db=ref_db)
+        )
+    npt.assert_allclose(mfcc_stream, mfcc, rtol=1e-5, atol=1e-5)
+
+
+def test_extract_features_sharded():
+
+    np.random.seed(8)
+    tmp_dir = tempfile.mkdtemp()
+    speaker_wav_fns = {}
+    vad_dict = {}
+    for speaker in ["s01", "s02", "s03"]:
+        speaker_wav_fns[speaker] = []
+        for utt in ["a", "b"]:
+            wav_fn = path.join(tmp_dir, speaker + "_" + utt + ".wav")
+            wav.write(wav_fn, 16000, (
+                np.random.randn(8000)*1000
+                ).astype(np.int16))
+            speaker_wav_fns[speaker].append(wav_fn)
+            vad_dict[speaker + "_" + utt] = [(5, 20), (19, 41)]
+    output_fn = path.join(tmp_dir, "mfcc.npz")
+
+    # Non-sharded extraction
+    wav_fns = sorted(glob.glob(path.join(tmp_dir, "*.wav")))
+    feat_dict = features.extract_features_files(wav_fns, ["mfcc"])["mfcc"]
+    expected = features.speaker_mvn(features.extract_vad(feat_dict, vad_dict))
+
+    # Interrupted extraction, after the shard of the first speaker
+    def interrupted_key(wav_key):
+        if wav_key.startswith("s02"):
+            raise KeyboardInterrupt
+        return wav_key
+    try:
+        features.extract_features_sharded(
+            speaker_wav_fns, {"mfcc": output_fn}, vad_dict, interrupted_key
+            )
+    except KeyboardInterrupt:
+        pass
+    assert not path.isfile(output_fn)
+    shard_fns = glob.glob(path.join(tmp_dir, "mfcc.shards.*", "*.npz"))
+    assert sorted([path.basename(fn) for fn in shard_fns]) == [
+        "s01.npz", "s01.speaker_mvn.npz"
+        ]
+    shard_mtime = os.stat(shard_fns[0]).st_mtime_ns
+
+    # Resumed extraction skips the finished speaker
+    features.extract_features_sharded(
+        speaker_wav_fns, {"mfcc": output_fn}, vad_dict, lambda key: key,
+        keep_shards=True
+        )
+    assert os.stat(shard_fns[0]).st_mtime_ns == shard_mtime
+    output_npz = np.load(output_fn)
+    assert sorted(output_npz.keys()) == sorted(expected)
+    for key in expected:
+        npt.assert_array_equal(output_npz[key], expected[key])
+
+    # A full run over two processes without keeping shards gives the same
+    # archive
+    os.remove(output_fn)
+    shard_dir = path.dirname(shard_fns[0])
+    for fn in glob.glob(path.join(shard_dir, "*")):
+        os.remove(fn)
+    features.extract_features_sharded(
+        speaker_wav_fns, {"mfcc": output_fn}, vad_dict, lambda key: key,
+        n_workers=2
+        )
+    assert not path.isdir(shard_dir)
+    output_npz = np.load(output_fn)
+    for key in expected:
+        npt.assert_array_equal(output_npz[key], expected[key])
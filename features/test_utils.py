@@ -0,0 +1,150 @@
+"""
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from os import path
+import numpy as np
+import numpy.testing as npt
+import os
+import shutil
+import tempfile
+
+import utils
+
+
+#-----------------------------------------------------------------------------#
+#                                TEST FUNCTIONS                               #
+#-----------------------------------------------------------------------------#
+
+def test_cut_segments():
+
+    np.random.seed(1)
+    input_npz = {
+        "s01_01a_000010-000060": np.random.randn(50, 13),
+        "s01_01a_000060-000100": np.random.randn(40, 13),
+        "s01_01a_000150-000200": np.random.randn(50, 13),
+        "s02_01b_000000-000100": np.random.randn(100, 13),
+        }
+    target_segs = {
+        "about_s01_01a_000020-000030": ("s01_01a", 20, 30),
+        "because_s01_01a_000060-000070": ("s01_01a", 60, 70),
+        "people_s01_01a_000120-000130": ("s01_01a", 120, 130),
+        "years_s01_01a_000160-000190": ("s01_01a", 160, 190),
+        "years_s02_01b_000050-000090": ("s02_01b", 50, 90),
+        "years_s03_01a_000050-000090": ("s03_01a", 50, 90),
+        }
+
+    segments = utils.cut_segments(input_npz, target_segs)
+
+    assert list(segments.keys()) == [
+        "about_s01_01a_000020-000030", "because_s01_01a_000060-000070",
+        "years_s01_01a_000160-000190", "years_s02_01b_000050-000090"
+        ]
+    npt.assert_array_equal(
+        segments["about_s01_01a_000020-000030"],
+        input_npz["s01_01a_000010-000060"][10:20]
+        )
+    # A start on the boundary of two segments uses the first segment
+    npt.assert_array_equal(
+        segments["because_s01_01a_000060-000070"],
+        input_npz["s01_01a_000010-000060"][50:60]
+        )
+    npt.assert_array_equal(
+        segments["years_s01_01a_000160-000190"],
+        input_npz["s01_01a_000150-000200"][10:40]
+        )
+    npt.assert_array_equal(
+        segments["years_s02_01b_000050-000090"],
+        input_npz["s02_01b_000000-000100"][50:90]
+        )
+
+
+def test_strip_nonvad_terms():
+
+    vad_dict = {
+        "s01_01a": [(10, 50), (60, 100), (100, 120)],
+        "s02_01b": [(0, 30)],
+        "s03_01a": [],
+        }
+    terms = [
+        ("s01_01a", 0, 20), ("s01_01a", 40, 70), ("s01_01a", 45, 75),
+        ("s01_01a", 50, 60), ("s01_01a", 90, 115), ("s02_01b", 20, 40),
+        ("s02_01b", 40, 50), ("s03_01a", 0, 10), ("s01_01a", 30, 30),
+        ]
+    utts = [i[0] for i in terms]
+    starts = np.array([i[1] for i in terms])
+    ends = np.array([i[2] for i in terms])
+
+    nonvad_starts, nonvad_ends, mask = utils.strip_nonvad_terms(
+        vad_dict, utts, starts, ends
+        )
+
+    for i, (utt, start, end) in enumerate(terms):
+        nonvad_indices = utils.strip_nonvad(utt, start, end, vad_dict[utt])
+        if nonvad_indices is None:
+            assert not mask[i]
+        else:
+            assert mask[i]
+            assert (nonvad_starts[i], nonvad_ends[i]) == nonvad_indices
+
+
+def test_read_fa():
+
+    fa_lines = [
+        "s0101a 0.00 0.125 SIL", "s0101a 0.125 0.375 hello",
+        "s0101a 0.375 1.00 because", "s0101a 1.00 1.20 SIL",
+        "s0101a 1.20 1.80 together", "s0102b 0.10 0.70 about",
+        "s0102b 0.70 0.75 SPN",
+        ]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fa_fn = path.join(tmp_dir, "test.wrd")
+        with open(fa_fn, "w") as f:
+            f.write("\n".join(fa_lines) + "\n")
+
+        fa = utils.read_fa(fa_fn)
+        assert fa["utterances"].tolist() == ["s0101a", "s0102b"]
+        npt.assert_array_equal(fa["utterance_ids"], [0, 0, 0, 0, 0, 1, 1])
+        assert fa["labels"][fa["label_ids"]].tolist() == [
+            line.split()[3] for line in fa_lines
+            ]
+        npt.assert_array_equal(fa["ends"], [
+            float(line.split()[2]) for line in fa_lines
+            ])
+        assert path.isfile(fa_fn + ".cache.npz")
+
+        # Frames are rounded half to even (12.5 to 12, 37.5 to 38)
+        vad_dict = utils.read_vad_from_fa(fa_fn)
+        assert vad_dict == {
+            "s01_01a": [(12, 101), (120, 181)], "s01_02b": [(10, 71)]
+            }
+        list_fn = path.join(tmp_dir, "samediff.list")
+        utils.write_samediff_words(fa_fn, list_fn)
+        with open(list_fn) as f:
+            assert f.read().split() == [
+                "because_s01_01a_000038-000101",
+                "together_s01_01a_000120-000181",
+                "about_s01_02b_000010-000071"
+                ]
+
+        # The sidecar is refreshed when the file changes, also if its size
+        # stays the same
+        fa_stat = os.stat(fa_fn)
+        for old_label, new_label in [("hello", "hi"), ("about", "abort")]:
+            fa_lines = [
+                line.replace(old_label, new_label) for line in fa_lines
+                ]
+            with open(fa_fn, "w") as f:
+                f.write("\n".join(fa_lines) + "\n")
+            os.utime(fa_fn, (fa_stat.st_atime, fa_stat.st_mtime + 10))
+            fa_stat = os.stat(fa_fn)
+            fa = utils.read_fa(fa_fn)
+            assert new_label in fa["labels"].tolist()
+            assert old_label not in fa["labels"].tolist()
+            with np.load(fa_fn + ".cache.npz") as cache:
+                assert cache["mtime"] == fa_stat.st_mtime
+                assert new_label in cache["labels"].tolist()
+    finally:
+        shutil.rmtree(tmp_dir)
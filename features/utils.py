@@ -6,8 +6,11 @@ Contact: kamperh@gmail.com
 Date: 2019
 """
 
+from os import path
 from tqdm import tqdm
 import numpy as np
+import os
+import zipfile
 
 
 def uttlabel_to_uttkey(utterance):
@@ -22,60 +25,109 @@ def uttlabel_to_uttkey(utterance):
     return utt_key
 
 
+def read_fa(fa_fn, use_cache=True):
+    """
+    Read a forced alignment file into columnar arrays.
+
+    A dictionary is returned with "utterances" and "labels" giving the unique
+    utterance and token labels, and with "utterance_ids", "label_ids",
+    "starts" and "ends" giving, for each line in the file, the index of the
+    utterance and token label and the start and end times in seconds. If
+    `use_cache` is True, the arrays are cached in a sidecar file next to
+    `fa_fn` which is used as long as the modification time and size of `fa_fn`
+    are unchanged. The sidecar is written to a temporary file which is then
+    renamed, and is rebuilt if it cannot be read.
+    """
+
+    cache_fn = fa_fn + ".cache.npz"
+    fa_stat = os.stat(fa_fn)
+    if use_cache and path.isfile(cache_fn):
+        try:
+            with np.load(cache_fn) as cache:
+                if (cache["mtime"] == fa_stat.st_mtime and cache["size"] ==
+                        fa_stat.st_size):
+                    return dict([
+                        (key, cache[key]) for key in cache.keys() if key not
+                        in ["mtime", "size"]
+                        ])
+        except (IOError, OSError, EOFError, KeyError, ValueError,
+                zipfile.BadZipFile):
+            pass  # damaged sidecar, rebuilt below
+
+    with open(fa_fn, "r") as f:
+        tokens = f.read().split()
+    fa = {}
+    for name, column in [("utterance", tokens[0::4]), ("label", tokens[3::4])]:
+        codes = {}
+        fa[name + "_ids"] = np.array(
+            [codes.setdefault(i, len(codes)) for i in column], dtype=np.int32
+            )
+        fa[name + "s"] = np.array(sorted(codes, key=codes.get))
+    fa["starts"] = np.array(tokens[1::4], dtype=np.float64)
+    fa["ends"] = np.array(tokens[2::4], dtype=np.float64)
+
+    if use_cache:
+        tmp_fn = cache_fn[:-len(".npz")] + ".tmp{}.npz".format(os.getpid())
+        try:
+            np.savez_compressed(
+                tmp_fn, mtime=fa_stat.st_mtime, size=fa_stat.st_size, **fa
+                )
+            os.rename(tmp_fn, cache_fn)
+        except (IOError, OSError):
+            if path.isfile(tmp_fn):
+                os.remove(tmp_fn)
+    return fa
+
+
+def get_word_mask(fa):
+    """Return a mask of the lines in `fa` that are not silence or noise."""
+    nonword_ids = [
+        i for i, label in enumerate(fa["labels"]) if label in ["SIL", "SPN"]
+        ]
+    return ~np.isin(fa["label_ids"], nonword_ids)
+
+
 def read_vad_from_fa(fa_fn, frame_indices=True):
     """
     Read voice activity detected (VAD) regions from a forced alignment file.
 
     The dictionary has utterance labels as keys and as values the speech
     regions as lists of tuples of (start, end) frame, with the end excluded.
+    A region is a run of consecutive words in an utterance with each word
+    starting where the previous one ends.
     """
-    vad_dict = {}
-    prev_utterance = ""
-    prev_token_label = ""
-    prev_end_time = -1
-    start_time = -1
-    with open(fa_fn, "r") as f:
-        for line in f:
-            utterance, start_token, end_token, token_label = line.strip(
-                ).split()
-            start_token = float(start_token)
-            end_token = float(end_token)
-            # utterance = utterance.replace("_", "-")
-            utt_key = uttlabel_to_uttkey(utterance)
-            # utt_key = utterance[0:3] + "_" + utterance[3:]
-            if utt_key not in vad_dict:
-                vad_dict[utt_key] = []
-
-            if token_label in ["SIL", "SPN"]:
-                continue
-            if prev_end_time != start_token or prev_utterance != utterance:
-                if prev_end_time != -1:
-                    utt_key = uttlabel_to_uttkey(prev_utterance)
-                    # utt_key = prev_utterance[0:3] + "_" + prev_utterance[3:]
-                    if frame_indices:
-                        # Convert time to frames
-                        start = int(round(start_time * 100))
-                        end = int(round(prev_end_time * 100)) + 1
-                        vad_dict[utt_key].append((start, end))
-                    else:
-                        vad_dict[utt_key].append(
-                            (start_time, prev_end_time)
-                            )
-                start_time = start_token
-
-            prev_end_time = end_token
-            prev_token_label = token_label
-            prev_utterance = utterance
-
-        utt_key = uttlabel_to_uttkey(prev_utterance)
-        # utt_key = prev_utterance[0:3] + "_" + prev_utterance[3:]
-        if frame_indices:
-            # Convert time to frames
-            start = int(round(start_time * 100))
-            end = int(round(prev_end_time * 100)) + 1  # end index excluded
-            vad_dict[utt_key].append((start, end))
-        else:
-            vad_dict[utt_key].append((start_time, prev_end_time))        
+    fa = read_fa(fa_fn)
+    vad_dict = dict([
+        (uttlabel_to_uttkey(utterance), []) for utterance in fa["utterances"]
+        ])
+
+    # Find the first and last word of each region
+    word_mask = get_word_mask(fa)
+    utterance_ids = fa["utterance_ids"][word_mask]
+    starts = fa["starts"][word_mask]
+    ends = fa["ends"][word_mask]
+    if len(starts) == 0:
+        return vad_dict
+    region_breaks = np.ones(len(starts), dtype=bool)
+    region_breaks[1:] = (
+        (ends[:-1] != starts[1:]) | (utterance_ids[:-1] != utterance_ids[1:])
+        )
+    i_firsts = np.flatnonzero(region_breaks)
+    i_lasts = np.append(i_firsts[1:] - 1, len(starts) - 1)
+
+    region_starts = starts[i_firsts]
+    region_ends = ends[i_lasts]
+    if frame_indices:
+        # Convert time to frames
+        region_starts = np.round(region_starts*100).astype(int)
+        region_ends = np.round(region_ends*100).astype(int) + 1  # end excluded
+    utt_keys = [
+        uttlabel_to_uttkey(utterance) for utterance in fa["utterances"]
+        ]
+    for utterance_id, start, end in zip(
+            utterance_ids[i_firsts], region_starts.tolist(),
+            region_ends.tolist()):
+        vad_dict[utt_keys[utterance_id]].append((start, end))
     return vad_dict
 
 
@@ -87,60 +139,92 @@ def write_samediff_words(fa_fn, output_fn, min_frames=50, min_chars=5):
     written to the word list file `output_fn`.
     """
     print("Reading:", fa_fn)
-    words = []
-    with open(fa_fn, "r") as f:
-        for line in f:
-            utterance, start, end, label = line.strip().split()
-            # utterance = utterance.replace("_", "-")
-            start = float(start)
-            end = float(end)
-            if label in ["SIL", "SPN"]:
-                continue
-            words.append((utterance, label, (start, end)))
+    fa = read_fa(fa_fn)
+    word_mask = get_word_mask(fa)
 
     print("Finding same-different word tokens")
-    words_50fr5ch = []
-    for utterance, label, (start, end) in words:
-        start_frame = int(round(float(start) * 100))
-        end_frame = int(round(float(end) * 100))
-        if end_frame - start_frame >= min_frames and len(label) >= min_chars:
-            words_50fr5ch.append((utterance, label, (start_frame, end_frame)))
-    print("No. tokens:", len(words_50fr5ch), "out of", len(words))
+    start_frames = np.round(fa["starts"]*100).astype(int)
+    end_frames = np.round(fa["ends"]*100).astype(int)
+    label_lengths = np.array([len(label) for label in fa["labels"]])
+    samediff_mask = (
+        word_mask & (end_frames - start_frames >= min_frames) &
+        (label_lengths[fa["label_ids"]] >= min_chars)
+        )
+    print(
+        "No. tokens:", np.sum(samediff_mask), "out of", np.sum(word_mask)
+        )
 
     # if not path.isdir(output_dir):
     #     os.makedirs(output_dir)
     print("Writing:", output_fn)
+    utt_keys = [
+        uttlabel_to_uttkey(utterance) for utterance in fa["utterances"]
+        ]
     with open(output_fn, "w") as f:
-        for utterance, label, (start, end) in words_50fr5ch:
-            utt_key = uttlabel_to_uttkey(utterance)
-            # utt_key = utterance[0:3] + "_" + utterance[3:]
+        for utterance_id, label_id, start, end in zip(
+                fa["utterance_ids"][samediff_mask],
+                fa["label_ids"][samediff_mask],
+                start_frames[samediff_mask], end_frames[samediff_mask]):
             f.write(
-                label + "_" + utt_key + "_%06d-%06d\n" % (int(round(start)),
-                int(round(end)) + 1)
+                fa["labels"][label_id] + "_" + utt_keys[utterance_id] +
+                "_%06d-%06d\n" % (start, end + 1)
                 )
 
 
-def segments_from_npz(input_npz_fn, segments_fn, output_npz_fn):
+class SegmentIndex(object):
     """
-    Cut segments from a NumPy archive and save in a new archive.
+    An index of the voice active segments of each utterance.
 
-    As keys, the archives use the format "label_spkr_utterance_start-end".
+    The segment keys have the format "spkr_utterance_start-end". For each
+    utterance the segments are kept as arrays sorted by start frame, so the
+    segment containing a particular frame is found with a binary search.
     """
 
-    # Read the .npz file
-    print("Reading npz:", input_npz_fn)
-    input_npz = np.load(input_npz_fn)
-
-    # Create input npz segments dict
-    utterance_segs = {}  # utterance_segs["s08_02b_029657-029952"]
-                         # is (29657, 29952)
-    for key in input_npz.keys():
-        utterance_segs[key] = tuple(
-            [int(i) for i in key.split("_")[-1].split("-")]
-            )
+    def __init__(self, segment_keys):
+        utterance_segs = {}
+        for key in segment_keys:
+            utterance, interval = key.rsplit("_", 1)
+            start, end = interval.split("-")
+            if utterance not in utterance_segs:
+                utterance_segs[utterance] = []
+            utterance_segs[utterance].append((int(start), int(end), key))
+        self.starts = {}
+        self.ends = {}
+        self.keys = {}
+        for utterance in utterance_segs:
+            segs = sorted(utterance_segs[utterance])
+            self.starts[utterance] = np.array([i[0] for i in segs])
+            self.ends[utterance] = np.array([i[1] for i in segs])
+            self.keys[utterance] = [i[2] for i in segs]
+
+    def find(self, utterance, frames):
+        """
+        Return the indices of the segments of `utterance` containing `frames`.
+
+        A segment contains a frame if it is within the segment's start and end
+        frames, both inclusive. Where a frame falls in more than one segment,
+        the segment starting first is used. An index of -1 is returned for a
+        frame not in any segment.
+        """
+        frames = np.asarray(frames)
+        if utterance not in self.starts:
+            return -np.ones(len(frames), dtype=np.int64)
+        starts = self.starts[utterance]
+        ends = self.ends[utterance]
+        indices = np.searchsorted(ends, frames, side="left")
+        valid = indices < len(ends)
+        valid[valid] = starts[indices[valid]] <= frames[valid]
+        indices[~valid] = -1
+        return indices
+
+
+def read_segments(segments_fn):
+    """
+    Read a segment list and return a dict of (utterance, start, end) tuples.
 
-    # Create target segments dict
-    print("Reading segments:", segments_fn)
+    Each line in the list gives a key in the format
+    "label_spkr_utterance_start-end", which is also the dictionary key.
+    """
     target_segs = {}  # target_segs["years_s01_01a_004951-005017"]
                       # is ("s01_01a", 4951, 5017)
     for line in open(segments_fn):
@@ -150,24 +234,76 @@ def segments_from_npz(input_npz_fn, segments_fn, output_npz_fn):
         start = int(start)
         end = int(end)
         target_segs[line.strip()] = (utterance, start, end)
+    return target_segs
 
-    print("Extracting segments:")
-    output_npz = {}
-    n_target_segs = 0
-    for target_seg_key in tqdm(sorted(target_segs)):
+
+def cut_segments(input_npz, target_segs):
+    """
+    Cut all the `target_segs` from the utterance segments in `input_npz`.
+
+    The `input_npz` can be any dictionary-like mapping of utterance segment
+    keys to features, and `target_segs` is the output of `read_segments`. All
+    the targets are looked up in a `SegmentIndex` at once, and each utterance
+    segment is read only once irrespective of the number of targets it
+    contains. A dictionary with the targets found is returned, with keys
+    inserted in sorted order.
+    """
+
+    index = SegmentIndex(input_npz.keys())
+
+    # Find the utterance segment containing each target
+    utterance_targets = {}
+    for target_seg_key in target_segs:
         utterance, target_start, target_end = target_segs[target_seg_key]
-        for utterance_key in [
-                i for i in utterance_segs.keys() if i.startswith(utterance)]:
-            utterannce_start, utterance_end = utterance_segs[utterance_key]
-            if (target_start >= utterannce_start and target_start <=
-                    utterance_end):
-                start = target_start - utterannce_start
-                end = target_end - utterannce_start
-                output_npz[target_seg_key] = input_npz[
-                    utterance_key
-                    ][start:end]
-                n_target_segs += 1
-                break
+        if utterance not in utterance_targets:
+            utterance_targets[utterance] = []
+        utterance_targets[utterance].append(target_seg_key)
+    segment_targets = {}  # segment_targets["s08_02b_029657-029952"] is a list
+                          # of the target keys in that segment
+    for utterance in utterance_targets:
+        target_keys = utterance_targets[utterance]
+        indices = index.find(
+            utterance, [target_segs[i][1] for i in target_keys]
+            )
+        for target_seg_key, i_seg in zip(target_keys, indices):
+            if i_seg == -1:
+                continue
+            utterance_key = index.keys[utterance][i_seg]
+            if utterance_key not in segment_targets:
+                segment_targets[utterance_key] = []
+            segment_targets[utterance_key].append(target_seg_key)
+
+    # Slice the targets
+    segments = {}
+    for utterance_key in tqdm(sorted(segment_targets)):
+        features = input_npz[utterance_key]
+        utterance_start = int(utterance_key.split("_")[-1].split("-")[0])
+        for target_seg_key in segment_targets[utterance_key]:
+            _, target_start, target_end = target_segs[target_seg_key]
+            segments[target_seg_key] = features[
+                target_start - utterance_start:target_end - utterance_start
+                ]
+    return dict([(key, segments[key]) for key in sorted(segments)])
+
+
+def segments_from_npz(input_npz_fn, segments_fn, output_npz_fn):
+    """
+    Cut segments from a NumPy archive and save in a new archive.
+
+    As keys, the archives use the format "label_spkr_utterance_start-end".
+    """
+
+    # Read the .npz file
+    print("Reading npz:", input_npz_fn)
+    input_npz = np.load(input_npz_fn)
+
+    # Create target segments dict
+    print("Reading segments:", segments_fn)
+    target_segs = read_segments(segments_fn)
+
+    print("Extracting segments:")
+    output_npz = cut_segments(input_npz, target_segs)
+    n_target_segs = len(output_npz)
 
     print(
         "Extracted " + str(n_target_segs) + " out of " + str(len(target_segs))
@@ -223,8 +359,216 @@ def strip_nonvad(utt, start, end, vads):
     return (start, end)
 
 
+def read_pairs(pairs_fn):
+    """
+    Read a UTD pair file into arrays.
+
+    Both Aren's format (with cluster and speaker fields) and Sameer's format
+    (with times in seconds) are read. A dictionary is returned with
+    "clusters", "utt1", "utt2" as lists and "start1", "end1", "start2" and
+    "end2" as arrays of frame indices.
+    """
+    pairs = dict([
+        (key, []) for key in ["clusters", "utt1", "start1", "end1", "utt2",
+        "start2", "end2"]
+        ])
+    utt_keys = {}
+    for line in open(pairs_fn):
+        line = line.strip().split(" ")
+        if len(line) == 9:
+            # Aren's format
+            (
+                cluster, utt1, speaker1, start1, end1, utt2, speaker2, start2,
+                end2
+            ) = line
+            for utt in [utt1, utt2]:
+                if utt not in utt_keys:
+                    utt_keys[utt] = uttlabel_to_uttkey(utt)
+            utt1 = utt_keys[utt1]
+            utt2 = utt_keys[utt2]
+            start1 = int(start1)
+            end1 = int(end1)
+            start2 = int(start2)
+            end2 = int(end2)
+        elif len(line) == 6:
+            # Sameer's format
+            utt1, start1, end1, utt2, start2, end2 = line
+            cluster = "?"
+            start1 = int(np.floor(float(start1)*100))
+            end1 = int(np.floor(float(end1)*100))
+            start2 = int(np.floor(float(start2)*100))
+            end2 = int(np.floor(float(end2)*100))
+        else:
+            continue
+        pairs["clusters"].append(cluster)
+        pairs["utt1"].append(utt1)
+        pairs["start1"].append(start1)
+        pairs["end1"].append(end1)
+        pairs["utt2"].append(utt2)
+        pairs["start2"].append(start2)
+        pairs["end2"].append(end2)
+    for key in ["start1", "end1", "start2", "end2"]:
+        pairs[key] = np.array(pairs[key], dtype=np.int64)
+    return pairs
+
+
+def strip_nonvad_terms(vad_dict, utts, starts, ends):
+    """
+    Strip non-VAD regions from many terms at once.
+
+    This gives the same result as calling `strip_nonvad` for each term, with
+    term `i` in utterance `utts[i]` from frame `starts[i]` to `ends[i]`. The
+    VAD regions of all the utterances are concatenated into sorted arrays
+    (with each utterance offset so that its regions come after those of the
+    previous one), and the regions overlapping each term are found using
+    `searchsorted`. Updated start and end arrays are returned, together with
+    a mask which is False for terms not falling in a VAD region.
+    """
+
+    # Sorted VAD regions of all the utterances, offset per utterance
+    utt_ids = {}
+    vad_starts = []
+    vad_ends = []
+    for utt in sorted(set(utts)):
+        utt_ids[utt] = len(utt_ids)
+        vads = sorted(vad_dict[utt])
+        vad_starts.extend([i[0] for i in vads])
+        vad_ends.extend([i[1] for i in vads])
+    vad_starts = np.array(vad_starts, dtype=np.int64)
+    vad_ends = np.array(vad_ends, dtype=np.int64)
+    max_frame = max(
+        [1] + [np.max(i) + 1 for i in [vad_starts, vad_ends, starts, ends] if
+        len(i) > 0]
+        )
+    offset = 2*max_frame  # larger than any difference between frames
+    term_offsets = np.array([utt_ids[utt] for utt in utts], dtype=np.int64)
+    term_offsets = term_offsets*offset + offset
+    vad_offsets = np.repeat(
+        np.arange(len(utt_ids), dtype=np.int64)*offset + offset,
+        [len(vad_dict[utt]) for utt in sorted(utt_ids)]
+        )
+
+    # Candidate regions [lower, upper) overlapping each term
+    lower = np.searchsorted(
+        vad_ends + vad_offsets, starts + term_offsets, side="right"
+        )
+    upper = np.searchsorted(
+        vad_starts + vad_offsets, ends + term_offsets, side="left"
+        )
+    counts = np.maximum(upper - lower, 0)
+
+    # Overlap of each term with each of its candidate regions
+    i_terms = np.repeat(np.arange(len(starts)), counts)
+    i_vads = (
+        np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts,
+        counts) + np.repeat(lower, counts)
+        )
+    overlaps = (
+        np.minimum(ends[i_terms], vad_ends[i_vads]) -
+        np.maximum(starts[i_terms], vad_starts[i_vads])
+        )
+
+    # Region with maximum overlap, taking the first region for ties
+    has_vads = counts > 0
+    group_starts = (np.cumsum(counts) - counts)[has_vads]
+    max_overlaps = np.zeros(len(starts), dtype=np.int64)
+    i_max_vads = -np.ones(len(starts), dtype=np.int64)
+    if len(overlaps) > 0:
+        max_overlaps[has_vads] = np.maximum.reduceat(overlaps, group_starts)
+        is_max = overlaps == max_overlaps[i_terms]
+        first_max = np.where(is_max, i_vads, len(vad_starts))
+        i_max_vads[has_vads] = np.minimum.reduceat(first_max, group_starts)
+
+    # Now strip non-VAD regions
+    mask = max_overlaps > 0
+    nonvad_starts = starts.copy()
+    nonvad_ends = ends.copy()
+    nonvad_starts[mask] = np.maximum(
+        starts[mask], vad_starts[i_max_vads[mask]]
+        )
+    nonvad_ends[mask] = np.minimum(ends[mask], vad_ends[i_max_vads[mask]])
+
+    # Terms with no positive overlap (e.g. with end before start) are rare
+    for i in np.flatnonzero(has_vads & ~mask):
+        nonvad_indices = strip_nonvad(
+            utts[i], starts[i], ends[i], vad_dict[utts[i]]
+            )
+        if nonvad_indices is not None:
+            mask[i] = True
+            nonvad_starts[i], nonvad_ends[i] = nonvad_indices
+
+    return nonvad_starts, nonvad_ends, mask
+
+
+def batch_strip_nonvad_from_pairs(vad_dict, input_pairs_fn, output_pairs_fn):
+    """
+    Strip non-VAD regions from the terms in a UTD pair file.
+
+    Pairs with a term not in a VAD region or with overlapping terms from the
+    same utterance are removed. All the pairs are read into arrays and the
+    terms are processed together using `strip_nonvad_terms`.
+    """
+
+    print("Reading:", input_pairs_fn)
+    pairs = read_pairs(input_pairs_fn)
+    utt1 = pairs["utt1"]
+    utt2 = pairs["utt2"]
+    start1 = pairs["start1"]
+    end1 = pairs["end1"]
+    start2 = pairs["start2"]
+    end2 = pairs["end2"]
+
+    # Utterances missing from forced alignments
+    keep = np.array([
+        utt1[i] != "s01_03a" and utt2[i] != "s01_03a" for i in
+        range(len(utt1))
+        ], dtype=bool)
+
+    # Pairs from overlapping speech
+    same_utt = np.array(
+        [utt1[i] == utt2[i] for i in range(len(utt1))], dtype=bool
+        )
+    keep &= ~(same_utt & (
+        ((start2 <= start1) & (start1 <= end2)) |
+        ((start2 <= end1) & (end1 <= end2))
+        ))
+
+    # Strip the terms from both sides of the pairs together
+    i_keep = np.flatnonzero(keep)
+    utts = [utt1[i] for i in i_keep] + [utt2[i] for i in i_keep]
+    nonvad_starts, nonvad_ends, mask = strip_nonvad_terms(
+        vad_dict, utts, np.concatenate([start1[i_keep], start2[i_keep]]),
+        np.concatenate([end1[i_keep], end2[i_keep]])
+        )
+    n_keep = len(i_keep)
+    mask = mask[:n_keep] & mask[n_keep:]
+
+    print("Writing:", output_pairs_fn)
+    with open(output_pairs_fn, "w") as f:
+        f.write("".join([
+            pairs["clusters"][i] + " " + utt1[i] + " " + str(nonvad_starts[j])
+            + " " + str(nonvad_ends[j]) + " " + utt2[i] + " " +
+            str(nonvad_starts[n_keep + j]) + " " + str(nonvad_ends[n_keep + j])
+            + "\n" for j, i in enumerate(i_keep) if mask[j]
+            ]))
+    print("Wrote", np.sum(mask), "out of", len(utt1), "pairs")
+
+
 def strip_nonvad_from_pairs(vad_dict, input_pairs_fn, output_pairs_fn,
         log=False):
+    """
+    Strip non-VAD regions from the terms in a UTD pair file.
+
+    If `log` is True, each pair is processed in turn with details (including
+    sox play commands) printed for each term; otherwise all the pairs are
+    processed at once using `batch_strip_nonvad_from_pairs`.
+    """
+
+    if not log:
+        batch_strip_nonvad_from_pairs(
+            vad_dict, input_pairs_fn, output_pairs_fn
+            )
+        return
 
     # Now keep only VAD regions
     if log:
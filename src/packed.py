@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+Packed feature archives with memory-mapped loading.
+
+A packed archive is a directory replacing a NumPy archive of per-utterance
+feature matrices. It contains `frames.npy`, the frames of all the utterances
+stacked into a single contiguous float32 matrix, and `index.npz`, giving the
+sorted utterance keys and the offset of each utterance into the frames. The
+frame matrix is memory-mapped on loading, so only the utterances that are
+used are read from disk, and processes loading the same archive share the
+same pages.
+
+Run this script to convert an existing NumPy archive to a packed archive.
+
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+import argparse
+import numpy as np
+import os
+import sys
+import threading
+import zipfile
+
+FRAMES_FN = "frames.npy"
+INDEX_FN = "index.npz"
+
+
+#-----------------------------------------------------------------------------#
+#                            PACKED ARCHIVE CLASS                             #
+#-----------------------------------------------------------------------------#
+
+class PackedArchive(object):
+    """
+    A read-only, dictionary-like packed archive.
+
+    As for a loaded NumPy archive, iterating over the archive gives the keys
+    and indexing with a key gives the features for that key. The features are
+    views into the memory-mapped frame matrix `frames`; the utterance with
+    index `i` in `keys()` is `frames[offsets[i]:offsets[i + 1]]`. If the
+    archive was created from one-dimensional items (e.g. embeddings), each
+    item is a single row of `frames`.
+    """
+
+    def __init__(self, packed_dir, mmap_mode="r"):
+        self.packed_dir = packed_dir
+        index = np.load(path.join(packed_dir, INDEX_FN))
+        self._keys = [str(key) for key in index["keys"]]
+        self.offsets = index["offsets"]
+        self.item_ndim = int(index["item_ndim"])
+        self.lengths = np.diff(self.offsets)
+        self.frames = np.load(
+            path.join(packed_dir, FRAMES_FN), mmap_mode=mmap_mode
+            )
+        self._key_to_index = dict(
+            [(key, i) for i, key in enumerate(self._keys)]
+            )
+
+    def keys(self):
+        return list(self._keys)
+
+    def get_index(self, i):
+        """Return the features of the item at position `i` in `keys()`."""
+        if self.item_ndim == 1:
+            return self.frames[i]
+        return self.frames[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, key):
+        return self.get_index(self._key_to_index[key])
+
+    def __contains__(self, key):
+        return key in self._key_to_index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def items(self):
+        for i, key in enumerate(self._keys):
+            yield (key, self.get_index(i))
+
+
+#-----------------------------------------------------------------------------#
+#                              UTILITY FUNCTIONS                              #
+#-----------------------------------------------------------------------------#
+
+def is_packed(fn):
+    """Return True if `fn` is a packed archive directory."""
+    return path.isfile(path.join(fn, INDEX_FN))
+
+
+def load(fn, mmap_mode="r"):
+    """
+    Load either a packed archive or a NumPy archive.
+
+    Both the returned types can be used as a dictionary of features.
+    """
+    if is_packed(fn):
+        return PackedArchive(fn, mmap_mode=mmap_mode)
+    return np.load(fn)
+
+
+def read_npy_header(f):
+    """Return the shape, Fortran order and dtype in the header of `f`."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def read_npz_shapes(npz_fn):
+    """
+    Return a dict with the shape of each array in the NumPy archive `npz_fn`.
+
+    Only the header of each array is read from the archive, so the data
+    itself is not decompressed.
+    """
+    shapes = {}
+    with zipfile.ZipFile(npz_fn) as zf:
+        for name in zf.namelist():
+            if not name.endswith(".npy"):
+                continue
+            with zf.open(name) as f:
+                shape, _, _ = read_npy_header(f)
+            shapes[name[:-len(".npy")]] = shape
+    return shapes
+
+
+def read_index(fn, use_cache=True):
+    """
+    Return the keys and item shapes of an archive without reading any data.
+
+    A dictionary is returned with the sorted "keys" and with "lengths" and
+    "dims" giving the number of rows (1 for one-dimensional items) and the
+    dimensionality of each item. For a packed archive these are taken from
+    its index, and for a NumPy archive from the npy headers of its members.
+    If `use_cache` is True, the index of a NumPy archive is cached in a
+    sidecar file next to `fn` which is used as long as the modification time
+    and size of `fn` are unchanged. The sidecar is written to a temporary file
+    which is then renamed, and is rebuilt if it cannot be read.
+    """
+
+    if is_packed(fn):
+        archive = PackedArchive(fn)
+        return {
+            "keys": np.array(archive.keys()), "lengths": archive.lengths,
+            "dims": np.full(len(archive), archive.frames.shape[1], np.int64)
+            }
+
+    cache_fn = fn + ".index.npz"
+    fn_stat = os.stat(fn)
+    if use_cache and path.isfile(cache_fn):
+        try:
+            with np.load(cache_fn) as cache:
+                if (cache["mtime"] == fn_stat.st_mtime and cache["size"] ==
+                        fn_stat.st_size):
+                    return dict([
+                        (key, cache[key]) for key in cache.keys() if key not
+                        in ["mtime", "size"]
+                        ])
+        except (IOError, OSError, EOFError, KeyError, ValueError,
+                zipfile.BadZipFile):
+            pass  # damaged sidecar, rebuilt below
+
+    shapes = read_npz_shapes(fn)
+    keys = sorted(shapes)
+    index = {"keys": np.array(keys)}
+    index["lengths"] = np.array(
+        [shapes[key][0] if len(shapes[key]) > 1 else 1 for key in keys],
+        dtype=np.int64
+        )
+    index["dims"] = np.array(
+        [shapes[key][-1] for key in keys], dtype=np.int64
+        )
+
+    if use_cache:
+        tmp_fn = cache_fn[:-len(".npz")] + ".tmp{}.npz".format(os.getpid())
+        try:
+            np.savez(
+                tmp_fn, mtime=fn_stat.st_mtime, size=fn_stat.st_size, **index
+                )
+            os.rename(tmp_fn, cache_fn)
+        except (IOError, OSError):
+            if path.isfile(tmp_fn):
+                os.remove(tmp_fn)
+    return index
+
+
+def read_npz_arrays(npz_fn, keys=None, min_length=None, n_threads=None):
+    """
+    Return the keys and the arrays in the NumPy archive `npz_fn`.
+
+    Only the arrays for `keys` are read if given, otherwise all the arrays
+    in sorted key order. Arrays with `min_length` or fewer rows are skipped
+    using only their headers. Every other array is decompressed once, on a
+    pool of `n_threads` threads (zlib releases the GIL, so compressed
+    archives are read in parallel) each reading through its own handle to
+    the archive. By default, a thread is used per CPU, up to four.
+    """
+    if n_threads is None:
+        n_threads = min(4, os.cpu_count() or 1)
+    local = threading.local()
+    zip_files = []
+    lock = threading.Lock()
+
+    def read_array(key):
+        if not hasattr(local, "zf"):
+            local.zf = zipfile.ZipFile(npz_fn)
+            with lock:
+                zip_files.append(local.zf)
+        with local.zf.open(key + ".npy") as f:
+            shape, fortran_order, dtype = read_npy_header(f)
+            if min_length is not None and shape[0] <= min_length:
+                return None
+            assert not dtype.hasobject, "object arrays are not supported"
+            array = np.empty(
+                shape[::-1] if fortran_order else shape, dtype=dtype
+                )
+            n_bytes = f.readinto(array.reshape(-1).view(np.uint8))
+            assert n_bytes == array.nbytes, "truncated array: " + key
+        return array.T if fortran_order else array
+
+    if keys is None:
+        with zipfile.ZipFile(npz_fn) as zf:
+            keys = sorted([
+                name[:-len(".npy")] for name in zf.namelist() if
+                name.endswith(".npy")
+                ])
+    try:
+        if n_threads <= 1:
+            arrays = [read_array(key) for key in keys]
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                arrays = list(executor.map(read_array, keys))
+    finally:
+        for zf in zip_files:
+            zf.close()
+    use_keys = [key for key, array in zip(keys, arrays) if array is not None]
+    x = [array for array in arrays if array is not None]
+    return use_keys, x
+
+
+def write_packed(packed_dir, feat_dict, shapes=None, dtype=np.float32):
+    """
+    Write the features in `feat_dict` as a packed archive to `packed_dir`.
+
+    The `feat_dict` can be any dictionary-like mapping of keys to arrays, e.g.
+    a loaded NumPy archive. Items are written one at a time directly into the
+    memory-mapped output, so `feat_dict` is never held in memory in packed
+    form. If given, `shapes` should give the shape of each item; otherwise
+    shapes are taken from the items themselves. A `ValueError` is raised if
+    `feat_dict` is empty, since the frame dimensionality is then unknown.
+    """
+    keys = sorted(feat_dict)
+    if len(keys) == 0:
+        raise ValueError("no items to write to packed archive " + packed_dir)
+    if shapes is None:
+        shapes = dict([(key, feat_dict[key].shape) for key in keys])
+    item_ndim = len(shapes[keys[0]])
+    assert item_ndim in [1, 2], "only 1D or 2D items can be packed"
+    if item_ndim == 1:
+        lengths = np.ones(len(keys), dtype=np.int64)
+        d_frame = shapes[keys[0]][0]
+    else:
+        lengths = np.array([shapes[key][0] for key in keys], dtype=np.int64)
+        d_frame = shapes[keys[0]][1]
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    if not path.isdir(packed_dir):
+        os.makedirs(packed_dir)
+    frames = np.lib.format.open_memmap(
+        path.join(packed_dir, FRAMES_FN), mode="w+", dtype=dtype,
+        shape=(int(offsets[-1]), d_frame)
+        )
+    for i, key in enumerate(keys):
+        frames[offsets[i]:offsets[i + 1]] = feat_dict[key]
+    frames.flush()
+    del frames
+    np.savez(
+        path.join(packed_dir, INDEX_FN), keys=np.array(keys),
+        offsets=offsets, item_ndim=item_ndim
+        )
+
+
+def npz_to_packed(npz_fn, packed_dir, dtype=np.float32):
+    """Convert the NumPy archive `npz_fn` to a packed archive."""
+    shapes = read_npz_shapes(npz_fn)
+    write_packed(packed_dir, np.load(npz_fn), shapes=shapes, dtype=dtype)
+
+
+def check_argv():
+    """Check the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0], add_help=False
+        )
+    parser.add_argument("npz_fn", type=str, help="input NumPy archive")
+    parser.add_argument(
+        "packed_dir", type=str, help="output packed archive directory"
+        )
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    return parser.parse_args()
+
+
+#-----------------------------------------------------------------------------#
+#                                MAIN FUNCTION                                #
+#-----------------------------------------------------------------------------#
+
+def main():
+    args = check_argv()
+    print("Reading:", args.npz_fn)
+    print("Writing:", args.packed_dir)
+    npz_to_packed(args.npz_fn, args.packed_dir)
+    packed = PackedArchive(args.packed_dir)
+    print("No. items:", len(packed))
+    print("Frames shape:", packed.frames.shape)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Author: Herman Kamper
+Contact: kamperh@gmail.com
+Date: 2019
+"""
+
+from os import path
+import numpy as np
+import numpy.testing as npt
+import os
+import shutil
+import tempfile
+
+import packed
+
+
+#-----------------------------------------------------------------------------#
+#                                TEST FUNCTIONS                               #
+#-----------------------------------------------------------------------------#
+
+def test_npz_to_packed():
+
+    np.random.seed(1)
+    feat_dict = {
+        "because_s01_01a_000010-000060": np.random.randn(50, 39),
+        "about_s02_01b_000100-000145": np.random.randn(45, 39),
+        "people_s01_01a_000200-000251": np.random.randn(51, 39),
+        }
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        npz_fn = path.join(tmp_dir, "test.npz")
+        packed_dir = path.join(tmp_dir, "test.packed")
+        np.savez_compressed(npz_fn, **feat_dict)
+        assert packed.read_npz_shapes(npz_fn) == dict(
+            [(key, feat_dict[key].shape) for key in feat_dict]
+            )
+        packed.npz_to_packed(npz_fn, packed_dir)
+        archive = packed.load(packed_dir)
+        assert archive.keys() == sorted(feat_dict)
+        assert archive.frames.shape == (146, 39)
+        npt.assert_array_equal(archive.lengths, [45, 50, 51])
+        for key in feat_dict:
+            npt.assert_allclose(archive[key], feat_dict[key], rtol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_write_packed_embeddings():
+
+    np.random.seed(1)
+    embed_dict = {"b": np.random.randn(10), "a": np.random.randn(10)}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        packed_dir = path.join(tmp_dir, "embeds.packed")
+        packed.write_packed(packed_dir, embed_dict)
+        archive = packed.load(packed_dir)
+        assert archive.item_ndim == 1
+        assert archive.frames.shape == (2, 10)
+        for key in embed_dict:
+            npt.assert_allclose(archive[key], embed_dict[key], rtol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_write_packed_empty():
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        packed_dir = path.join(tmp_dir, "test.packed")
+        try:
+            packed.write_packed(packed_dir, {})
+            assert False, "expected ValueError"
+        except ValueError as e:
+            assert "no items" in str(e)
+        assert not path.exists(packed_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_read_npz_arrays():
+
+    np.random.seed(2)
+    feat_dict = {
+        "because_s01_01a_000010-000060": np.random.randn(50, 39),
+        "about_s02_01b_000100-000145": np.asfortranarray(
+            np.random.randn(45, 39)
+            ),
+        "people_s01_01a_000200-000251": np.random.randn(51, 39).astype(
+            np.float32
+            ),
+        }
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        npz_fn = path.join(tmp_dir, "test.npz")
+        np.savez_compressed(npz_fn, **feat_dict)
+        for n_threads in [1, 2]:
+            keys, x = packed.read_npz_arrays(
+                npz_fn, min_length=45, n_threads=n_threads
+                )
+            assert keys == [
+                "because_s01_01a_000010-000060",
+                "people_s01_01a_000200-000251"
+                ]
+            for key, array in zip(keys, x):
+                assert array.dtype == feat_dict[key].dtype
+                npt.assert_array_equal(array, feat_dict[key])
+        keys, x = packed.read_npz_arrays(npz_fn)
+        assert keys == sorted(feat_dict)
+        npt.assert_array_equal(x[0], feat_dict[keys[0]])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_read_index():
+
+    np.random.seed(3)
+    feat_dict = {
+        "because_s01_01a_000010-000060": np.random.randn(50, 39),
+        "about_s02_01b_000100-000145": np.random.randn(45, 13),
+        }
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        npz_fn = path.join(tmp_dir, "test.npz")
+        np.savez_compressed(npz_fn, **feat_dict)
+        for i in range(2):
+            index = packed.read_index(npz_fn)
+            assert path.isfile(npz_fn + ".index.npz")
+            assert index["keys"].tolist() == sorted(feat_dict)
+            npt.assert_array_equal(index["lengths"], [45, 50])
+            npt.assert_array_equal(index["dims"], [13, 39])
+
+        # A truncated sidecar is rebuilt
+        with open(npz_fn + ".index.npz", "r+b") as f:
+            f.truncate(20)
+        index = packed.read_index(npz_fn)
+        assert index["keys"].tolist() == sorted(feat_dict)
+        with np.load(npz_fn + ".index.npz") as cache:
+            npt.assert_array_equal(cache["lengths"], [45, 50])
+        assert sorted(os.listdir(tmp_dir)) == [
+            "test.npz", "test.npz.index.npz"
+            ]
+    finally:
+        shutil.rmtree(tmp_dir)
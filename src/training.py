@@ -6,7 +6,10 @@ Date: 2016, 2018, 2019
 """
 
 from datetime import datetime
+from os import path
 import numpy as np
+import os
+import pickle
 import sys
 import tensorflow as tf
 import timeit
@@ -158,7 +161,8 @@ def train_fixed_epochs(n_epochs, optimizer, train_loss_tensor,
 def train_fixed_epochs_external_val(n_epochs, optimizer, train_loss_tensor,
         train_feed_iterator, feed_placeholders, validation_func, save_model_fn,
         save_best_val_model_fn, n_val_interval=1, load_model_fn=None,
-        config=None, epoch_offset=0):
+        config=None, epoch_offset=0, checkpoint_fn=None,
+        n_checkpoint_batches=None):
     """
     Train a model for a fixed number of epochs with external validation.
     
@@ -185,6 +189,15 @@ def train_fixed_epochs_external_val(n_epochs, optimizer, train_loss_tensor,
         If provided, save final session to this file.
     save_best_val_model_fn : str
         If provided, save the best validation session to this file.
+    checkpoint_fn : str
+        If provided, a checkpoint of the session is saved after every epoch,
+        with the state of training and of `train_feed_iterator` (which should
+        provide `get_state` and `set_state`) written to `checkpoint_fn` +
+        ".state.pkl". If this file exists, training is resumed from the
+        checkpoint, continuing with exactly the batch where it stopped.
+    n_checkpoint_batches : int
+        If provided with `checkpoint_fn`, a checkpoint is also saved after
+        every this many training batches within an epoch.
     
     Return
     ------
@@ -200,48 +213,102 @@ def train_fixed_epochs_external_val(n_epochs, optimizer, train_loss_tensor,
     record_dict["train_loss"] = []
     record_dict["validation_loss"] = []
     best_validation_loss = np.inf
+
+    # Resume from checkpoint
+    i_epoch_start = 0
+    i_batch_start = 0
+    resume_model_fn = None
+    if checkpoint_fn is not None:
+        state_fn = checkpoint_fn + ".state.pkl"
+        checkpoint_saver = tf.train.Saver(max_to_keep=2)
+    if checkpoint_fn is not None and path.isfile(state_fn):
+        print("Reading: {}".format(state_fn))
+        with open(state_fn, "rb") as f:
+            state = pickle.load(f)
+        record_dict = state["record_dict"]
+        best_validation_loss = state["best_validation_loss"]
+        i_epoch_start = state["i_epoch"]
+        i_batch_start = state["i_batch"]
+        train_losses = state["train_losses"]
+        epoch_iterator_state = state["iterator_state"]
+        train_feed_iterator.set_state(epoch_iterator_state)
+        resume_model_fn = state["model_fn"]
+        checkpoint_saver.recover_last_checkpoints([resume_model_fn])
     
     print(datetime.now())
     
     def feed_dict(vals):
         return {key: val for key, val in zip(feed_placeholders, vals)}
 
+    def save_checkpoint(session, i_epoch, i_batch, iterator_state,
+            train_losses):
+        # The session is saved under a new name before the state refers to it
+        model_fn = checkpoint_saver.save(
+            session, "{}.{}.{}".format(checkpoint_fn, i_epoch, i_batch)
+            )
+        state = {
+            "model_fn": model_fn,
+            "record_dict": record_dict,
+            "best_validation_loss": best_validation_loss,
+            "i_epoch": i_epoch,
+            "i_batch": i_batch,
+            "train_losses": train_losses,
+            "iterator_state": iterator_state
+            }
+        with open(state_fn + ".tmp", "wb") as f:
+            pickle.dump(state, f, -1)
+        os.rename(state_fn + ".tmp", state_fn)
+
     # Launch the graph
     saver = tf.train.Saver()
-    if load_model_fn is None:
+    if load_model_fn is None and resume_model_fn is None:
         init = tf.global_variables_initializer()
     with tf.Session(config=config) as session:
         
         # Start or restore session
-        if load_model_fn is None:
+        if resume_model_fn is not None:
+            checkpoint_saver.restore(session, resume_model_fn)
+        elif load_model_fn is None:
             session.run(init)
         else:
             saver.restore(session, load_model_fn)
     
         # Train
-        for i_epoch in range(n_epochs):
+        for i_epoch in range(i_epoch_start, n_epochs):
             print("Epoch {}:".format(epoch_offset + i_epoch)),
             start_time = timeit.default_timer()
             
             # Train model
-            train_losses = []
-            if not isinstance(train_loss_tensor, (list, tuple)):
-                for cur_feed in train_feed_iterator:
+            if i_batch_start == 0:
+                train_losses = []
+                if checkpoint_fn is not None:
+                    epoch_iterator_state = train_feed_iterator.get_state()
+            for i_batch, cur_feed in enumerate(train_feed_iterator):
+                if i_batch < i_batch_start:
+                    continue  # trained on before the checkpoint
+                if not isinstance(train_loss_tensor, (list, tuple)):
                     _, cur_loss = session.run(
                         [optimizer, train_loss_tensor],
                         feed_dict=feed_dict(cur_feed)
                         )
-                    train_losses.append(cur_loss)
-                train_loss = np.mean(train_losses)
-            else:
-                for cur_feed in train_feed_iterator:
+                else:
                     cur_loss = session.run(
                         [optimizer] + train_loss_tensor,
                         feed_dict=feed_dict(cur_feed)
                         )
                     cur_loss.pop(0)  # remove the optimizer
                     cur_loss = np.array(cur_loss)
-                    train_losses.append(cur_loss)
+                train_losses.append(cur_loss)
+                if (checkpoint_fn is not None and n_checkpoint_batches is not
+                        None and (i_batch + 1) % n_checkpoint_batches == 0):
+                    save_checkpoint(
+                        session, i_epoch, i_batch + 1, epoch_iterator_state,
+                        train_losses
+                        )
+            i_batch_start = 0
+            if not isinstance(train_loss_tensor, (list, tuple)):
+                train_loss = np.mean(train_losses)
+            else:
                 train_loss = np.mean(train_losses, axis=0)
             record_dict["train_loss"].append((i_epoch, train_loss))
 
@@ -293,6 +360,12 @@ def train_fixed_epochs_external_val(n_epochs, optimizer, train_loss_tensor,
             print(log)
             sys.stdout.flush()
 
+            if checkpoint_fn is not None:
+                save_checkpoint(
+                    session, i_epoch + 1, 0, train_feed_iterator.get_state(),
+                    []
+                    )
+
         # if save_model_fn is not None:
         print("Writing: {}".format(save_model_fn))
         saver.save(session, save_model_fn)